@@ -0,0 +1,77 @@
+"""Import-time benchmark for the CLI entrypoint and the compile process targets.
+
+Runs `python -X importtime -c "import <module>"` for each entrypoint in a fresh
+interpreter and reports the cumulative import time. Fails (exit code 1) if an
+entrypoint imports a dependency it should not need, or exceeds its time budget.
+
+    $ python benchmarks/bench_importtime.py [--runs 5] [--budget-scale 1.0]
+"""
+from typing import Dict, List, Tuple
+import argparse
+import statistics
+import subprocess
+import sys
+
+# module => (budget in ms, top-level packages which must not be imported)
+ENTRYPOINTS: Dict[str, Tuple[float, List[str]]] = {
+    # imported by spawned compile processes when started through the `gadfly` script
+    "gadfly": (150, ["typer", "click", "toml", "livereload", "tornado", "watchdog", "mako", "markdown_it"]),
+    # `gadfly --help`, `gadfly compile` before dispatching
+    "gadfly.__main__": (250, ["toml", "livereload", "tornado", "watchdog", "mako", "markdown_it"]),
+    # target module of the page- and asset compile processes
+    "gadfly.mp": (250, ["typer", "click", "livereload", "tornado", "watchdog", "mako", "markdown_it"]),
+}
+
+
+def measure(module: str) -> Tuple[float, Dict[str, int]]:
+    """Import `module` in a fresh interpreter.
+
+    Returns:
+        (total cumulative import time in ms, {module name: cumulative us})
+    """
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True, check=True
+    )
+    imports = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        imports[name.strip()] = int(cumulative_us)
+    return imports[module] / 1000, imports
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5, help="runs per entrypoint, the median is reported")
+    parser.add_argument("--budget-scale", type=float, default=1.0, help="scale time budgets (slow CI machines)")
+    args = parser.parse_args()
+
+    failed = False
+    for module, (budget_ms, forbidden) in ENTRYPOINTS.items():
+        timings = []
+        imports = {}
+        for _ in range(args.runs):
+            total_ms, imports = measure(module)
+            timings.append(total_ms)
+        median_ms = statistics.median(timings)
+        budget_ms *= args.budget_scale
+        offending = sorted({name.split(".")[0] for name in imports} & set(forbidden))
+        slowest = sorted(
+            ((us, name) for name, us in imports.items() if name != module and "." not in name),
+            reverse=True)[:5]
+
+        status = "ok"
+        if offending or median_ms > budget_ms:
+            status = "FAIL"
+            failed = True
+        print(f"{module}: {median_ms:.1f}ms (budget {budget_ms:.0f}ms) [{status}]")
+        print(f"  slowest top-level imports: {', '.join(f'{name} {us / 1000:.1f}ms' for us, name in slowest)}")
+        if offending:
+            print(f"  imports forbidden dependencies: {', '.join(offending)}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
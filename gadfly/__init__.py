@@ -1 +1,11 @@
 from gadfly.config import Config
+
+
+def main():
+    """Entrypoint of the `gadfly` command.
+
+    Compile processes are started with the "spawn" method, which re-runs the
+    script of the `gadfly` command in each of them. Keeping the entrypoint in
+    this (light) module means they do not import the CLI and its dependencies."""
+    from gadfly.__main__ import main as _main
+    _main()
@@ -1,17 +1,18 @@
 import signal
 import sys
-from multiprocessing import Process
+from typing import List, Optional
 
 import typer
-from livereload import Server
-import toml
 
 from gadfly import config
-from gadfly import mp
 from gadfly import cli
-from gadfly import genproject
 from gadfly.assets.errors import *
 
+# NOTE: keep imports at the top light. Heavier dependencies (toml, livereload,
+#       watchdog, mako...) are imported by the commands needing them, keeping
+#       `gadfly --help` and the start of compile processes fast.
+#       See benchmarks/bench_importtime.py
+
 # CLI
 #  watch+dev server
 #  single compile pass
@@ -21,13 +22,105 @@ app = typer.Typer(
 
 
 @app.command()
-def compile():
+def compile(daemon: bool = typer.Option(
+        default=False, help="build through the project's running `gadfly daemon`, if any")):
     """
     Do a single compile.
     """
     cfg = config.config
     cfg.dev_mode = False
-    mp.compile_once(config.config)
+    if daemon:
+        from gadfly import daemon as build_daemon
+        try:
+            answer = build_daemon.request(cfg, {"cmd": "build"})
+        except build_daemon.DaemonNotRunningError:
+            cli.info("no daemon running, compiling without")
+        else:
+            if not answer["ok"]:
+                cli.pp_err_details("daemon build failed", {"error": answer["error"]})
+                sys.exit(1)
+            changes = answer["changes"]
+            cli.info(f"built by daemon in {answer['ms']}ms: {changes['added']} added, {changes['changed']} changed, "
+                     f"{changes['removed']} removed, see '.gadfly/changes.json'")
+            return
+    from gadfly import mp
+    if mp.compile_once(cfg):
+        # over budget, see `gadfly.metrics`
+        sys.exit(1)
+
+
+@app.command()
+def check(render: bool = typer.Option(
+        default=False, help="also render pages against the context, discarding the output")):
+    """
+    Compile all templates and pages, reporting every error, without writing output.
+    """
+    from gadfly import check as site_check
+    cfg = config.config
+    cfg.dev_mode = False
+    if site_check.run(cfg, render):
+        sys.exit(1)
+
+
+@app.command()
+def metrics(builds: Optional[List[str]] = typer.Argument(
+        default=None, help="build numbers (or 'latest'): one to show it, two to compare them")):
+    """
+    List the builds recorded by `compile`, show one or compare two.
+    """
+    import json
+    from gadfly import metrics as build_metrics
+    cfg = config.config
+    builds = builds or []
+    if len(builds) > 2:
+        cli.pp_err_details("expected at most two builds", {"got": ", ".join(builds)})
+        sys.exit(1)
+    try:
+        records = [build_metrics.load(cfg, build_id) for build_id in builds]
+    except KeyError as e:
+        cli.pp_err_details("no such build recorded", {"build": e.args[0], "see": "gadfly metrics"})
+        sys.exit(1)
+    if not records:
+        build_metrics.list_builds(cfg)
+    elif len(records) == 1:
+        print(json.dumps(records[0], indent=2))
+    else:
+        build_metrics.compare(*records)
+
+
+@app.command()
+def daemon(status: bool = typer.Option(default=False, help="show the status of the running daemon"),
+           invalidate: Optional[str] = typer.Option(
+               default=None, help="'context', 'templates' or 'assets': redo these in the next build")):
+    """
+    Keep compilers running, serving builds requested by `compile --daemon`.
+    """
+    import json
+    from gadfly import daemon as build_daemon
+    cfg = config.config
+    cfg.dev_mode = False
+    if status or invalidate is not None:
+        try:
+            answer = build_daemon.request(cfg, {"cmd": "status"} if status
+                                          else {"cmd": "invalidate", "what": invalidate})
+        except build_daemon.DaemonNotRunningError as e:
+            cli.pp_err_details("no daemon running", {"socket": e.path})
+            sys.exit(1)
+        if not answer["ok"]:
+            cli.pp_err_details("daemon request failed", {"error": answer["error"]})
+            sys.exit(1)
+        if status:
+            print(json.dumps(answer, indent=2))
+        return
+
+    def on_ctrl_c(sig, frame):
+        # the compile processes receive the signal themselves
+        print("CTRL-C hit..")
+        print(f"{cli.colors.CLR}", end="", flush=True)
+        sys.exit(0)
+
+    signal.signal(signal.SIGINT, on_ctrl_c)
+    build_daemon.serve(cfg)
 
 
 @app.command()
@@ -35,35 +128,31 @@ def watch(watch_port: int = 5500):
     """
     Watch for changes and recompile when needed.
     """
+    from gadfly import mp
     cfg = config.config
     cfg.dev_mode = True
 
-    def _serve():
-        s = Server()
-        s.watch(f"{config.config.output_path}/**")
-        s.serve(root=config.config.output_path, port=watch_port)
-
-    server = Process(target=_serve)
-
     def on_ctrl_c(sig, frame):
+        # the compile processes and dev server receive the signal themselves
         print("CTRL-C hit..")
-        server.terminate()
         print(f"{cli.colors.CLR}", end="", flush=True)
         sys.exit(0)
 
     signal.signal(signal.SIGINT, on_ctrl_c)
 
-    server.start()
-    mp.compile_watch(config.config)
-    server.terminate()
+    mp.compile_watch(cfg, serve_port=watch_port)
 
 
 @app.callback()
-def _pre_command(silent: bool = False, project: Path = typer.Option(default=Path(".."), help="project directory")):
+def _pre_command(silent: bool = False,
+                 project: Path = typer.Option(default=Path(".."), help="project directory"),
+                 no_context_cache: bool = typer.Option(
+                     default=False, help="re-evaluate the context hook, ignoring any cached snapshot")):
     # TODO: for most commands, we would want to check and enforce that the project directory exists
     #       maybe a decorator ?
     # install project directory as a path we look for modules in
     # this permits handlers to be expressed as strings of the form "mod1.mod2:fn"
+    import toml
     print("HELLO")
     print(project)
     sys.path.insert(1, str(project.absolute()))
@@ -71,6 +160,7 @@ def _pre_command(silent: bool = False, project: Path = typer.Option(default=Path
     if not conf_path.exists():
         print(f"No {conf_path.name} in {conf_path.parent}.")
         if cli.prompt_yes_no("Create 'gadfly.toml' ?"):
+            from gadfly import genproject
             genproject.genconf(conf_path)
         else:
             print("oh... OK...")
@@ -108,7 +198,12 @@ def _pre_command(silent: bool = False, project: Path = typer.Option(default=Path
             {"asset": e.asset_name, "path": e.asset_path}
         )
         sys.exit(1)
+    except AssetValidationError as e:
+        cli.pp_exc()
+        cli.pp_err_details(str(e), {"asset": e.asset_name, "path": e.asset_path})
+        sys.exit(1)
     config.config.silent = silent
+    config.config.bypass_context_cache = no_context_cache
 
 
 def main():
@@ -1,6 +1,6 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Optional
+from typing import Callable, Optional
 from gadfly.config import Config
 
 
@@ -14,3 +14,24 @@ class AssetCtx:
     dev_mode: bool
     # file asset -- only provided in watch mode where something happened
     file: Optional[Path] = None
+    # name and options of the asset's `[assets.<name>]` section
+    asset_name: Optional[str] = None
+    asset_opts: dict = field(default_factory=dict)
+    # see `kept` and `written`
+    on_kept: Optional[Callable[[Path], None]] = None
+    on_written: Optional[Callable[[Path], None]] = None
+
+    def kept(self, path: Path) -> None:
+        """Register that output file `path` is still produced by this asset, though
+        the handler did not rewrite it."""
+        if self.on_kept is not None:
+            self.on_kept(path)
+
+    def written(self, path: Path) -> None:
+        """Register that the handler (re-)wrote output file `path`.
+
+        Files written below the asset's `out` directory are found without
+        this, others must be reported to be tracked (manifest, compression,
+        pages referencing them)."""
+        if self.on_written is not None:
+            self.on_written(path)
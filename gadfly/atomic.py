@@ -0,0 +1,35 @@
+"""Atomic writes of output, state and cache files.
+
+Has no dependencies within gadfly, such that any module (including those
+`gadfly.output` depends on) can use it.
+"""
+from pathlib import Path
+from typing import Iterator
+from contextlib import contextmanager
+import threading
+import os
+
+
+@contextmanager
+def open_atomic(path: Path, mode: str = "wb", **kwargs) -> Iterator:
+    """Open temporary file which replaces `path` once closed without error.
+
+    Readers never observe a partially written file. If an exception is raised,
+    `path` is left untouched."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # unique per process and thread, the page and asset compilers (and their
+    # compression threads) may rewrite the same file concurrently
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}-{threading.get_ident()}.tmp")
+    try:
+        with open(tmp_path, mode, **kwargs) as fh:
+            yield fh
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    os.replace(tmp_path, path)
+
+
+def write_atomic(path: Path, content: bytes) -> None:
+    """Write file via a temporary file, readers never observe a partially written file."""
+    with open_atomic(path) as fh:
+        fh.write(content)
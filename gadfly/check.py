@@ -0,0 +1,268 @@
+"""Validation of templates and pages without writing any output, see `gadfly check`.
+
+Every template (any file under `templates_path`) and every page is compiled,
+in the worker pool for larger sites. With `render`, the context hook is
+evaluated and each page rendered against it into a sink discarding the output,
+as a build would: pages go through the page pre-compile hook, and with
+`[build] metadata_phase` the metadata sections of all pages are evaluated
+before any page is rendered. Post-compile hooks and output transforms are not
+run, they act on the output.
+
+Errors do not stop the check, all are collected and reported at once, located
+at the innermost template (or project code) frame involved.
+"""
+from concurrent.futures import Executor
+from contextlib import nullcontext
+from functools import partial
+from io import TextIOBase
+from os import walk
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
+import os
+import time
+from mako.exceptions import CompileException, RichTraceback, SyntaxException
+from gadfly import cli
+from gadfly import config as config_mod
+from gadfly import shared_context
+from gadfly.compiler import compile_page_to, page_metadata
+from gadfly.config import Config
+from gadfly.templating import Environment
+from gadfly.workers import create_pool, worker_count
+
+# files checked per worker job
+BATCH_SIZE = 32
+# below this many files, starting worker processes costs more than it saves
+PARALLEL_MIN_FILES = 50
+
+
+class CheckError(NamedTuple):
+    # file holding the error, relative to the project root
+    file: str
+    line: Optional[int]
+    message: str
+    # source at `line`, if known
+    code: Optional[str] = None
+    # page being rendered, if the error is in another file (e.g. a template it inherits)
+    page: Optional[str] = None
+
+
+class _NullSink(TextIOBase):
+    def write(self, s: str) -> int:
+        return len(s)
+
+
+def _rel(cfg: Config, fpath) -> str:
+    try:
+        return str(Path(fpath).relative_to(cfg.project_root))
+    except ValueError:
+        return str(fpath)
+
+
+def _within(fpath: str, root: Path) -> bool:
+    return fpath.startswith(str(root) + os.sep)
+
+
+def _error(cfg: Config, fpath: Path, e: Exception, prefix: str = "") -> CheckError:
+    """Error `e`, raised while checking `fpath`.
+
+    NOTE: must be called while handling `e`, the traceback is read from `sys.exc_info`."""
+    page = _rel(cfg, fpath) if fpath.suffix == ".md" else None
+    if isinstance(e, (CompileException, SyntaxException)):
+        # mako appends the position to the message, reported on its own
+        message = str(e).split(" in file '", 1)[0]
+        return CheckError(_rel(cfg, e.filename or fpath), e.lineno, f"{prefix}{type(e).__name__}: {message}")
+    if isinstance(e, SyntaxError) and e.filename:
+        # in the project's code, which has no frame of its own
+        return CheckError(_rel(cfg, e.filename), e.lineno, f"{prefix}SyntaxError: {e.msg}", e.text, page)
+    if type(e) is NameError and str(e) == "Undefined":
+        message = "NameError: undefined name rendered"
+    else:
+        message = f"{type(e).__name__}: {e}"
+    # frames of template code are mapped back to the template's lines
+    frames = [(filename, lineno, code) for filename, lineno, _fn, code in RichTraceback().traceback]
+    for roots in ((cfg.templates_path, cfg.pages_path), (cfg.project_root,)):
+        for filename, lineno, code in reversed(frames):
+            if any(_within(filename, root) for root in roots) and "site-packages" not in filename:
+                file = _rel(cfg, filename)
+                return CheckError(file, lineno, f"{prefix}{message}", code, page if page != file else None)
+    return CheckError(_rel(cfg, fpath), None, f"{prefix}{message}")
+
+
+# templating environment of a worker process
+_worker_env: Optional[Environment] = None
+
+
+def _env() -> Environment:
+    global _worker_env
+    if _worker_env is None:
+        _worker_env = Environment(config=config_mod.config)
+    return _worker_env
+
+
+def _check_templates(paths: List[Path]) -> List[CheckError]:
+    # NOTE: runs in a worker process for larger sites
+    cfg = config_mod.config
+    errors = []
+    for fpath in paths:
+        try:
+            _env().template_from_file(fpath)
+        except Exception as e:
+            errors.append(_error(cfg, fpath, e))
+    return errors
+
+
+def _check_pages(pages: List[Tuple[Path, Optional[Dict]]], metadata: bool,
+                 render: bool) -> Tuple[Dict[Path, Dict], List[CheckError]]:
+    """Compile `pages`, evaluating their metadata section if `metadata` and
+    rendering them if `render`. Pages are given along with the extra variables
+    set by the page pre-compile hook, None for pages to compile only.
+
+    Returns:
+        metadata of the pages whose metadata section was evaluated, errors.
+    """
+    # NOTE: runs in a worker process for larger sites
+    cfg = config_mod.config
+    env = _env()
+    page_mds = {}
+    errors = []
+    for page_path, extra_vars in pages:
+        try:
+            if extra_vars is None or not (metadata or render):
+                env.template_from_file(page_path)
+                continue
+            if metadata:
+                page_mds[page_path] = page_metadata(page_path, cfg, env, extra_vars)
+            if render:
+                cfg.page_md.setdefault(page_path.relative_to(cfg.pages_path), {})
+                compile_page_to(page_path, cfg, env, _NullSink(), page_vars=extra_vars)
+        except Exception as e:
+            errors.append(_error(cfg, page_path, e))
+    return page_mds, errors
+
+
+def _files(root: Path, accept: Callable[[str], bool]) -> List[Path]:
+    found = []
+    for dirpath, dir_names, file_names in walk(root):
+        dir_names[:] = [name for name in dir_names if not name.startswith(".")]
+        found.extend(Path(dirpath) / name for name in file_names if accept(name))
+    return sorted(found)
+
+
+def _run(pool: Optional[Executor], fn: Callable, items: list) -> Iterable:
+    """Results of `fn` over batches of `items`, submitted right away to `pool`, if any."""
+    batches = [items[ndx:ndx + BATCH_SIZE] for ndx in range(0, len(items), BATCH_SIZE)]
+    if pool is None:
+        return (fn(batch) for batch in batches)
+    return pool.map(fn, batches)
+
+
+def _prepare_render(cfg: Config, pages: List[Path],
+                    errors: List[CheckError]) -> Optional[Dict[Path, Optional[Dict]]]:
+    """Evaluate the context and run the page pre-compile hook over `pages`.
+
+    Returns:
+        pages to check, with the extra variables set by the hook (None for
+        pages it filtered out, compiled only), None if the context cannot be
+        evaluated."""
+    # imported here, as for `mp`'s users, the hooks are loaded as the page compiler does
+    from gadfly.mp import ConsumerProcessFatalError, _eval_context, get_code_hook, page_pre_compile_noop
+    module = cfg.code.module_path
+    try:
+        context = _eval_context(cfg)
+        pre_compile_hook = get_code_hook(cfg, cfg.code.page_pre_compile_hook) or page_pre_compile_noop
+    except ConsumerProcessFatalError:
+        # already reported
+        errors.append(CheckError(_rel(cfg, module), None, "invalid hooks, see above"))
+        return None
+    except Exception as e:
+        errors.append(_error(cfg, Path(module), e, "loading the project's code: "))
+        return None
+    if context is None:
+        errors.append(CheckError(_rel(cfg, module), None, "context hook failed, see the trace above"))
+        return None
+    cfg.context = context
+
+    page_vars: Dict[Path, Optional[Dict]] = {}
+    for page_path in pages:
+        cfg.page_md[page_path.relative_to(cfg.pages_path)] = {}
+        extra_vars = {}
+        try:
+            keep = pre_compile_hook(page_path, cfg, extra_vars)
+        except Exception as e:
+            errors.append(_error(cfg, page_path, e, "page pre-compile hook: "))
+            keep = False
+        page_vars[page_path] = extra_vars if keep else None
+    return page_vars
+
+
+def run(cfg: Config, render: bool = False) -> List[CheckError]:
+    """Check all templates and pages, rendering pages if `render`, see the module's documentation.
+
+    Returns:
+        all errors found, reported already.
+    """
+    started = time.perf_counter()
+    templates = _files(cfg.templates_path, lambda name: not name.startswith("."))
+    pages = _files(cfg.pages_path, lambda name: name.endswith(".md"))
+    errors: List[CheckError] = []
+    page_vars: Optional[Dict[Path, Optional[Dict]]] = None
+    if render:
+        page_vars = _prepare_render(cfg, pages, errors)
+        render = page_vars is not None
+    if page_vars is None:
+        page_vars = {page_path: None for page_path in pages}
+    # rendered once all metadata is known, by workers started with it
+    two_pass = render and cfg.build.metadata_phase
+
+    parallel = worker_count(cfg) > 1 and len(templates) + len(pages) >= PARALLEL_MIN_FILES
+    context_path = shared_context.write(cfg, cfg.context) if parallel and cfg.context else None
+    try:
+        with create_pool(cfg, context_path) if parallel else nullcontext() as pool:
+            template_results = _run(pool, _check_templates, templates)
+            page_results = _run(pool, partial(_check_pages, metadata=two_pass, render=render and not two_pass),
+                                list(page_vars.items()))
+            for batch_errors in template_results:
+                errors.extend(batch_errors)
+            page_mds = {}
+            for batch_mds, batch_errors in page_results:
+                page_mds.update(batch_mds)
+                errors.extend(batch_errors)
+
+        if two_pass:
+            for page_path, page_md in page_mds.items():
+                page_name = page_path.relative_to(cfg.pages_path)
+                cfg.page_md[page_name] = {**cfg.page_md[page_name], **page_md}
+            # pages whose metadata section failed are reported already
+            to_render = [(page_path, page_vars[page_path]) for page_path in page_mds]
+            with create_pool(cfg, context_path) if parallel else nullcontext() as pool:
+                for _mds, batch_errors in _run(pool, partial(_check_pages, metadata=False, render=True), to_render):
+                    errors.extend(batch_errors)
+    finally:
+        if context_path is not None:
+            shared_context.remove(context_path)
+
+    distinct = report(cfg, errors)
+    what = "rendered" if render else "compiled"
+    summary = f"{len(errors) or 'no'} error{'s' if len(errors) != 1 else ''}"
+    if distinct != len(errors):
+        summary += f" ({distinct} distinct)"
+    cli.info(f"checked {len(templates)} templates and {len(pages)} pages ({what}) "
+             f"in {int((time.perf_counter() - started) * 1000)}ms: {summary}")
+    return errors
+
+
+def report(cfg: Config, errors: List[CheckError]) -> int:
+    """Report `errors`, returns the number of distinct errors."""
+    # an error in a template shows up in every page using it, reported once
+    grouped: Dict[Tuple[str, Optional[int], str], List[CheckError]] = {}
+    for error in sorted(errors, key=lambda error: (error.file, error.line or 0, error.page or "")):
+        grouped.setdefault((error.file, error.line, error.message), []).append(error)
+    for (file, line, message), group in grouped.items():
+        details = {"in": f"{file}:{line}" if line is not None else file}
+        if group[0].code:
+            details["line"] = group[0].code.strip()
+        pages = [error.page for error in group if error.page is not None]
+        if pages:
+            details["page"] = pages[0] if len(pages) == 1 else f"{pages[0]} and {len(pages) - 1} more"
+        cli.pp_err_details(message, details)
+    return len(grouped)
@@ -1,35 +1,249 @@
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Optional, List, Callable, Iterable, Sequence, TextIO, Tuple, Union
 from pathlib import Path
-from os import walk
+from io import StringIO
+import tempfile
+from dataclasses import dataclass
+import time
+from gadfly import deps
+from gadfly import metrics
+from gadfly import config as config_mod
 from gadfly.config import Config
-from gadfly.cli import info, colors
+from gadfly.cli import info, colors, pp_exc, pp_err_details
 from gadfly.utils import output_path
+from gadfly.output import Outputs
+from gadfly.pages import PageEntry, PageIndex
+from gadfly.search import SearchIndex
+from gadfly.links import LinkChecker
+from gadfly.transforms import TransformPipeline
+from gadfly.workers import LazyPool, worker_count
+from concurrent.futures import Future, wait as wait_futures
 from gadfly.page_hooks_api import *
-from gadfly.template_runtime import Environment
+from gadfly.templating import Environment
 from mako.runtime import UNDEFINED
 
 
 ContextDict = Dict[str, Any]
 
+# name of the def holding a page's metadata, evaluated on its own in the metadata phase
+METADATA_DEF = "gf_metadata"
+# below this many pages, starting worker processes costs more than it saves
+PARALLEL_METADATA_MIN_PAGES = 50
+# generated pages rendered per worker job, see `GeneratedPages`
+GENERATED_BATCH_SIZE = 32
 
-def render_generated_page(page: Path, template_path: str, cfg: Config, env: Environment, ctx: ContextDict):
-    """Generate page from path, template and given context."""
+
+@dataclass(frozen=True)
+class RenderCtx:
+    """Everything needed to render pages, created once per page compiler process."""
+    config: Config
+    env: Environment
+    page_pre_compile_hook: PagePreCompileHookFn
+    page_post_compile_hook: PagePostCompileHookFn
+    outputs: Outputs
+    transforms: TransformPipeline
+    pool: LazyPool
+    # pages of the project, kept up to date by the page compiler
+    pages: PageIndex
+    # render pages straight to their output files, see `render`
+    stream: bool = False
+    page_post_compile_stream_hook: Optional[PagePostCompileStreamHookFn] = None
+    # search index fed the rendered pages, if enabled
+    search: Optional[SearchIndex] = None
+    # link checker fed the written pages, if enabled
+    links: Optional[LinkChecker] = None
+
+
+def _generated_path(page: Path, cfg: Config) -> Path:
     if page.is_absolute():
         try:
             # is_relative_to requires Python 3.9
             page.relative_to(cfg.output_path)
-        except AttributeError:
-            # TODO: better error
+        except ValueError:
             raise RuntimeError(f"invalid path '{page}' - not contained in output_path")
+        return page
+    return cfg.output_path / page
+
+
+def _write_generated(page: Path, content: str, cfg: Config, outputs: Outputs,
+                     links: Optional[LinkChecker]) -> None:
+    data = content.encode("utf-8")
+    try:
+        # leave the file (and its mtime) untouched if the page did not change
+        unchanged = page.stat().st_size == len(data) and page.read_bytes() == data
+    except OSError:
+        unchanged = False
+    info(f"generating page '{colors.B_MAGENTA}{page.relative_to(cfg.project_root)}{colors.B_WHITE}'"
+         + (" (unchanged)" if unchanged else ""))
+    if unchanged:
+        outputs.written(page, data)
     else:
-        page = cfg.output_path / page
+        outputs.write(page, content)
+    if links is not None and page.suffix == ".html":
+        links.add(page, content)
+
 
-    template = env.template_from_file(cfg.templates_path / template_path)
-    content = env.render(template, ctx)
-    page.parent.mkdir(parents=True, exist_ok=True)
-    with open(page, "w") as fh:
+def render_generated_page(page: Path, template_path: str, cfg: Config, env: Environment, ctx: ContextDict,
+                          outputs: Outputs, links: Optional[LinkChecker] = None):
+    """Generate page from path, template and given context."""
+    page = _generated_path(page, cfg)
+    template = env.template(template_path)
+    if cfg.build.stream_pages:
         info(f"generating page '{colors.B_MAGENTA}{page.relative_to(cfg.project_root)}{colors.B_WHITE}'")
-        fh.write(content)
+        # generated pages are not post-processed, always safe to stream
+        with outputs.writing(page) as fh:
+            env.render_to(template, ctx, fh)
+        if links is not None and page.suffix == ".html":
+            links.add_file(page)
+        return
+    _write_generated(page, env.render(template, ctx), cfg, outputs, links)
+
+
+def _render_generated_job(batch: List[Tuple[str, ContextDict]]) -> List[Tuple[Optional[str], Optional[str]]]:
+    # NOTE: runs in a worker process, returns the content or the error of each page
+    env = _worker_environment()
+    results = []
+    for template_path, ctx in batch:
+        try:
+            results.append((env.render(env.template(template_path), ctx), None))
+        except Exception as e:
+            pp_exc()
+            results.append((None, f"{type(e).__name__}: {e}"))
+    return results
+
+
+class _GeneratedFuture(Future):
+    def __init__(self, pages: "GeneratedPages"):
+        super().__init__()
+        self._pages = pages
+
+    # a hook waiting for a page still queued would wait forever, send the queue off first
+    def result(self, timeout=None):
+        if not self.done():
+            self._pages.dispatch()
+        return super().result(timeout)
+
+    def exception(self, timeout=None):
+        if not self.done():
+            self._pages.dispatch()
+        return super().exception(timeout)
+
+
+class GeneratedPages:
+    def __init__(self, rctx: RenderCtx):
+        """The `render_generated_page` callback passed to the post-compile hook.
+
+        Calling it, as `render_generated_page(page, template, context)`, renders
+        and writes the page right away. Hooks generating many pages should use
+        `submit` (or `render_many`) instead: pages are then rendered in batches by
+        the worker pool, along with the rest of the hook. All pages submitted
+        are written by the time `wait` returns, called once the hook is done.
+
+        Either way, a page whose content did not change is not rewritten."""
+        self._rctx = rctx
+        # generated pages are streamed in-process, see `render_generated_page`
+        self._parallel = worker_count(rctx.config) > 1 and not rctx.config.build.stream_pages
+        # pages submitted, not yet sent to the worker pool
+        self._queue: List[Tuple[Path, str, ContextDict, Future]] = []
+        self._futures: List[Future] = []
+        self._dispatched = False
+
+    def __call__(self, page: Union[str, Path], template_path: str, ctx: ContextDict) -> None:
+        rctx = self._rctx
+        render_generated_page(Path(page), template_path, rctx.config, rctx.env, ctx, rctx.outputs, rctx.links)
+
+    def submit(self, page: Union[str, Path], template_path: str, ctx: ContextDict) -> Future:
+        """Queue page for rendering.
+
+        Returns:
+            a future resolving to the output file once written. If rendering
+            fails, the error is reported and the future holds it.
+
+        Raises:
+            RuntimeError: if `page` is not within the output directory.
+        """
+        # validated before the page is queued, `wait` never waits for it
+        page = _generated_path(Path(page), self._rctx.config)
+        fut = _GeneratedFuture(self)
+        self._futures.append(fut)
+        self._queue.append((page, template_path, ctx, fut))
+        if self._parallel and len(self._queue) >= GENERATED_BATCH_SIZE:
+            self.dispatch()
+        return fut
+
+    def render_many(self, jobs: Iterable[Tuple[Union[str, Path], str, ContextDict]]) -> None:
+        """Render pages given as (page, template, context), returns once all are written."""
+        futures = [self.submit(page, template_path, ctx) for page, template_path, ctx in jobs]
+        self.dispatch()
+        wait_futures(futures)
+
+    def dispatch(self) -> None:
+        """Send the queued pages off to be rendered."""
+        queue, self._queue = self._queue, []
+        if not queue:
+            return
+        if not self._parallel:
+            self._render_queued(queue)
+            return
+        self._dispatched = True
+        try:
+            job = self._rctx.pool.get().submit(
+                _render_generated_job, [(template_path, ctx) for _page, template_path, ctx, _fut in queue])
+        except Exception as e:
+            # e.g. a broken pool, the queued pages must not be waited for
+            job = Future()
+            job.set_exception(e)
+        job.add_done_callback(lambda result: self._write_queued(queue, result))
+
+    def _render_queued(self, queue: List[Tuple[Path, str, ContextDict, Future]]) -> None:
+        rctx = self._rctx
+        for page, template_path, ctx, fut in queue:
+            try:
+                render_generated_page(page, template_path, rctx.config, rctx.env, ctx, rctx.outputs, rctx.links)
+            except Exception as e:
+                pp_exc()
+                self._failed(page, template_path, fut, e)
+                continue
+            fut.set_result(page)
+
+    def _write_queued(self, queue: List[Tuple[Path, str, ContextDict, Future]], result: Future) -> None:
+        # NOTE: may run in another thread
+        rctx = self._rctx
+        try:
+            results = result.result()
+        except Exception as e:
+            # e.g. a context which cannot be pickled
+            pp_exc()
+            results = [(None, f"{type(e).__name__}: {e}")] * len(queue)
+        for (page, template_path, _ctx, fut), (content, error) in zip(queue, results):
+            if content is None:
+                self._failed(page, template_path, fut, RuntimeError(error))
+                continue
+            try:
+                _write_generated(page, content, rctx.config, rctx.outputs, rctx.links)
+            except Exception as e:
+                pp_exc()
+                self._failed(page, template_path, fut, e)
+                continue
+            fut.set_result(page)
+
+    def _failed(self, page: Path, template_path: str, fut: Future, e: Exception) -> None:
+        pp_err_details("failed to render generated page", {
+            "page": page.relative_to(self._rctx.config.project_root),
+            "template": template_path,
+            "error": e,
+        })
+        fut.set_exception(e)
+
+    def wait(self) -> None:
+        """Block until all pages passed to `submit` are written."""
+        if not self._dispatched:
+            # too few pages to be worth starting workers for
+            queue, self._queue = self._queue, []
+            self._render_queued(queue)
+        self.dispatch()
+        futures, self._futures = self._futures, []
+        self._dispatched = False
+        wait_futures(futures)
 
 
 def compile_page(page: Path, config: Config, env: Environment, page_vars: Optional[Dict] = None) -> str:
@@ -44,7 +258,18 @@ def compile_page(page: Path, config: Config, env: Environment, page_vars: Option
     Returns:
         the generated HTML output as a string
     """
-    render_ctx = {**config.context}
+    buf = StringIO()
+    compile_page_to(page, config, env, buf, page_vars)
+    return buf.getvalue()
+
+
+def compile_page_to(page: Path, config: Config, env: Environment, buf: TextIO,
+                    page_vars: Optional[Dict] = None) -> None:
+    """Generate HTML output from page, writing it to `buf` as it is produced.
+
+    See `compile_page`."""
+    # the context itself is added by the environment
+    render_ctx = {}
     if page_vars is not None:
         render_ctx.update(**page_vars)
 
@@ -61,61 +286,318 @@ def compile_page(page: Path, config: Config, env: Environment, page_vars: Option
     render_ctx.update({
         "gf_page_name": page_name,
         "gf_md_assoc": md_assoc,
+        "gf_page_md": config.page_md,
     })
     template = env.template_from_file(page)
-    return env.render(template, render_ctx)
+    env.render_to(template, render_ctx, buf)
+
+
+def page_metadata(page: Path, config: Config, env: Environment, page_vars: Optional[Dict] = None) -> Dict:
+    """Evaluate only the metadata section of a page.
 
+    The metadata section is the page's `gf_metadata` def, e.g.:
 
-def write_output_file(config: Config, page_path: Path, content: str):
-    out_path = output_path(config, page_path)
-    out_path.parent.mkdir(parents=True, exist_ok=True)
-    with open(out_path, "w") as fh:
-        info(
-            f"'{colors.B_MAGENTA}{page_path.relative_to(config.project_root)}{colors.B_WHITE}' -> '{colors.B_MAGENTA}{out_path.relative_to(config.project_root)}{colors.B_WHITE}'")
-        fh.write(content)
+        <%def name="gf_metadata()">${gf_md_assoc(title="Hello", date="2021-10-01")}</%def>
 
+    Args:
+        page: path to the page file (.md)
+        config: gadfly config
+        env: environment class (see compiler.py)
+        page_vars: additional variables to make available to the templating environment for this page only.
+
+    Returns:
+        the metadata set via `gf_md_assoc` calls, empty if the page has no metadata section.
+    """
+    template = env.template_from_file(page)
+    if not template.has_def(METADATA_DEF):
+        return {}
+    page_md = {}
+
+    def md_assoc(**kwargs) -> str:
+        page_md.update({key: val for key, val in kwargs.items() if val not in (None, UNDEFINED)})
+        return ""
+
+    render_ctx = {
+        **(page_vars or {}),
+        "gf_page_name": page.relative_to(config.pages_path),
+        "gf_md_assoc": md_assoc,
+        "gf_page_md": config.page_md,
+    }
+    env.render(template.get_def(METADATA_DEF), render_ctx)
+    return page_md
 
-def unlink_output_file(config: Config, page_path: Path):
-    out_path = output_path(config, page_path)
+
+# templating environment of a worker process, see `_worker_environment`
+_worker_env: Optional[Environment] = None
+
+
+def _worker_environment() -> Environment:
+    global _worker_env
+    if _worker_env is None:
+        _worker_env = Environment(config=config_mod.config)
+    return _worker_env
+
+
+def _page_metadata_job(page: Path, page_vars: Dict) -> Dict:
+    # NOTE: runs in a worker process
+    return page_metadata(page, config_mod.config, _worker_environment(), page_vars)
+
+
+def _info_output(config: Config, page_path: Path, out_path: Path) -> None:
+    info(
+        f"'{colors.B_MAGENTA}{page_path.relative_to(config.project_root)}{colors.B_WHITE}' -> '{colors.B_MAGENTA}{out_path.relative_to(config.project_root)}{colors.B_WHITE}'")
+
+
+def write_output_file(config: Config, page_path: Path, content: str, outputs: Outputs,
+                      out_path: Optional[Path] = None):
+    if out_path is None:
+        out_path = output_path(config, page_path)
+    _info_output(config, page_path, out_path)
+    outputs.write(out_path, content)
+
+
+def unlink_output_file(rctx: RenderCtx, page_path: Path):
+    _unlink_output(rctx, rctx.pages.entry(page_path))
+
+
+def _unlink_output(rctx: RenderCtx, entry: PageEntry) -> None:
+    if rctx.search is not None:
+        rctx.search.remove(entry.name)
+    out_path = entry.out_path
     out_path.unlink(missing_ok=True)
-    page_dir = out_path.parent
-    if page_dir.exists():
-        out_path.parent.rmdir()
+    rctx.outputs.removed(out_path)
+    if rctx.links is not None:
+        rctx.links.removed(out_path)
+    # the page's directory, and its parents left empty
+    for page_dir in out_path.parents:
+        if page_dir == rctx.config.output_path or not page_dir.exists():
+            break
+        try:
+            page_dir.rmdir()
+        except OSError:
+            # not empty, e.g. holds the output of pages in the matching subdirectory
+            break
+
+
+def delete_page(rctx: RenderCtx, entry: PageEntry) -> None:
+    """Remove the output, metadata and recorded dependencies of deleted page `entry`."""
+    info(f"'{colors.B_MAGENTA}{entry.path.relative_to(rctx.config.project_root)}{colors.B_WHITE}' deleted")
+    _unlink_output(rctx, entry)
+    rctx.config.page_md.pop(entry.name, None)
+    if deps.tracker is not None:
+        deps.tracker.reset(entry.name)
+
+
+def _write_transformed(rctx: RenderCtx, entry: PageEntry, result: Future) -> None:
+    config = rctx.config
+    try:
+        content = result.result()
+    except Exception:
+        pp_exc()
+        pp_err_details("output transform failed, page not written", {
+            "page": entry.path.relative_to(config.project_root),
+        })
+        # the previous output remains, it must not be garbage collected
+        rctx.outputs.kept(entry.out_path)
+        return
+    write_output_file(config, entry.path, content, rctx.outputs, entry.out_path)
+    if rctx.links is not None:
+        # after the transforms, which may rewrite links
+        rctx.links.add(entry.out_path, content)
+
+
+def render(rctx: RenderCtx, page_path: Path, metadata: Optional[Dict] = None) -> None:
+    """Render page and write its output, see `_render`."""
+    started = time.perf_counter()
+    try:
+        _render(rctx, page_path, metadata)
+    finally:
+        # output transforms excepted, these may complete later
+        metrics.page(rctx.pages.entry(page_path).name, time.perf_counter() - started)
 
 
-def render(config: Config, env: Environment, page_path: Path,
-           page_pre_compile_hook: PagePreCompileHookFn,
-           page_post_compile_hook: PagePostCompileHookFn) -> None:
-    # clear page metadata before compilation
-    config.page_md[page_path.relative_to(config.pages_path)] = {}
+def _render(rctx: RenderCtx, page_path: Path, metadata: Optional[Dict] = None) -> None:
+    """Render page and write its output.
+
+    If `rctx.stream` is set, the page is rendered straight to (a temporary file
+    replacing) its output file, never holding the whole page in memory. The
+    stream post-compile hook, if any, is then applied in place of the regular
+    post-compile hook, receiving the page in chunks.
+
+    Args:
+        rctx: render context
+        page_path: path to the page file (.md)
+        metadata: the page's metadata, if already evaluated in the metadata phase.
+    """
+    config = rctx.config
+    entry = rctx.pages.entry(page_path)
+    page_name = entry.name
+    # clear page metadata and asset references before compilation
+    config.page_md[page_name] = {}
+    if deps.tracker is not None:
+        deps.tracker.reset(page_name)
 
     # call per-page pre-compile hook, can create extra vars to inject into the template-rendering
     # context for this page, cause compilation to be skipped and set page metadata (if desired)
     extra_vars = {}
-    if not page_pre_compile_hook(page_path, config, extra_vars):
+    if not rctx.page_pre_compile_hook(page_path, config, extra_vars):
         # filtered out, abort
-        unlink_output_file(config, page_path)
-        config.page_md[page_path.relative_to(config.pages_path)] = {}
+        _unlink_output(rctx, entry)
+        config.page_md[page_name] = {}
+        return
+
+    if config.build.metadata_phase:
+        if metadata is None:
+            metadata = page_metadata(page_path, config, rctx.env, extra_vars)
+        config.page_md[page_name] = {**config.page_md[page_name], **metadata}
+
+    if rctx.stream:
+        _render_streamed(rctx, entry, extra_vars)
         return
 
-    content = compile_page(page_path, config, env, page_vars=extra_vars)
+    content = compile_page(page_path, config, rctx.env, page_vars=extra_vars)
 
-    content = page_post_compile_hook(page_path, config, content)
+    content = rctx.page_post_compile_hook(page_path, config, content)
     if content in (False, None):
         # filtered out, abort
         # clear out any MD that might have been set as part of the compilation
-        unlink_output_file(config, page_path)
-        config.page_md[page_path.relative_to(config.pages_path)] = {}
+        _unlink_output(rctx, entry)
+        config.page_md[page_name] = {}
+        return
+
+    if rctx.search is not None:
+        rctx.search.update(page_name, content)
+    # transforms may complete asynchronously, see `TransformPipeline.wait`
+    rctx.transforms.apply(
+        page_name, content,
+        lambda result: _write_transformed(rctx, entry, result))
+
+
+def _render_streamed(rctx: RenderCtx, entry: PageEntry, extra_vars: Dict) -> None:
+    if not _stream_page(rctx, entry, extra_vars):
         return
+    # the page is not held in memory, read it back from its output file
+    if rctx.search is not None:
+        rctx.search.update_file(entry.name, entry.out_path)
+    if rctx.links is not None:
+        rctx.links.add_file(entry.out_path)
+
+
+def _stream_page(rctx: RenderCtx, entry: PageEntry, extra_vars: Dict) -> bool:
+    """Returns False if the stream post-compile hook filtered out the page."""
+    # Peak memory is bounded by Mako's buffering (and that of the hook, if any)
+    # rather than by the size of the page.
+    config = rctx.config
+    page_path, out_path = entry.path, entry.out_path
+    hook = rctx.page_post_compile_stream_hook
+    if hook is None:
+        with rctx.outputs.writing(out_path) as fh:
+            compile_page_to(page_path, config, rctx.env, fh, page_vars=extra_vars)
+        _info_output(config, page_path, out_path)
+        return True
+
+    # the hook consumes the rendered page in chunks, render to a scratch file first.
+    with tempfile.TemporaryFile("w+", encoding="utf-8", newline="") as raw:
+        compile_page_to(page_path, config, rctx.env, raw, page_vars=extra_vars)
+        raw.seek(0)
+        chunk_size = config.build.stream_chunk_size
+        chunks = hook(page_path, config, iter(lambda: raw.read(chunk_size), ""))
+        if chunks in (False, None):
+            # filtered out, abort
+            _unlink_output(rctx, entry)
+            config.page_md[entry.name] = {}
+            return False
+        with rctx.outputs.writing(out_path) as fh:
+            for chunk in chunks:
+                fh.write(chunk)
+    _info_output(config, page_path, out_path)
+    return True
+
 
-    write_output_file(config, page_path, content)
+def collect_metadata(rctx: RenderCtx, pages: List[Path]) -> Dict[Path, Dict]:
+    """Metadata phase, evaluate the metadata section of all pages.
 
+    Populates `config.page_md` before any page is rendered, such that pages can
+    refer to each other's metadata. The page pre-compile hook is called for each
+    page, pages it filters out get no metadata.
 
-def render_all(config: Config, env: Environment,
-               page_pre_compile_hook: PagePreCompileHookFn,
-               page_post_compile_hook: PagePostCompileHookFn) -> None:
-    for dirpath, _dir_names, file_names in walk(config.pages_path):
-        for file_name in file_names:
-            if file_name.endswith(".md"):
-                page_path = Path(dirpath) / file_name
-                render(config, env, page_path, page_pre_compile_hook, page_post_compile_hook)
+    Returns:
+        metadata of each page, by page path. Pages whose metadata could not be
+        evaluated are left out, rendering them will evaluate it again.
+    """
+    config = rctx.config
+    page_vars = {}
+    for page_path in pages:
+        config.page_md[rctx.pages.entry(page_path).name] = {}
+        extra_vars = {}
+        if rctx.page_pre_compile_hook(page_path, config, extra_vars):
+            page_vars[page_path] = extra_vars
+
+    if len(page_vars) < PARALLEL_METADATA_MIN_PAGES or worker_count(config) == 1:
+        results = {page_path: page_metadata(page_path, config, rctx.env, extra_vars)
+                   for page_path, extra_vars in page_vars.items()}
+    else:
+        pool = rctx.pool.get()
+        jobs = {page_path: pool.submit(_page_metadata_job, page_path, extra_vars)
+                for page_path, extra_vars in page_vars.items()}
+        results = {}
+        for page_path, job in jobs.items():
+            try:
+                results[page_path] = job.result()
+            except Exception:
+                pp_exc()
+                pp_err_details("failed to evaluate page metadata in worker", {
+                    "page": page_path.relative_to(config.project_root),
+                })
+
+    for page_path, page_md in results.items():
+        page_name = rctx.pages.entry(page_path).name
+        config.page_md[page_name] = {**config.page_md[page_name], **page_md}
+    return results
+
+
+def render_all(rctx: RenderCtx, should_abort: Optional[Callable[[], bool]] = None,
+               priority: Sequence[Path] = (), on_priority_done: Optional[Callable[[], None]] = None) -> bool:
+    """Render all pages.
+
+    Args:
+        rctx: render context
+        should_abort: checked between pages, if it returns True, the remaining
+                      pages are skipped. Pages are written atomically, so each
+                      output file is either the old or the new version.
+        priority: pages to render before all others, in order.
+        on_priority_done: called once the priority pages are written (including
+                          their transforms), before rendering the remaining pages.
+
+    Returns:
+        True if all pages were rendered, False if aborted.
+    """
+    config = rctx.config
+    started = time.time()
+    # the index rather than the pages directory, see `gadfly.pages`
+    pages = rctx.pages.paths()
+    known = set(pages)
+    first = [page for page in dict.fromkeys(priority) if page in known]
+    if first:
+        rest = set(first)
+        pages = first + [page for page in pages if page not in rest]
+    metadata = {}
+    if config.build.metadata_phase:
+        with metrics.stage("metadata"):
+            metadata = collect_metadata(rctx, pages)
+    with metrics.stage("render"):
+        for ndx, page_path in enumerate(pages):
+            if should_abort is not None and should_abort():
+                rctx.transforms.wait()
+                return False
+            # dropped once used, only the (compact) `config.page_md` is kept
+            render(rctx, page_path, metadata.pop(page_path, None))
+            if ndx == len(first) - 1 and on_priority_done is not None:
+                rctx.transforms.wait()
+                on_priority_done()
+    # transforms run along the rendering, this is the time spent waiting for the last ones
+    with metrics.stage("transforms"):
+        rctx.transforms.wait()
+    # every page went through the transforms, results not used since are stale
+    rctx.transforms.prune(started)
+    return True
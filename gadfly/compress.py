@@ -0,0 +1,191 @@
+"""Precompressed variants of output files.
+
+For each output file `foo.html`, writes `foo.html.gz`, `foo.html.br` and/or
+`foo.html.zst` next to it as configured in the `[compress]` section.
+
+Compression happens in a thread pool (zlib, brotli and zstandard all release
+the GIL while compressing). A small database of (mtime, size, sha256) per
+output file is kept in the `.gadfly/` directory so that files whose content
+did not change are never recompressed - neither during the same run, nor
+across runs.
+"""
+from concurrent.futures import ThreadPoolExecutor, Future
+from pathlib import Path
+from hashlib import sha256
+from typing import Callable, Dict, List, Optional, Union, TYPE_CHECKING
+import threading
+import json
+from gadfly.atomic import write_atomic
+from gadfly.config import Config
+from gadfly import cli
+from gadfly import metrics
+
+if TYPE_CHECKING:
+    from gadfly.manifest import OutputTracker
+
+# compression format => suffix of the compressed variant
+SUFFIXES = {
+    "gzip": ".gz",
+    "br": ".br",
+    "zstd": ".zst",
+}
+
+
+def variant_paths(path: Path) -> List[Path]:
+    """Paths of all possible compressed variants of `path`."""
+    return [path.with_name(path.name + suffix) for suffix in SUFFIXES.values()]
+
+
+def remove_variants(path: Path) -> None:
+    for variant in variant_paths(path):
+        variant.unlink(missing_ok=True)
+
+
+def is_variant(path: Union[str, Path]) -> bool:
+    return str(path).endswith(tuple(SUFFIXES.values()))
+
+
+def _compress_fn(fmt: str) -> Callable[[bytes], bytes]:
+    # optional dependencies are imported on use, config validation ensures
+    # they are installed if the format is enabled.
+    if fmt == "gzip":
+        import gzip
+        # fixed mtime, otherwise identical input yields different output
+        return lambda data: gzip.compress(data, compresslevel=9, mtime=0)
+    elif fmt == "br":
+        import brotli
+        return lambda data: brotli.compress(data, quality=11)
+    elif fmt == "zstd":
+        import zstandard
+        # compressor objects must not be shared between threads
+        return lambda data: zstandard.ZstdCompressor(level=19).compress(data)
+    raise ValueError(f"unknown compression format '{fmt}'")
+
+
+class OutputCompressor:
+    def __init__(self, cfg: Config, name: str, tracker: Optional["OutputTracker"] = None):
+        """Compress output files as they are written.
+
+        Args:
+            cfg: gadfly config
+            name: name of the database file, each process writing outputs must use its own.
+            tracker: if given, variants written, kept and removed are recorded in it.
+        """
+        self._cfg = cfg
+        self._tracker = tracker
+        self._formats = list(cfg.compress.formats)
+        self._extensions = set(cfg.compress.extensions)
+        self._fns: Dict[str, Callable[[bytes], bytes]] = {}
+        self._db_path = cfg.cache_path / f"compress-{name}.json"
+        self._db: Dict[str, list] = self._db_load()
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=cfg.compress.workers, thread_name_prefix="gadfly-compress")
+        self._pending: List[Future] = []
+
+    def _db_load(self) -> Dict[str, list]:
+        try:
+            with open(self._db_path) as fh:
+                db = json.load(fh)
+        except (FileNotFoundError, ValueError):
+            return {}
+        # formats changed, everything must be (re-)compressed
+        if db.get("formats") != self._formats:
+            return {}
+        return db.get("files", {})
+
+    def _db_save(self) -> None:
+        self._db_path.parent.mkdir(parents=True, exist_ok=True)
+        with self._lock:
+            data = json.dumps({"formats": self._formats, "files": self._db})
+        write_atomic(self._db_path, data.encode())
+
+    def wants(self, path: Path) -> bool:
+        return path.suffix in self._extensions and not is_variant(path)
+
+    def submit(self, path: Path, content: Optional[bytes] = None) -> None:
+        """Queue `path` for compression.
+
+        Args:
+            path: output file to compress
+            content: the file's content, if known, saves re-reading the file.
+        """
+        if not self.wants(path):
+            return
+        fut = self._pool.submit(self._compress, path, content)
+        with self._lock:
+            self._pending.append(fut)
+
+    def remove(self, path: Path) -> None:
+        with self._lock:
+            self._db.pop(str(path), None)
+        remove_variants(path)
+
+    def _compress(self, path: Path, content: Optional[bytes]) -> None:
+        key = str(path)
+        try:
+            st = path.stat()
+        except FileNotFoundError:
+            return
+        with self._lock:
+            entry = self._db.get(key)
+        # files below the size threshold have no variants by design
+        variants_exist = st.st_size < self._cfg.compress.min_size or all(
+            path.with_name(path.name + SUFFIXES[fmt]).exists() for fmt in self._formats
+        )
+        if content is None:
+            if entry and entry[0] == st.st_mtime_ns and entry[1] == st.st_size and variants_exist:
+                metrics.cache("compress", True)
+                self._track_kept(path, st.st_size)
+                return
+            with open(path, "rb") as fh:
+                content = fh.read()
+        digest = sha256(content).hexdigest()
+        if entry and entry[2] == digest and variants_exist:
+            # rewritten with identical content
+            metrics.cache("compress", True)
+            with self._lock:
+                self._db[key] = [st.st_mtime_ns, st.st_size, digest]
+            self._track_kept(path, st.st_size)
+            return
+
+        metrics.cache("compress", False)
+        if len(content) < self._cfg.compress.min_size:
+            remove_variants(path)
+            if self._tracker is not None:
+                for variant in variant_paths(path):
+                    self._tracker.removed(variant)
+        else:
+            for fmt in self._formats:
+                fn = self._fns.get(fmt)
+                if fn is None:
+                    fn = self._fns.setdefault(fmt, _compress_fn(fmt))
+                variant = path.with_name(path.name + SUFFIXES[fmt])
+                data = fn(content)
+                write_atomic(variant, data)
+                if self._tracker is not None:
+                    self._tracker.written(variant, data)
+        with self._lock:
+            self._db[key] = [st.st_mtime_ns, st.st_size, digest]
+
+    def _track_kept(self, path: Path, size: int) -> None:
+        # variants still exist from an earlier build, they are outputs of this one too.
+        if self._tracker is None or size < self._cfg.compress.min_size:
+            return
+        for fmt in self._formats:
+            self._tracker.written(path.with_name(path.name + SUFFIXES[fmt]))
+
+    def wait(self) -> None:
+        """Block until all queued files are compressed, then persist the database."""
+        with self._lock:
+            pending, self._pending = self._pending, []
+        for fut in pending:
+            try:
+                fut.result()
+            except Exception:
+                cli.pp_exc()
+                cli.pp_err_details("failed to compress output file", {})
+        self._db_save()
+
+    def close(self) -> None:
+        self.wait()
+        self._pool.shutdown()
@@ -2,7 +2,9 @@ from pathlib import Path
 from typing import Union
 from gadfly.assets.errors import *
 from importlib.util import find_spec
-from typing import Optional
+from typing import Dict, Optional, List, Type, TypeVar
+from dataclasses import dataclass, field
+import dacite
 
 
 DEFAULT_CONFIG = """\
@@ -17,6 +19,42 @@ code = "blogcode"
 # where the generated website content goes
 output = "output"
 
+# Cache the evaluated context hook on disk, only re-evaluating it when the
+# code module, gadfly.toml or one of the listed data files change.
+# [code]
+# context_cache = true
+# context_files = ["data/**/*.toml"]
+
+# Write precompressed variants (index.html.gz, ...) next to each output file.
+# Supported formats: "gzip", "br" (needs 'brotli'), "zstd" (needs 'zstandard').
+# [compress]
+# formats = ["gzip"]
+
+# Transforms applied, in order, to each page's output. Pure transforms only
+# depend on their input, they are run in parallel and their results are cached.
+# [[transforms]]
+# name = "minify"
+# fn = "blogcode.transforms:minify"
+# pure = true
+# options = { remove_comments = true }
+
+# Full-text search index of the rendered pages, written to <output>/search/.
+# [search]
+# enabled = true
+# shards = 16
+
+# Report broken internal links and anchors of the rendered pages.
+# [links]
+# check = true
+# ignore = ["/api/*"]
+
+# Extra glob patterns the file watchers should ignore. The output directory,
+# VCS directories, node_modules, __pycache__ and editor swap files are always
+# ignored. Per-asset patterns go in an 'ignore' list in the asset's section.
+# [watch]
+# ignore = ["*.tmp"]
+# pages_ignore = ["drafts/"]
+
 # Example asset handler
 # [assets.css]
 # handler = "on_css"
@@ -33,7 +71,10 @@ class ConfigCodeSection:
                  context_hook: str = "context",
                  post_compile_hook: str = "post_compile",
                  page_pre_compile_hook: str = "page_pre_compile_hook",
-                 page_post_compile_hook: str = "page_post_compile_hook"):
+                 page_post_compile_hook: str = "page_post_compile_hook",
+                 page_post_compile_stream_hook: str = "page_post_compile_stream_hook",
+                 context_cache: bool = False,
+                 context_files: Optional[List[str]] = None):
         self.__module = module
         mod = find_spec(module)
         if mod is None:
@@ -43,6 +84,9 @@ class ConfigCodeSection:
         self.__post_compile_hook = post_compile_hook
         self.__page_pre_compile_hook = page_pre_compile_hook
         self.__page_post_compile_hook = page_post_compile_hook
+        self.__page_post_compile_stream_hook = page_post_compile_stream_hook
+        self.__context_cache = context_cache
+        self.__context_files = list(context_files or [])
 
     @property
     def module(self) -> str:
@@ -68,9 +112,22 @@ class ConfigCodeSection:
     def page_post_compile_hook(self) -> str:
         return self.__page_post_compile_hook
 
+    @property
+    def page_post_compile_stream_hook(self) -> str:
+        return self.__page_post_compile_stream_hook
+
+    @property
+    def context_cache(self) -> bool:
+        return self.__context_cache
+
+    @property
+    def context_files(self) -> List[str]:
+        return self.__context_files
+
     def __repr__(self):
         attrs = ", ".join(f"""{attr}: {getattr(self, attr)}""" for attr in [
-            "module", "context_hook", "post_compile_hook", "page_pre_compile_hook", "page_post_compile_hook"
+            "module", "context_hook", "post_compile_hook", "page_pre_compile_hook", "page_post_compile_hook",
+            "page_post_compile_stream_hook", "context_cache", "context_files"
         ])
         return f"<{type(self).__name__} {attrs}>"
 
@@ -78,6 +135,170 @@ class ConfigCodeSection:
         return self.__repr__()
 
 
+# compression formats and the (optional) module each requires
+COMPRESS_FORMATS = {"gzip": "gzip", "br": "brotli", "zstd": "zstandard"}
+
+
+@dataclass(frozen=True)
+class ConfigCompressSection:
+    # formats to write variants for, empty disables compression
+    formats: List[str] = field(default_factory=list)
+    # files smaller than this (in bytes) are not worth compressing
+    min_size: int = 256
+    # only files with these extensions are compressed
+    extensions: List[str] = field(default_factory=lambda: [
+        ".html", ".css", ".js", ".mjs", ".json", ".xml", ".svg", ".txt", ".map"
+    ])
+    # number of compression threads
+    workers: int = 4
+
+    def __post_init__(self):
+        for fmt in self.formats:
+            if fmt not in COMPRESS_FORMATS:
+                raise ValueError(f"invalid compress format '{fmt}', expected one of {', '.join(COMPRESS_FORMATS)}")
+            if find_spec(COMPRESS_FORMATS[fmt]) is None:
+                raise ValueError(f"compress format '{fmt}' requires the '{COMPRESS_FORMATS[fmt]}' package")
+
+
+@dataclass(frozen=True)
+class ConfigBuildSection:
+    # number of worker processes for parallel stages, defaults to the number of CPUs
+    workers: Optional[int] = None
+    # evaluate every page's metadata section (its 'gf_metadata' def) before rendering
+    # any page, making all pages' metadata available while rendering.
+    metadata_phase: bool = False
+    # render pages straight to their output files instead of into memory,
+    # see `compiler.render`.
+    stream_pages: bool = False
+    # size (in characters) of the chunks passed to the stream post-compile hook
+    stream_chunk_size: int = 64 * 1024
+    # keep memory bounded on very large sites: compact page metadata storage
+    # and at most `template_cache_size` templates cached by the template lookup.
+    low_memory: bool = False
+    template_cache_size: int = 100
+    # remove outputs of pages produced by an earlier compile but not by this one,
+    # except those matching one of the `gc_keep` glob patterns (relative to the output dir).
+    gc_outputs: bool = True
+    gc_keep: List[str] = field(default_factory=list)
+
+    def __post_init__(self):
+        if self.workers is not None and self.workers < 1:
+            raise ValueError("workers must be 1 or greater")
+        if self.stream_chunk_size < 1:
+            raise ValueError("stream_chunk_size must be 1 or greater")
+        if self.template_cache_size < 1:
+            raise ValueError("template_cache_size must be 1 or greater")
+
+
+@dataclass(frozen=True)
+class ConfigTransform:
+    # name, used in error messages and as part of the cache key
+    name: str
+    # function to call, of the form "module.submodule:fn"
+    fn: str
+    # pure transforms depend only on their input, they run in worker processes
+    # and their results are cached.
+    pure: bool = False
+    # passed to the transform function
+    options: dict = field(default_factory=dict)
+
+    def __post_init__(self):
+        if len(self.fn.split(":")) != 2:
+            raise ValueError(f"transform '{self.name}': fn must be of the form 'module:function', got '{self.fn}'")
+
+
+@dataclass(frozen=True)
+class ConfigWatchSection:
+    # glob patterns ignored by all watchers, in addition to the defaults
+    ignore: List[str] = field(default_factory=list)
+    # glob patterns ignored only by the respective watchers
+    pages_ignore: List[str] = field(default_factory=list)
+    templates_ignore: List[str] = field(default_factory=list)
+    code_ignore: List[str] = field(default_factory=list)
+    # events arriving within this many milliseconds of each other are passed on together
+    debounce_ms: int = 50
+    # "native": the OS' file events, "poll": stat the watched trees every `poll_interval_ms`,
+    # for file systems not delivering events (network file systems, some container mounts)
+    backend: str = "native"
+    poll_interval_ms: int = 1000
+
+    def __post_init__(self):
+        if self.debounce_ms < 0:
+            raise ValueError("debounce_ms must be 0 or greater")
+        if self.backend not in ("native", "poll"):
+            raise ValueError(f"backend must be 'native' or 'poll', got '{self.backend}'")
+        if self.poll_interval_ms < 1:
+            raise ValueError("poll_interval_ms must be 1 or greater")
+
+
+@dataclass(frozen=True)
+class ConfigSearchSection:
+    # build a full-text search index of the pages, see `gadfly.search`
+    enabled: bool = False
+    # directory of the index files, relative to the output directory
+    output: str = "search"
+    # number of files the terms are split over, browsers load those of the searched terms
+    shards: int = 1
+    # terms sharing their first `shard_prefix` characters are in the same shard
+    shard_prefix: int = 2
+    # shorter terms are not indexed
+    min_term_length: int = 2
+    stop_words: List[str] = field(default_factory=list)
+    # glob patterns of pages (relative to the pages directory) not to index
+    exclude: List[str] = field(default_factory=list)
+
+    def __post_init__(self):
+        out = Path(self.output)
+        if out.is_absolute() or ".." in out.parts or not out.parts:
+            raise ValueError(f"output must be a directory within the output directory, got '{self.output}'")
+        if self.shards < 1:
+            raise ValueError("shards must be 1 or greater")
+        if self.shard_prefix < 1:
+            raise ValueError("shard_prefix must be 1 or greater")
+        if self.min_term_length < 1:
+            raise ValueError("min_term_length must be 1 or greater")
+
+
+@dataclass(frozen=True)
+class ConfigLinksSection:
+    # check internal links and anchors of the rendered pages, see `gadfly.links`
+    check: bool = False
+    # glob patterns of links (as written in the page) not to check
+    ignore: List[str] = field(default_factory=list)
+
+
+@dataclass(frozen=True)
+class ConfigBudgetsSection:
+    # `gadfly compile` fails if the build exceeds any of these, unset ones are not checked
+    max_build_ms: Optional[int] = None
+    # render time of any single page
+    max_page_ms: Optional[int] = None
+    # by stage, see `gadfly.metrics`, e.g. {render = 60000}
+    max_stage_ms: Dict[str, int] = field(default_factory=dict)
+    min_pages_per_s: Optional[int] = None
+    # of the largest process, workers included
+    max_peak_rss_mb: Optional[int] = None
+    # of all output files
+    max_output_mb: Optional[int] = None
+
+
+@dataclass(frozen=True)
+class ConfigMetricsSection:
+    # record the metrics of each `gadfly compile`, see `gadfly.metrics`
+    record: bool = True
+    # number of recorded builds to keep
+    keep: int = 50
+    # number of slowest pages recorded per build
+    slowest: int = 10
+    budgets: ConfigBudgetsSection = field(default_factory=ConfigBudgetsSection)
+
+    def __post_init__(self):
+        if self.keep < 1:
+            raise ValueError("keep must be 1 or greater")
+        if self.slowest < 0:
+            raise ValueError("slowest must be 0 or greater")
+
+
 class Config:
     def __init__(self,
                  project_root: Path,
@@ -87,6 +308,13 @@ class Config:
                  templates: str = "templates",
                  code: Optional[ConfigCodeSection] = None,
                  assets: dict = None,
+                 compress: Optional[ConfigCompressSection] = None,
+                 build: Optional[ConfigBuildSection] = None,
+                 transforms: Optional[List[ConfigTransform]] = None,
+                 watch: Optional[ConfigWatchSection] = None,
+                 search: Optional[ConfigSearchSection] = None,
+                 links: Optional[ConfigLinksSection] = None,
+                 metrics: Optional[ConfigMetricsSection] = None,
                  dev_mode: bool = True):
         self.__project_root = project_root.absolute()
         self.silent = silent
@@ -95,7 +323,20 @@ class Config:
         self.templates_path = templates
         self.code = code if code is not None else ConfigCodeSection()
         self.assets = assets
+        self.compress = compress if compress is not None else ConfigCompressSection()
+        self.build = build if build is not None else ConfigBuildSection()
+        self.transforms = transforms if transforms is not None else []
+        self.watch = watch if watch is not None else ConfigWatchSection()
+        self.search = search if search is not None else ConfigSearchSection()
+        self.links = links if links is not None else ConfigLinksSection()
+        self.metrics = metrics if metrics is not None else ConfigMetricsSection()
         self.dev_mode = dev_mode
+        # set from the CLI to ignore (and overwrite) any context snapshot on disk
+        self.bypass_context_cache = False
+        # record outputs for the build manifest, set for one-off compiles
+        self.track_outputs = False
+        # record build metrics, set for one-off compiles
+        self.record_metrics = False
 
         self.context = {}
         self.page_md = {}
@@ -104,6 +345,11 @@ class Config:
     def project_root(self) -> Path:
         return self.__project_root
 
+    @property
+    def cache_path(self) -> Path:
+        """Directory for gadfly's own state which persists between runs."""
+        return self.project_root / ".gadfly"
+
     def __path_coerce(self, label: str, val: Union[str, Path], create: bool = False) -> Path:
         if isinstance(val, str):
             val = Path(val)
@@ -154,8 +400,31 @@ class Config:
         return self.__repr__()
 
 
+T = TypeVar("T")
+
+
+def _read_section(section_cls: Type[T], section: str, conf_dict: dict) -> T:
+    try:
+        return dacite.from_dict(section_cls, conf_dict.get(section, {}), config=dacite.Config(strict=True))
+    except dacite.DaciteError as e:
+        raise ValueError(f"invalid [{section}] section: {e}")
+
+
+def _plain(val):
+    """Convert (nested) dict and list subclasses to plain dicts and lists.
+
+    The TOML parser represents inline tables by a local class which cannot be
+    pickled - and the config is pickled when passed to compile processes."""
+    if isinstance(val, dict):
+        return {k: _plain(v) for k, v in val.items()}
+    elif isinstance(val, list):
+        return [_plain(v) for v in val]
+    return val
+
+
 def read_config(project_path: Path, conf_dict: dict) -> Config:
     project_root: Path = project_path.absolute()
+    conf_dict = _plain(conf_dict)
     # TODO: check project_root, must exist and be a directory
     conf_assets = conf_dict.get("assets", {})
     for asset_name, opts in conf_assets.items():
@@ -169,13 +438,31 @@ def read_config(project_path: Path, conf_dict: dict) -> Config:
             raise AssetPathNotADirError(asset_name, asset_path)
         elif "handler" not in opts:
             raise AssetHandlerMissingError(asset_name, asset_path)
+        elif not isinstance(opts.get("ignore", []), list):
+            raise AssetValidationError(asset_name, asset_path, "'ignore' must be a list of glob patterns")
 
     code_section = ConfigCodeSection(**conf_dict.get("code", {}))
+    transforms = []
+    for entry in conf_dict.get("transforms", []):
+        try:
+            transforms.append(dacite.from_dict(ConfigTransform, entry, config=dacite.Config(strict=True)))
+        except dacite.DaciteError as e:
+            raise ValueError(f"invalid [[transforms]] entry: {e}")
+    names = [transform.name for transform in transforms]
+    if len(names) != len(set(names)):
+        raise ValueError("[[transforms]] entries must have unique names")
     return Config(
         project_root=project_root,
         **{k: v for k, v in conf_dict.get("project", {}).items()
            if k in {"pages", "templates", "output"}},
-        **{"assets": conf_assets, "code": code_section}
+        **{"assets": conf_assets, "code": code_section,
+           "compress": _read_section(ConfigCompressSection, "compress", conf_dict),
+           "build": _read_section(ConfigBuildSection, "build", conf_dict),
+           "transforms": transforms,
+           "watch": _read_section(ConfigWatchSection, "watch", conf_dict),
+           "search": _read_section(ConfigSearchSection, "search", conf_dict),
+           "links": _read_section(ConfigLinksSection, "links", conf_dict),
+           "metrics": _read_section(ConfigMetricsSection, "metrics", conf_dict)}
     )
 
 
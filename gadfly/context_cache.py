@@ -0,0 +1,104 @@
+"""On-disk snapshot of the evaluated context hook.
+
+The snapshot is keyed by a hash over everything the context hook can
+reasonably depend on:
+
+* the python version and snapshot format
+* the project's `gadfly.toml`
+* every file of the code module (the whole package directory for packages)
+* the data files listed in `[code] context_files` (globs, relative to the project root)
+
+If any of these change, the key changes and the hook is evaluated anew. Anything
+else the hook reads (network, environment variables, files not listed) is not
+tracked - use `--no-context-cache` or delete the `.gadfly/` directory to force
+re-evaluation.
+"""
+from pathlib import Path
+from hashlib import sha256
+from typing import Optional, List
+import pickle
+import sys
+from gadfly.atomic import write_atomic
+from gadfly.config import Config
+from gadfly.utils import file_sha256
+from gadfly import cli
+
+# bump whenever the snapshot layout changes
+SNAPSHOT_VERSION = 1
+
+
+def snapshot_path(cfg: Config) -> Path:
+    return cfg.cache_path / "context.pickle"
+
+
+def _code_files(cfg: Config) -> List[Path]:
+    mod_path = Path(cfg.code.module_path)
+    if mod_path.name != "__init__.py":
+        return [mod_path]
+    return sorted(
+        fpath for fpath in mod_path.parent.rglob("*")
+        if fpath.is_file() and "__pycache__" not in fpath.parts
+    )
+
+
+def _data_files(cfg: Config) -> List[Path]:
+    files = set()
+    for pattern in cfg.code.context_files:
+        files.update(fpath for fpath in cfg.project_root.glob(pattern) if fpath.is_file())
+    return sorted(files)
+
+
+def snapshot_key(cfg: Config) -> str:
+    """Compute the key identifying the current inputs of the context hook."""
+    h = sha256()
+    h.update(f"{SNAPSHOT_VERSION}:{sys.version_info[:2]}".encode())
+    conf_path = cfg.project_root / "gadfly.toml"
+    files = ([conf_path] if conf_path.exists() else []) + _code_files(cfg) + _data_files(cfg)
+    for fpath in files:
+        h.update(str(fpath).encode())
+        h.update(file_sha256(fpath).encode())
+    return h.hexdigest()
+
+
+def load(cfg: Config, key: str) -> Optional[dict]:
+    """Return the snapshotted context iff. it was stored under `key`."""
+    try:
+        with open(snapshot_path(cfg), "rb") as fh:
+            snapshot = pickle.load(fh)
+    except FileNotFoundError:
+        return None
+    except Exception:
+        # corrupt or written by an incompatible version, treat as a miss.
+        return None
+    if not isinstance(snapshot, dict) or snapshot.get("key") != key:
+        return None
+    return snapshot["context"]
+
+
+def store(cfg: Config, key: str, context: dict) -> None:
+    """Write context snapshot, failing to pickle or write the context only disables the cache."""
+    fpath = snapshot_path(cfg)
+    try:
+        data = pickle.dumps({"key": key, "context": context}, protocol=pickle.HIGHEST_PROTOCOL)
+    except Exception:
+        cli.pp_exc()
+        cli.pp_err_details(
+            "context could not be pickled, not caching it", {
+                "module": cfg.code.module,
+                "hook": cfg.code.context_hook,
+            })
+        return
+    try:
+        # a concurrently (re-)starting process never sees a partial snapshot
+        write_atomic(fpath, data)
+    except OSError as e:
+        # e.g. disk full or a read-only `.gadfly/`
+        cli.pp_err_details("context snapshot could not be written, not caching it", {
+            "path": fpath,
+            "error": e,
+        })
+
+
+def clear(cfg: Config) -> None:
+    """Drop the snapshot, the next evaluation of the context runs the hook."""
+    snapshot_path(cfg).unlink(missing_ok=True)
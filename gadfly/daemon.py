@@ -0,0 +1,268 @@
+"""Build daemon, keeping the page and asset compilers running between builds:
+the context stays evaluated, templates compiled and caches warm.
+
+`gadfly daemon` starts it. Requests arrive on a Unix socket in the project's
+state directory (`.gadfly/daemon.sock`), one JSON object per connection and
+line, each answered by one:
+
+* `{"cmd": "build"}`: process all changes since the last build, answered once
+  the outputs are written and the manifest is updated (see `gadfly.manifest`).
+* `{"cmd": "status"}`: uptime, builds done and whether the compilers run.
+* `{"cmd": "invalidate", "what": "context" | "templates" | "assets"}`:
+  re-evaluate the context (ignoring its snapshot), re-render all pages or re-run
+  all asset handlers, completed as part of the next build.
+
+Changes are found by polling the project's files once per build (see
+`gadfly.poll`), nothing runs between builds. A build ends with a FLUSH event,
+which the asset compiler answers and forwards to the page compiler, after any
+events it sent there. Once both compilers answered, all changes are processed.
+"""
+from pathlib import Path
+from typing import Dict, Optional, Set, Tuple
+import asyncio
+import itertools
+import json
+import multiprocessing as mp
+import os
+import socket
+import threading
+import time
+from gadfly import cli
+from gadfly import config
+from gadfly import context_cache
+from gadfly import manifest
+from gadfly.mp import (
+    ConsumerProcess, EventType, OUTPUT_TRACKERS, _compile_process, _asset_compile_process
+)
+
+SOCKET_NAME = "daemon.sock"
+INVALIDATE = ("context", "templates", "assets")
+# answers completing a build: the asset compiler's, the page compiler's for
+# the daemon's FLUSH and for the one forwarded by the asset compiler.
+_FLUSHED_ALL = {"assets", "pages/daemon", "pages/assets"}
+
+
+class DaemonNotRunningError(Exception):
+    def __init__(self, path: Path):
+        self.path = path
+        super().__init__(f"no daemon listening on '{path}'")
+
+
+def socket_path(cfg: config.Config) -> Path:
+    return cfg.cache_path / SOCKET_NAME
+
+
+def request(cfg: config.Config, msg: dict) -> dict:
+    """Send `msg` to the daemon of the project, returns its answer."""
+    path = socket_path(cfg)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(str(path))
+        except (FileNotFoundError, ConnectionRefusedError) as e:
+            raise DaemonNotRunningError(path) from e
+        sock.sendall(json.dumps(msg).encode() + b"\n")
+        with sock.makefile("rb") as fh:
+            line = fh.readline()
+    if not line:
+        return {"ok": False, "error": "daemon closed the connection without answering"}
+    return json.loads(line)
+
+
+class _Daemon:
+    def __init__(self, cfg: config.Config, loop: asyncio.AbstractEventLoop):
+        # imported here, clients do not need these
+        from gadfly.poll import PollingObserver
+        from gadfly.supervisor import Supervisor
+        from gadfly.watch import schedule_watches
+
+        self._cfg = cfg
+        self._loop = loop
+        ctx = mp.get_context("spawn")
+        self.page_queue = ctx.Queue()
+        self.asset_queue = ctx.Queue()
+        # answers of the compilers (page compiler: also reload requests, ignored)
+        self.reply_queue = ctx.Queue()
+        self.stop_queue = ctx.Queue()
+        # snapshot of the project's files, taken before the compilers start:
+        # changes made while they render are picked up by the next build.
+        self._observer = PollingObserver(interval=0)
+        schedule_watches(cfg, self._observer, self.page_queue, self.asset_queue)
+
+        self.supervisor = Supervisor(ctx, self.stop_queue, on_crash=self._on_crash)
+        self.supervisor.add("page compiler", ConsumerProcess(
+            target=_compile_process, input_queue=self.page_queue, args=(self.stop_queue, cfg, self.reply_queue)))
+        self.supervisor.add("asset compiler", ConsumerProcess(
+            target=_asset_compile_process, input_queue=self.asset_queue,
+            args=(self.stop_queue, cfg, self.reply_queue, self.page_queue)))
+
+        self._lock = asyncio.Lock()
+        self._ids = itertools.count(1)
+        # build id => (answers received, future resolved once complete)
+        self._pending: Dict[str, Tuple[Set[str], asyncio.Future]] = {}
+        self._started = time.time()
+        self._builds = 0
+        self._last_build: Optional[dict] = None
+
+    def start_reply_reader(self) -> None:
+        def read():
+            while True:
+                msg = self.reply_queue.get()
+                if msg["type"] == EventType.FLUSHED:
+                    self._loop.call_soon_threadsafe(self._on_flushed, msg["payload"])
+
+        # a daemon thread, rather than the loop's executor, which would wait for it on shutdown.
+        threading.Thread(target=read, name="gadfly-daemon-replies", daemon=True).start()
+
+    def _on_flushed(self, payload: dict) -> None:
+        pending = self._pending.get(payload["id"])
+        if pending is None:
+            return
+        answers, done = pending
+        answers.add(payload["name"] if payload["name"] == "assets" else f"pages/{payload['source']}")
+        if answers >= _FLUSHED_ALL and not done.done():
+            done.set_result(None)
+
+    def _on_crash(self, name: str, exitcode: int) -> None:
+        # the crashed process may have taken a FLUSH event with it, fail the builds waiting
+        for _answers, done in self._pending.values():
+            if not done.done():
+                done.set_exception(RuntimeError(f"{name} exited (code {exitcode}) during the build"))
+
+    async def build(self, full: bool = False) -> dict:
+        """Process all changes since the last build.
+
+        Args:
+            full: whether this is the daemon's initial build, producing every
+                  output (see `manifest.merge`).
+        """
+        async with self._lock:
+            started = time.perf_counter()
+            build_id = str(next(self._ids))
+            done = self._loop.create_future()
+            self._pending[build_id] = (set(), done)
+            try:
+                if not full:
+                    await self._loop.run_in_executor(None, self._observer.poll)
+                flush = {"type": EventType.FLUSH, "payload": {"id": build_id, "source": "daemon"}}
+                self.page_queue.put(flush)
+                self.asset_queue.put(flush)
+                await done
+            except RuntimeError as e:
+                return {"ok": False, "error": str(e)}
+            finally:
+                del self._pending[build_id]
+            changes = await self._loop.run_in_executor(None, manifest.merge, self._cfg, OUTPUT_TRACKERS, full)
+            if changes is None:
+                return {"ok": False, "error": "outputs of the build are not recorded"}
+            self._builds += 1
+            self._last_build = {
+                "ms": int((time.perf_counter() - started) * 1000),
+                "finished": time.time(),
+                "changes": {kind: len(files) for kind, files in changes.items()},
+            }
+            return {"ok": True, **self._last_build}
+
+    def status(self) -> dict:
+        return {
+            "ok": True,
+            "pid": os.getpid(),
+            "uptime_s": int(time.time() - self._started),
+            "builds": self._builds,
+            "last_build": self._last_build,
+            "processes": self.supervisor.alive(),
+        }
+
+    def invalidate(self, what: str) -> dict:
+        if what == "context":
+            # the restarted page compiler evaluates the context, and snapshots it again
+            context_cache.clear(self._cfg)
+            self.page_queue.put({"type": EventType.CONTEXT_CHANGED, "payload": {}})
+        elif what == "templates":
+            self.page_queue.put({"type": EventType.TEMPLATE_CHANGED, "payload": {}})
+        elif what == "assets":
+            for asset_name, asset_opts in self._cfg.assets.items():
+                # no file: the handler runs over the whole directory
+                self.asset_queue.put({"type": EventType.ASSET_CHANGED, "payload": {
+                    "file": None, "asset_name": asset_name, "asset_opts": asset_opts}})
+        else:
+            return {"ok": False, "error": f"cannot invalidate '{what}', expected one of {', '.join(INVALIDATE)}"}
+        return {"ok": True}
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            line = await reader.readline()
+            try:
+                msg = json.loads(line)
+                cmd = msg["cmd"]
+            except (ValueError, KeyError, TypeError):
+                answer = {"ok": False, "error": "expected a JSON object with a 'cmd' key"}
+            else:
+                if cmd == "build":
+                    answer = await self.build()
+                    self._report(answer)
+                elif cmd == "status":
+                    answer = self.status()
+                elif cmd == "invalidate":
+                    answer = self.invalidate(msg.get("what"))
+                else:
+                    answer = {"ok": False, "error": f"unknown command '{cmd}'"}
+            writer.write(json.dumps(answer).encode() + b"\n")
+            await writer.drain()
+        except ConnectionError:
+            # client gone
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    def _report(answer: dict) -> None:
+        if not answer["ok"]:
+            cli.info(f"build failed: {answer['error']}")
+            return
+        changes = answer["changes"]
+        cli.info(f"build done in {answer['ms']}ms: "
+                 f"{changes['added']} added, {changes['changed']} changed, {changes['removed']} removed")
+
+
+def serve(cfg: config.Config) -> None:
+    """Run the build daemon of the project until interrupted."""
+    asyncio.run(_serve(cfg))
+
+
+async def _serve(cfg: config.Config) -> None:
+    path = socket_path(cfg)
+    try:
+        request(cfg, {"cmd": "status"})
+    except DaemonNotRunningError:
+        # left behind by a daemon which did not exit cleanly
+        path.unlink(missing_ok=True)
+    else:
+        cli.pp_err_details("a daemon is already running for this project", {"socket": path})
+        return
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    cfg.track_outputs = True
+    manifest.clear_trackers(cfg, OUTPUT_TRACKERS)
+    loop = asyncio.get_running_loop()
+    daemon = _Daemon(cfg, loop)
+    try:
+        server = await asyncio.start_unix_server(daemon.handle, path=str(path))
+    except OSError as e:
+        cli.pp_err_details("failed to start daemon", {"socket": path, "error": str(e)})
+        return
+    daemon.start_reply_reader()
+    supervised = asyncio.ensure_future(daemon.supervisor.run())
+
+    async def initial_build():
+        answer = await daemon.build(full=True)
+        daemon._report(answer)
+        cli.info(f"daemon listening on '{path}'")
+
+    initial = asyncio.ensure_future(initial_build())
+    try:
+        # until a compiler signals a fatal error
+        await supervised
+    finally:
+        initial.cancel()
+        server.close()
+        path.unlink(missing_ok=True)
@@ -0,0 +1,90 @@
+"""Dependencies of pages on the files written by asset handlers.
+
+Templates reference asset outputs through the helpers of the `gadfly`
+namespace: `${gadfly.asset('css/main.css')}` emits the output's URL,
+`${gadfly.depends('data/authors.json')}` just records the reference (e.g. for
+a file read by template code). Paths are relative to the output directory. The
+image helpers record the source image.
+
+In watch mode (and in the build daemon), the page compiler records each page's references along with
+the digest of the referenced file at render time. When the asset compiler
+reports the files it wrote (`EventType.ASSET_OUTPUT_CHANGED`), the pages which
+were rendered against a different version of any of them are re-rendered,
+rather than none or all.
+"""
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Set, Tuple, Union
+import os
+from gadfly.config import Config
+from gadfly.utils import file_sha256
+from gadfly import config
+
+# set by the page compiler in watch mode and in the build daemon, not by one-off compiles
+tracker: Optional["AssetDependencies"] = None
+
+
+class AssetDependencies:
+    def __init__(self, cfg: Config):
+        self._cfg = cfg
+        # file => {page name => digest of file when the page was rendered}
+        self._refs: Dict[str, Dict[str, Optional[str]]] = {}
+        # page name => files it references
+        self._pages: Dict[str, Set[str]] = {}
+        # file => ((mtime, size), digest), files are hashed once per change
+        self._digests: Dict[str, Tuple[Tuple[int, int], str]] = {}
+
+    def digest(self, fpath: str) -> Optional[str]:
+        """sha256 of `fpath`, None if it does not exist."""
+        try:
+            st = os.stat(fpath)
+        except FileNotFoundError:
+            self._digests.pop(fpath, None)
+            return None
+        sig = (st.st_mtime_ns, st.st_size)
+        cached = self._digests.get(fpath)
+        if cached is None or cached[0] != sig:
+            cached = self._digests[fpath] = (sig, file_sha256(fpath))
+        return cached[1]
+
+    def reset(self, page_name: Path) -> None:
+        """Forget the references of `page_name`, about to be re-rendered."""
+        for fpath in self._pages.pop(str(page_name), ()):
+            refs = self._refs[fpath]
+            refs.pop(str(page_name), None)
+            if not refs:
+                del self._refs[fpath]
+
+    def record(self, page_name: Path, fpath: str) -> None:
+        self._pages.setdefault(str(page_name), set()).add(fpath)
+        self._refs.setdefault(fpath, {})[str(page_name)] = self.digest(fpath)
+
+    def affected(self, files: Iterable[str]) -> List[str]:
+        """Pages (absolute paths) rendered against another version of any of `files`."""
+        pages = []
+        for fpath in files:
+            refs = self._refs.get(fpath)
+            if not refs:
+                continue
+            digest = self.digest(fpath)
+            pages.extend(str(self._cfg.pages_path / page_name)
+                         for page_name, seen in refs.items() if seen != digest)
+        return list(dict.fromkeys(pages))
+
+
+def record(page_name: Optional[Path], fpath: Union[str, Path]) -> None:
+    """Record that `page_name` references `fpath` (an absolute path), if tracking."""
+    # page_name is unset for generated pages, these are re-generated after every change anyway
+    if tracker is not None and page_name is not None:
+        tracker.record(page_name, str(fpath))
+
+
+def depends(page_name: Optional[Path], path: str) -> str:
+    record(page_name, config.config.output_path / path.lstrip("/"))
+    return ""
+
+
+def asset(page_name: Optional[Path], path: str) -> str:
+    """URL of asset output `path`."""
+    path = path.lstrip("/")
+    record(page_name, config.config.output_path / path)
+    return f"/{path}"
@@ -0,0 +1,320 @@
+"""Development server, serving the output directory with live-reload.
+
+Runs as a consumer process of `compile_watch`. Beyond livereload's own server,
+it
+* reports which pages connected browsers are viewing to the page compiler
+  (`EventType.PAGES_VIEWED`), which renders those first.
+* reloads browsers as soon as the page compiler reports their page is done
+  (`EventType.RELOAD` on its input queue), likewise when the asset compiler
+  wrote files. Unlike livereload's own server, it does not poll the output
+  directory for changes.
+* answers conditional requests (`If-None-Match`, `If-Modified-Since`) with
+  304s and serves precompressed variants, see `OutputFileHandler`.
+"""
+from pathlib import Path
+from typing import Dict, Optional, Set, Tuple
+from urllib.parse import urlparse, unquote
+from queue import Empty as QueueEmpty
+import datetime
+import json
+import mimetypes
+import os
+import time
+import multiprocessing as mp
+from livereload import Server
+from livereload.handlers import LiveReloadHandler, LiveReloadJSHandler, ForceReloadHandler
+from livereload.server import LiveScriptInjector
+from tornado import escape, ioloop, web
+from gadfly import config
+from gadfly import cli
+from gadfly.compress import SUFFIXES
+from gadfly.mp import EventType, OUTPUT_TRACKERS
+from gadfly.utils import file_sha256
+
+# how often to check for reload requests from the page compiler, in ms
+RELOAD_POLL_INTERVAL = 100
+
+
+def url_to_page(cfg: config.Config, url: str) -> Optional[Path]:
+    """Find the page producing the output served at `url`, if any."""
+    url_path = unquote(urlparse(url).path).lstrip("/")
+    out_path = cfg.output_path / url_path
+    if url_path == "" or url_path.endswith("/") or out_path.is_dir():
+        out_path = out_path / "index.html"
+    if out_path.name != "index.html":
+        # pages only produce index.html files, anything else is generated
+        return None
+    out_dir = out_path.parent.relative_to(cfg.output_path)
+    candidates = [cfg.pages_path / out_dir / "index.md"]
+    if out_dir.parts:
+        candidates.append(cfg.pages_path / out_dir.parent / f"{out_dir.name}.md")
+    for page in candidates:
+        if page.exists():
+            return page
+    return None
+
+
+class OutputDigests:
+    def __init__(self, cfg: config.Config):
+        """sha256 of output files, as recorded by the output compressors
+        (`gadfly.compress`) if up to date, else hashed once per change of a file."""
+        self._cfg = cfg
+        # compression database => (its (mtime, size), output file => [mtime, size, sha256])
+        self._dbs: Dict[Path, Tuple[Tuple[int, int], Dict[str, list]]] = {}
+        # output file => ((mtime, size), sha256)
+        self._digests: Dict[str, Tuple[Tuple[int, int], str]] = {}
+
+    def _db_entry(self, abspath: str) -> Optional[list]:
+        for name in OUTPUT_TRACKERS:
+            db_path = self._cfg.cache_path / f"compress-{name}.json"
+            try:
+                st = os.stat(db_path)
+            except FileNotFoundError:
+                continue
+            sig = (st.st_mtime_ns, st.st_size)
+            cached = self._dbs.get(db_path)
+            if cached is None or cached[0] != sig:
+                try:
+                    with open(db_path) as fh:
+                        files = json.load(fh).get("files", {})
+                except (OSError, ValueError):
+                    # being replaced, read again on the next request
+                    continue
+                cached = self._dbs[db_path] = (sig, files)
+            entry = cached[1].get(abspath)
+            if entry is not None:
+                return entry
+        return None
+
+    def compressed(self, abspath: str, st: os.stat_result) -> bool:
+        """Whether the variants of `abspath`, if any, were written for its current content."""
+        entry = self._db_entry(abspath)
+        return entry is not None and entry[0] == st.st_mtime_ns and entry[1] == st.st_size
+
+    def digest(self, abspath: str, st: os.stat_result) -> str:
+        sig = (st.st_mtime_ns, st.st_size)
+        cached = self._digests.get(abspath)
+        if cached is not None and cached[0] == sig:
+            return cached[1]
+        entry = self._db_entry(abspath)
+        if entry is not None and (entry[0], entry[1]) == sig:
+            digest = entry[2]
+        else:
+            digest = file_sha256(abspath)
+        self._digests[abspath] = (sig, digest)
+        return digest
+
+
+def accepted_encodings(header: str) -> Set[str]:
+    """Codings accepted by an `Accept-Encoding` header (without q=0)."""
+    accepted = set()
+    for item in header.split(","):
+        coding, *params = [part.strip() for part in item.split(";")]
+        q = 1.0
+        for param in params:
+            if param.startswith("q="):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    pass
+        if coding and q > 0:
+            accepted.add(coding.lower())
+    return accepted
+
+
+class OutputFileHandler(web.StaticFileHandler):
+    """Serves the output directory, such that browsers re-download only what changed:
+
+    * strong ETags, the sha256 of each file (see `OutputDigests`),
+    * 304 answers to conditional requests, which livereload's handler never sends,
+    * `Cache-Control: no-cache`, browsers revalidate rather than guess freshness,
+    * precompressed variants (see `[compress]`) to clients accepting them.
+      Not for HTML pages, livereload injects its script into these.
+    """
+    # set by `serve`
+    digests: Optional[OutputDigests] = None
+    # `[compress]` formats, named as their content codings, preferred first
+    ENCODINGS = ["br", "zstd", "gzip"]
+
+    def validate_absolute_path(self, root: str, absolute_path: str) -> Optional[str]:
+        self._source: Optional[str] = None
+        self._encoding: Optional[str] = None
+        abspath = super().validate_absolute_path(root, absolute_path)
+        if abspath is None or not os.path.isfile(abspath):
+            return abspath
+        self._source = abspath
+        self._source_stat = os.stat(abspath)
+        variant = self._variant(abspath)
+        if variant is None:
+            return abspath
+        # serve the variant in place of the file, see `get_content_type`
+        self._stat_result = os.stat(variant)
+        return variant
+
+    def _variant(self, abspath: str) -> Optional[str]:
+        formats = config.config.compress.formats
+        if not formats or self._source_stat.st_size < config.config.compress.min_size:
+            return None
+        if (mimetypes.guess_type(abspath)[0] or "").startswith("text/html"):
+            return None
+        accepted = accepted_encodings(self.request.headers.get("Accept-Encoding", ""))
+        for fmt in self.ENCODINGS:
+            if fmt not in formats or fmt not in accepted:
+                continue
+            variant = abspath + SUFFIXES[fmt]
+            try:
+                st = os.stat(variant)
+            except FileNotFoundError:
+                continue
+            # outdated while the compressor catches up with a rewrite
+            if self.digests.compressed(abspath, self._source_stat) or st.st_mtime_ns >= self._source_stat.st_mtime_ns:
+                self._encoding = fmt
+                return variant
+        return None
+
+    def compute_etag(self) -> Optional[str]:
+        if self._source is None:
+            return None
+        digest = self.digests.digest(self._source, self._source_stat)
+        # representations differ per encoding, so do their tags
+        return f'"{digest}-{self._encoding}"' if self._encoding else f'"{digest}"'
+
+    def get_modified_time(self) -> Optional[datetime.datetime]:
+        if self._source is None:
+            return super().get_modified_time()
+        # of the content, a variant left in place by the compressor may be older
+        return datetime.datetime.fromtimestamp(int(self._source_stat.st_mtime), datetime.timezone.utc)
+
+    def get_content_type(self) -> str:
+        if self._encoding is None:
+            return super().get_content_type()
+        mime_type, _encoding = mimetypes.guess_type(self._source)
+        return mime_type or "application/octet-stream"
+
+    def set_extra_headers(self, path: str) -> None:
+        self.set_header("Cache-Control", "no-cache")
+        if config.config.compress.formats:
+            self.set_header("Vary", "Accept-Encoding")
+        if self._encoding is not None:
+            self.set_header("Content-Encoding", self._encoding)
+
+
+class GadflyLiveReloadHandler(LiveReloadHandler):
+    # page queue of the page compiler, set by `serve`
+    page_queue: Optional[mp.Queue] = None
+
+    def open(self, *args, **kwargs):
+        # page being viewed, known once the client sends its 'info' message
+        self.page: Optional[Path] = None
+
+    def on_message(self, message):
+        super().on_message(message)
+        message = escape.json_decode(message)
+        if message.get("command") == "info" and "url" in message:
+            self.page = url_to_page(config.config, message["url"])
+            self.report_viewed()
+
+    def on_close(self):
+        super().on_close()
+        self.report_viewed()
+
+    @classmethod
+    def report_viewed(cls) -> None:
+        pages = sorted({str(waiter.page) for waiter in cls.waiters if waiter.page is not None})
+        cls.page_queue.put({"type": EventType.PAGES_VIEWED, "payload": {"pages": pages}})
+
+    @classmethod
+    def reload_pages(cls, pages: Optional[Set[str]] = None, skip: Optional[Set[str]] = None,
+                     path: str = "*") -> None:
+        """Reload browsers viewing one of `pages` (all if None), except those viewing one of `skip`.
+
+        `path` is the changed file, for a stylesheet browsers reload just the stylesheets."""
+        msg = {
+            "command": "reload",
+            "path": path,
+            "liveCSS": cls.live_css,
+            "liveImg": True,
+        }
+        for waiter in cls.waiters.copy():
+            page = str(waiter.page)
+            if (pages is not None and page not in pages) or (skip and page in skip):
+                continue
+            waiter.send_message(msg)
+
+
+class DevServer(Server):
+    def __init__(self, reload_queue: mp.Queue):
+        super().__init__()
+        self._reload_queue = reload_queue
+        self.SFH = OutputFileHandler
+
+    def _poll_reload_queue(self) -> None:
+        try:
+            while True:
+                event = self._reload_queue.get(block=False)
+                if event["type"] == EventType.RELOAD and "payload" not in event:
+                    # the page compiler (re)started
+                    GadflyLiveReloadHandler.report_viewed()
+                elif event["type"] == EventType.RELOAD:
+                    payload = event["payload"]
+                    pages = payload.get("pages")
+                    GadflyLiveReloadHandler.reload_pages(
+                        set(pages) if pages is not None else None,
+                        set(payload.get("skip", [])),
+                        payload.get("path", "*"))
+                elif event["type"] == EventType.STOP:
+                    ioloop.IOLoop.current().stop()
+                    return
+        except QueueEmpty:
+            pass
+
+    def application(self, port, host, liveport=None, debug=None, live_css=True):
+        # mirrors `Server.application`, using our own live-reload websocket handler
+        # (no support for a separate live-reload port).
+        LiveReloadHandler.watcher = self.watcher
+        LiveReloadHandler.live_css = live_css
+        live_script = escape.utf8(
+            '<script type="text/javascript">(function(){'
+            'var s=document.createElement("script");'
+            'var port=(window.location.port || (window.location.protocol == "https:" ? 443: 80));'
+            's.src="//"+window.location.hostname+":"+port'
+            '+ "/livereload.js?port=" + port;'
+            'document.head.appendChild(s);'
+            '})();</script>'
+        )
+
+        class ConfiguredTransform(LiveScriptInjector):
+            script = live_script
+
+        app = web.Application(
+            handlers=[
+                (r"/livereload", GadflyLiveReloadHandler),
+                (r"/forcereload", ForceReloadHandler),
+                (r"/livereload.js", LiveReloadJSHandler),
+                *self.get_web_handlers(live_script)
+            ],
+            debug=bool(debug),
+            transforms=[ConfiguredTransform]
+        )
+        app.listen(port, address=host)
+        ioloop.PeriodicCallback(self._poll_reload_queue, RELOAD_POLL_INTERVAL).start()
+
+
+def serve(reload_queue: mp.Queue, stop_queue: mp.Queue, cfg: config.Config, port: int, page_queue: mp.Queue) -> None:
+    # this globally assigned variable is not set in the new process.
+    config.config = cfg
+    GadflyLiveReloadHandler.page_queue = page_queue
+    OutputFileHandler.digests = OutputDigests(cfg)
+    server = DevServer(reload_queue)
+    # Reloads are requested by the compile processes, nothing to watch. Without
+    # any watch, livereload would watch the working directory, marking its
+    # tasks as started prevents that (and its polling).
+    LiveReloadHandler._last_reload_time = time.time()
+    try:
+        server.serve(root=str(cfg.output_path), port=port)
+    except KeyboardInterrupt:
+        pass
+    except OSError as e:
+        cli.pp_err_details("failed to start dev server", {"port": port, "error": str(e)})
+        # warn master process, restarting would fail the same way
+        stop_queue.put(1)
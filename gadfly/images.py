@@ -0,0 +1,377 @@
+"""Built-in asset handler producing resized and re-encoded variants of images,
+and template helpers emitting `srcset` markup for them.
+
+```toml
+[assets.images]
+handler = "gadfly.images:on_images"
+# optional, defaults shown
+widths = [480, 960, 1920]
+formats = ["original"]  # or e.g. ["webp", "jpeg"]
+quality = 80
+out = "images"          # output directory, defaults to the asset name
+```
+
+`photos/cat.jpg` of the asset directory yields `images/photos/cat-480w.jpg` etc.
+in the output directory. Images are never upscaled, widths beyond an image's
+own width yield a single variant of its original width.
+
+Variants are encoded in worker processes and cached in `.gadfly/images/`, keyed
+by the hash of the source image and the variant's parameters. Restarts and CI
+builds (restoring `.gadfly`) only process new or changed images.
+
+Templates use the helpers of the `gadfly` namespace, which derive the variants
+from the image and the asset's options, independently of the handler having run:
+
+    <img srcset="${gadfly.srcset('photos/cat.jpg')}" sizes="50vw" alt="A cat">
+    ${gadfly.img('photos/cat.jpg', alt='A cat', sizes='50vw')}
+"""
+from concurrent.futures import Future
+from dataclasses import asdict, dataclass
+from importlib.util import find_spec
+from pathlib import Path
+from hashlib import sha256
+from html import escape
+from io import BytesIO
+from typing import Dict, List, Optional, Tuple
+import json
+import os
+from gadfly.assets.ctx import AssetCtx
+from gadfly.atomic import write_atomic
+from gadfly.assets.errors import AssetValidationError
+from gadfly.compress import remove_variants
+from gadfly.config import Config
+from gadfly.utils import file_sha256
+from gadfly import cli
+from gadfly import config as config_mod
+from gadfly import deps
+from gadfly import workers
+
+HANDLER = "gadfly.images:on_images"
+DEFAULT_WIDTHS = [480, 960, 1920]
+DEFAULT_QUALITY = 80
+# inputs
+IMAGE_SUFFIXES = {".jpg", ".jpeg", ".png", ".webp", ".gif", ".tif", ".tiff"}
+# outputs, by Pillow format name
+FORMATS = {
+    "JPEG": (".jpg", "image/jpeg"),
+    "PNG": (".png", "image/png"),
+    "WEBP": (".webp", "image/webp"),
+    "GIF": (".gif", "image/gif"),
+    "AVIF": (".avif", "image/avif"),
+}
+# EXIF orientations rotating the image by 90 or 270 degrees
+_TRANSPOSED = {5, 6, 7, 8}
+
+
+@dataclass(frozen=True)
+class ImageOptions:
+    widths: Tuple[int, ...]
+    # Pillow format names, or "original"
+    formats: Tuple[str, ...]
+    quality: int
+    # output directory, relative to the output path
+    out: str
+
+    def digest(self) -> str:
+        return sha256(json.dumps([self.widths, self.formats, self.quality, self.out]).encode()).hexdigest()
+
+
+@dataclass(frozen=True)
+class Variant:
+    # path relative to the output directory
+    path: str
+    width: int
+    height: int
+    format: str
+    # cache key, see `_variant_key`
+    key: str
+
+
+def _options(asset_name: str, opts: dict) -> ImageOptions:
+    def invalid(message: str) -> AssetValidationError:
+        return AssetValidationError(asset_name, opts.get("dir"), message)
+
+    if find_spec("PIL") is None:
+        raise invalid(f"handler '{HANDLER}' requires the 'Pillow' package")
+    widths = opts.get("widths", DEFAULT_WIDTHS)
+    if not widths or not all(isinstance(w, int) and w > 0 for w in widths):
+        raise invalid("'widths' must be a non-empty list of positive integers")
+    formats = [fmt.upper() for fmt in opts.get("formats", ["original"])]
+    if not formats:
+        raise invalid("'formats' must not be empty")
+    for fmt in formats:
+        if fmt == "JPG":
+            raise invalid("unknown format 'jpg', did you mean 'jpeg'?")
+        if fmt != "ORIGINAL" and fmt not in FORMATS:
+            raise invalid(f"unknown format '{fmt.lower()}', expected one of 'original', "
+                          + ", ".join(f"'{name.lower()}'" for name in FORMATS))
+    quality = opts.get("quality", DEFAULT_QUALITY)
+    if not isinstance(quality, int) or not 1 <= quality <= 100:
+        raise invalid("'quality' must be an integer between 1 and 100")
+    return ImageOptions(
+        widths=tuple(sorted(set(widths))),
+        formats=tuple("original" if fmt == "ORIGINAL" else fmt for fmt in formats),
+        quality=quality,
+        out=opts.get("out", asset_name).strip("/"),
+    )
+
+
+def _variant_key(src_hash: str, width: int, height: int, fmt: str, quality: int) -> str:
+    from PIL import __version__ as pil_version
+    return sha256(f"{src_hash}\0{width}\0{height}\0{fmt}\0{quality}\0{pil_version}".encode()).hexdigest()
+
+
+def _probe(src: Path) -> Tuple[int, int, str]:
+    """Size (after applying EXIF orientation) and format of image `src`, reads just its header."""
+    from PIL import Image
+    with Image.open(src) as img:
+        width, height = img.size
+        if img.getexif().get(0x0112) in _TRANSPOSED:
+            width, height = height, width
+        # multi-picture JPEGs, as written by many cameras
+        fmt = "JPEG" if img.format == "MPO" else img.format
+    return width, height, fmt
+
+
+def _plan(opts: ImageOptions, rel: str, src_hash: str, size: Tuple[int, int], src_format: str) -> List[Variant]:
+    src_width, src_height = size
+    widths = sorted({min(width, src_width) for width in opts.widths})
+    rel_path = Path(rel)
+    variants = []
+    for fmt in opts.formats:
+        if fmt == "original":
+            fmt = src_format if src_format in FORMATS else "PNG"
+        suffix = FORMATS[fmt][0]
+        for width in widths:
+            height = max(1, round(src_height * width / src_width))
+            path = Path(opts.out) / rel_path.parent / f"{rel_path.stem}-{width}w{suffix}"
+            variants.append(Variant(
+                path=path.as_posix(), width=width, height=height, format=fmt,
+                key=_variant_key(src_hash, width, height, fmt, opts.quality)))
+    return variants
+
+
+def _cache_dir(cfg: Config) -> Path:
+    return cfg.cache_path / "images" / "cache"
+
+
+def _cache_file(cache_dir: Path, key: str) -> Path:
+    return cache_dir / key[:2] / key
+
+
+def _index_path(cfg: Config, asset_name: str) -> Path:
+    return cfg.cache_path / "images" / f"{asset_name}.json"
+
+
+def _load_index(path: Path) -> Dict[str, dict]:
+    try:
+        with open(path) as fh:
+            return json.load(fh)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def _encode(src: str, variants: List[Tuple[str, int, int, str]], quality: int, cache_dir: str) -> None:
+    # NOTE: runs in a worker process
+    from PIL import Image, ImageOps
+    with Image.open(src) as img:
+        # decode once, for all variants
+        img = ImageOps.exif_transpose(img)
+        for key, width, height, fmt in variants:
+            out = img if img.size == (width, height) else img.resize((width, height), Image.LANCZOS)
+            if fmt == "JPEG" and out.mode not in ("RGB", "L"):
+                out = out.convert("RGB")
+            buf = BytesIO()
+            out.save(buf, fmt, quality=quality)
+            write_atomic(_cache_file(Path(cache_dir), key), buf.getvalue())
+
+
+def _sources(ctx: AssetCtx) -> List[Path]:
+    if ctx.file is not None:
+        return [ctx.file] if ctx.file.suffix.lower() in IMAGE_SUFFIXES and ctx.file.is_file() else []
+    sources = []
+    for dirpath, dir_names, file_names in os.walk(ctx.asset_dir):
+        dir_names.sort()
+        sources.extend(Path(dirpath) / name for name in sorted(file_names)
+                       if Path(name).suffix.lower() in IMAGE_SUFFIXES)
+    return sources
+
+
+def on_images(ctx: AssetCtx) -> None:
+    """Asset handler writing the variants of each image of the asset directory,
+    or only of `ctx.file` if set."""
+    cfg = ctx.config
+    asset_name = ctx.asset_name
+    opts = _options(asset_name, ctx.asset_opts)
+    digest = opts.digest()
+    cache_dir = _cache_dir(cfg)
+    index_path = _index_path(cfg, asset_name)
+    index = _load_index(index_path)
+    # whether the whole directory is processed, entries of images not seen are dropped
+    full = ctx.file is None
+    entries: Dict[str, dict] = {} if full else dict(index)
+    # (source, its relative path, index entry, variants to encode)
+    jobs: List[Tuple[Path, str, dict, List[Variant]]] = []
+
+    for path in _sources(ctx):
+        rel = path.relative_to(ctx.asset_dir).as_posix()
+        stat = path.stat()
+        entry = index.get(rel)
+        if entry is None or entry["options"] != digest or entry["stat"] != [stat.st_mtime_ns, stat.st_size]:
+            try:
+                width, height, fmt = _probe(path)
+            except Exception as e:
+                cli.pp_err_details("could not read image", {"asset": asset_name, "image": rel, "error": str(e)})
+                continue
+            planned = _plan(opts, rel, file_sha256(path), (width, height), fmt)
+            entry = {"options": digest, "stat": [stat.st_mtime_ns, stat.st_size],
+                     "variants": [asdict(v) for v in planned]}
+        missing = [Variant(**v) for v in entry["variants"] if not _cache_file(cache_dir, v["key"]).exists()]
+        jobs.append((path, rel, entry, missing))
+
+    encoding = [(path, rel, missing) for path, rel, _entry, missing in jobs if missing]
+    if encoding:
+        cli.info(f"encoding {sum(len(missing) for _, _, missing in encoding)} variants "
+                 f"of {len(encoding)} images ({asset_name})")
+    pool = workers.LazyPool(cfg)
+    try:
+        futures: Dict[str, Future] = {}
+        for path, rel, missing in encoding:
+            args = (str(path), [(v.key, v.width, v.height, v.format) for v in missing],
+                    opts.quality, str(cache_dir))
+            if len(encoding) == 1:
+                # not worth starting worker processes
+                future = Future()
+                try:
+                    future.set_result(_encode(*args))
+                except Exception as e:
+                    future.set_exception(e)
+            else:
+                future = pool.get().submit(_encode, *args)
+            futures[rel] = future
+        for path, rel, entry, _missing in jobs:
+            future = futures.get(rel)
+            if future is not None and future.exception() is not None:
+                cli.pp_err_details("could not encode image", {
+                    "asset": asset_name, "image": rel, "error": str(future.exception())})
+                entries.pop(rel, None)
+                continue
+            # outputs of images unchanged since the last run are left as they are
+            unchanged = index.get(rel) is entry
+            for v in entry["variants"]:
+                _write_variant(ctx, cache_dir, Variant(**v), unchanged)
+            entries[rel] = entry
+    finally:
+        pool.shutdown()
+
+    if full:
+        # outputs are not collected as garbage, remove those of images gone (or encoded differently)
+        current = {v["path"] for entry in entries.values() for v in entry["variants"]}
+        for entry in index.values():
+            for v in entry["variants"]:
+                if v["path"] not in current:
+                    (cfg.output_path / v["path"]).unlink(missing_ok=True)
+                    remove_variants(cfg.output_path / v["path"])
+        _prune_cache(cache_dir, {v["key"] for idx in (entries, *_other_indexes(cfg, asset_name))
+                                 for entry in idx.values() for v in entry["variants"]})
+    write_atomic(index_path, json.dumps(entries, indent=1, sort_keys=True).encode())
+
+
+def _write_variant(ctx: AssetCtx, cache_dir: Path, variant: Variant, unchanged: bool) -> None:
+    out_path = ctx.config.output_path / variant.path
+    cached = _cache_file(cache_dir, variant.key)
+    if unchanged and out_path.exists():
+        ctx.kept(out_path)
+        return
+    write_atomic(out_path, cached.read_bytes())
+
+
+def _other_indexes(cfg: Config, asset_name: str) -> List[Dict[str, dict]]:
+    """Indexes of the other image assets, sharing the cache."""
+    return [_load_index(_index_path(cfg, name)) for name, opts in cfg.assets.items()
+            if name != asset_name and opts.get("handler") == HANDLER]
+
+
+def _prune_cache(cache_dir: Path, keep: set) -> None:
+    if not cache_dir.exists():
+        return
+    for dirpath, _dir_names, file_names in os.walk(cache_dir):
+        for name in file_names:
+            if name not in keep:
+                Path(dirpath, name).unlink(missing_ok=True)
+
+
+# template helpers, run in the page compiler
+
+# index path => (mtime, index), indexes are read once per change
+_indexes: Dict[Path, Tuple[int, Dict[str, dict]]] = {}
+
+
+def _cached_index(path: Path) -> Dict[str, dict]:
+    try:
+        mtime = path.stat().st_mtime_ns
+    except FileNotFoundError:
+        return {}
+    cached = _indexes.get(path)
+    if cached is None or cached[0] != mtime:
+        cached = _indexes[path] = (mtime, _load_index(path))
+    return cached[1]
+
+
+def _image_asset(cfg: Config, asset: Optional[str]) -> str:
+    if asset is not None:
+        return asset
+    for name, opts in cfg.assets.items():
+        if opts.get("handler") == HANDLER:
+            return name
+    raise ValueError(f"no asset uses the image handler '{HANDLER}'")
+
+
+def variants(src: str, asset: Optional[str] = None, page_name: Optional[Path] = None) -> List[Variant]:
+    """Variants of image `src` (relative to the asset directory), derived from
+    the image itself - the asset handler need not have run yet.
+
+    `page_name`, if given, is recorded as depending on the image, see `gadfly.deps`."""
+    cfg = config_mod.config
+    asset = _image_asset(cfg, asset)
+    opts = _options(asset, cfg.assets[asset])
+    path = Path(cfg.assets[asset]["dir"]) / src
+    deps.record(page_name, path)
+    stat = path.stat()
+    entry = _cached_index(_index_path(cfg, asset)).get(Path(src).as_posix())
+    if entry is not None and entry["options"] == opts.digest() and entry["stat"] == [stat.st_mtime_ns, stat.st_size]:
+        return [Variant(**v) for v in entry["variants"]]
+    width, height, fmt = _probe(path)
+    return _plan(opts, Path(src).as_posix(), file_sha256(path), (width, height), fmt)
+
+
+def _srcset(variants_: List[Variant]) -> str:
+    return ", ".join(f"/{v.path} {v.width}w" for v in variants_)
+
+
+def srcset(src: str, fmt: Optional[str] = None, asset: Optional[str] = None,
+           page_name: Optional[Path] = None) -> str:
+    """The `srcset` attribute value for image `src`, in format `fmt` (default: the first configured)."""
+    all_variants = variants(src, asset, page_name)
+    fmt = fmt.upper() if fmt is not None else all_variants[0].format
+    return _srcset([v for v in all_variants if v.format == fmt])
+
+
+def img(src: str, alt: str = "", sizes: str = "100vw", asset: Optional[str] = None,
+        page_name: Optional[Path] = None, **attrs) -> str:
+    """`<img>` markup for image `src`, wrapped in a `<picture>` offering each format if several are configured."""
+    all_variants = variants(src, asset, page_name)
+    formats = list(dict.fromkeys(v.format for v in all_variants))
+    # the first configured format is preferred, the last is the fallback
+    fallback = [v for v in all_variants if v.format == formats[-1]]
+    largest = fallback[-1]
+    img_attrs = {"src": f"/{largest.path}", "srcset": _srcset(fallback), "sizes": sizes,
+                 "width": largest.width, "height": largest.height, "alt": alt, **attrs}
+    tag = "<img " + " ".join(f'{name}="{escape(str(val))}"' for name, val in img_attrs.items()) + ">"
+    if len(formats) == 1:
+        return tag
+    sources = "".join(
+        f'<source type="{FORMATS[fmt][1]}" srcset="{escape(_srcset([v for v in all_variants if v.format == fmt]))}"'
+        f' sizes="{escape(sizes)}">'
+        for fmt in formats[:-1])
+    return f"<picture>{sources}{tag}</picture>"
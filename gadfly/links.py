@@ -0,0 +1,268 @@
+"""Checker of internal links and anchors, run as part of the build.
+
+Enabled by `[links] check = true`. Links (`href`/`src` attributes) and anchors
+(`id` attributes, `<a name>`) are extracted from each page as it is written,
+pages and generated pages alike, in the worker pool for larger builds. Each
+link to the site itself is then resolved:
+
+* to a page: fine if the page was rendered, or is in the page index (see
+  `gadfly.pages`),
+* to any other file: fine if this build wrote or kept it, if an asset handler
+  reported writing it, or if it exists and is not an output of an earlier build's
+  page compiler (see `gadfly.manifest`). Stale outputs of deleted pages remain
+  until collected as garbage, they are not valid targets,
+* with a fragment: fine if the target page, when extracted, has that anchor.
+
+In watch mode, only the links of the re-rendered pages, and of the pages
+linking to them, are checked again.
+"""
+from concurrent.futures import Future
+from fnmatch import fnmatch
+from html.parser import HTMLParser
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple
+from urllib.parse import unquote, urljoin, urlsplit
+import posixpath
+import threading
+from gadfly.config import Config
+from gadfly.manifest import PAGES_TRACKER, load as load_manifest
+from gadfly.pages import PageIndex
+from gadfly import cli
+from gadfly import workers
+
+# pages extracted per worker job
+BATCH_SIZE = 32
+# attributes holding links, by tag
+LINK_ATTRS = {
+    "a": "href", "area": "href", "link": "href",
+    "img": "src", "script": "src", "source": "src", "iframe": "src", "video": "src", "audio": "src",
+}
+
+
+class Link(NamedTuple):
+    href: str
+    # line in the output file
+    line: int
+
+
+class BrokenLink(NamedTuple):
+    # output file holding the link, relative to the output directory
+    page: str
+    link: Link
+    reason: str
+
+
+class _LinkExtractor(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.links: List[Link] = []
+        self.anchors: Set[str] = set()
+
+    def handle_starttag(self, tag, attrs):
+        attr = LINK_ATTRS.get(tag)
+        for name, value in attrs:
+            if value is None:
+                continue
+            if name == "id" or (tag == "a" and name == "name"):
+                self.anchors.add(value)
+            elif name == attr:
+                self.links.append(Link(value.strip(), self.getpos()[0]))
+
+    handle_startendtag = handle_starttag
+
+
+def extract(content: str) -> Tuple[List[Link], Set[str]]:
+    """Links and anchors of an HTML page."""
+    parser = _LinkExtractor()
+    parser.feed(content)
+    parser.close()
+    return parser.links, parser.anchors
+
+
+def _extract_batch(batch: List[Tuple[str, str]]) -> List[Tuple[str, List[Link], Set[str]]]:
+    # NOTE: runs in a worker process
+    return [(name, *extract(content)) for name, content in batch]
+
+
+def page_url(name: str) -> str:
+    """URL of output file `name` (relative to the output directory)."""
+    if name == "index.html" or name.endswith("/index.html"):
+        return "/" + name[:-len("index.html")]
+    return "/" + name
+
+
+class LinkChecker:
+    def __init__(self, cfg: Config, pool: workers.LazyPool, pages: PageIndex):
+        """Checker of the links of the pages passed to `add`, see `check`."""
+        self._cfg = cfg
+        self._pool = pool
+        self._pages = pages
+        self._parallel = workers.worker_count(cfg) > 1
+        # pages written since the last check, not yet submitted for extraction
+        self._batch: List[Tuple[str, str]] = []
+        self._jobs: List[Future] = []
+        # pages added from transform callbacks run in other threads
+        self._lock = threading.Lock()
+        # output file => links, anchors
+        self._links: Dict[str, List[Link]] = {}
+        self._anchors: Dict[str, Set[str]] = {}
+        # output file => output files linking to it
+        self._inbound: Dict[str, Set[str]] = {}
+        # pages to check on the next `check`
+        self._dirty: Set[str] = set()
+        # other outputs of this build, see `written`
+        self._outputs: Set[str] = set()
+        # outputs of the page compiler in the previous build, possibly stale
+        self._prev_pages = {rel for rel, entry in load_manifest(cfg).items() if entry.get("by") == PAGES_TRACKER}
+        # output files of the page index, computed by `check`
+        self._indexed: Set[str] = set()
+
+    def _name(self, fpath: Path) -> str:
+        return fpath.relative_to(self._cfg.output_path).as_posix()
+
+    def add(self, fpath: Path, content: str) -> None:
+        """Register the (re-)written page `fpath`, an output file."""
+        with self._lock:
+            self._batch.append((self._name(fpath), content))
+            # extraction of a larger build starts while pages are still rendered
+            if self._parallel and len(self._batch) >= BATCH_SIZE:
+                self._jobs.append(self._pool.get().submit(_extract_batch, self._batch))
+                self._batch = []
+
+    def written(self, fpath: Path) -> None:
+        """Register output file `fpath` as written (or kept) by this build, e.g. a generated feed."""
+        try:
+            name = self._name(fpath)
+        except ValueError:
+            return
+        with self._lock:
+            self._outputs.add(name)
+
+    def add_file(self, fpath: Path) -> None:
+        """Register page `fpath` written without holding it in memory."""
+        with open(fpath, "r", encoding="utf-8") as fh:
+            self.add(fpath, fh.read())
+
+    def removed(self, fpath: Path) -> None:
+        """Register that page `fpath` was deleted, pages linking to it are checked again."""
+        name = self._name(fpath)
+        with self._lock:
+            self._batch = [entry for entry in self._batch if entry[0] != name]
+            self._set_links(name, [])
+            self._anchors.pop(name, None)
+            self._links.pop(name, None)
+            self._outputs.discard(name)
+            self._dirty.discard(name)
+            self._dirty.update(self._inbound.get(name, ()))
+
+    def files_changed(self, files: List[str]) -> None:
+        """Register that `files` (absolute paths) were written by another process,
+        pages linking to them are checked again."""
+        with self._lock:
+            for fpath in files:
+                try:
+                    name = self._name(Path(fpath))
+                except ValueError:
+                    # e.g. the changed source file of an asset
+                    continue
+                self._outputs.add(name)
+                self._dirty.update(self._inbound.get(name, ()))
+
+    def _set_links(self, name: str, links: List[Link]) -> None:
+        for target in self._targets(name, self._links.get(name, ())):
+            sources = self._inbound.get(target)
+            if sources is not None:
+                sources.discard(name)
+                if not sources:
+                    del self._inbound[target]
+        self._links[name] = links
+        for target in self._targets(name, links):
+            self._inbound.setdefault(target, set()).add(name)
+
+    def _targets(self, name: str, links) -> Set[str]:
+        targets = set()
+        for link in links:
+            resolved = self._resolve(name, link.href)
+            if resolved is not None and resolved[0] is not None:
+                targets.add(resolved[0])
+        return targets
+
+    def _resolve(self, name: str, href: str) -> Optional[Tuple[Optional[str], str]]:
+        """Output file (relative to the output directory, None if outside of it) and
+        fragment `href` refers to, None for links to other sites and ignored links."""
+        if not href or any(fnmatch(href, pattern) for pattern in self._cfg.links.ignore):
+            return None
+        parts = urlsplit(urljoin(page_url(name), href))
+        if parts.scheme or parts.netloc:
+            return None
+        path = unquote(parts.path)
+        if not path.strip("/"):
+            return "index.html", parts.fragment
+        target = posixpath.normpath(path.lstrip("/"))
+        if target == ".." or target.startswith("../"):
+            return None, parts.fragment
+        if path.endswith("/") or not posixpath.splitext(target)[1]:
+            # a directory, served by its index page
+            target = f"{target}/index.html"
+        return target, parts.fragment
+
+    def _exists(self, target: str) -> bool:
+        # a page rendered (or not yet), an output written by this build or by an asset handler
+        if target in self._links or target in self._indexed or target in self._outputs:
+            return True
+        if target in self._prev_pages:
+            # e.g. of a page deleted since, not collected as garbage (yet)
+            return False
+        # files gadfly never produced, and asset outputs left as they are
+        return (self._cfg.output_path / target).is_file()
+
+    def _check_page(self, name: str) -> List[BrokenLink]:
+        broken = []
+        for link in self._links.get(name, ()):
+            resolved = self._resolve(name, link.href)
+            if resolved is None:
+                continue
+            target, fragment = resolved
+            if target is None:
+                broken.append(BrokenLink(name, link, "outside of the site"))
+            elif not self._exists(target):
+                broken.append(BrokenLink(name, link, f"'{target}' does not exist"))
+            elif fragment and target in self._anchors and unquote(fragment) not in self._anchors[target]:
+                broken.append(BrokenLink(name, link, f"no anchor '{unquote(fragment)}' in '{target}'"))
+        return broken
+
+    def check(self) -> List[BrokenLink]:
+        """Check the links of the pages added since the last check, and of the pages linking to them."""
+        with self._lock:
+            batch, self._batch = self._batch, []
+            jobs, self._jobs = self._jobs, []
+        if batch and jobs:
+            # part of a larger build, run along the other jobs
+            jobs.append(self._pool.get().submit(_extract_batch, batch))
+            batch = []
+        results = _extract_batch(batch)
+        for job in jobs:
+            results.extend(job.result())
+
+        with self._lock:
+            for name, links, anchors in results:
+                self._set_links(name, links)
+                self._anchors[name] = anchors
+                self._dirty.add(name)
+                # links to the page's anchors may have broken (or been fixed)
+                self._dirty.update(self._inbound.get(name, ()))
+            dirty, self._dirty = self._dirty, set()
+            self._indexed = {self._name(entry.out_path) for entry in self._pages}
+        broken = []
+        for name in sorted(dirty):
+            broken.extend(self._check_page(name))
+        return broken
+
+
+def report(cfg: Config, broken: List[BrokenLink]) -> None:
+    for entry in broken:
+        fpath = cfg.output_path / entry.page
+        details = {"link": entry.link.href, "in": f"{fpath.relative_to(cfg.project_root)}:{entry.link.line}"}
+        cli.pp_err_details(f"broken link: {entry.reason}", details)
+    if broken:
+        cli.info(f"{len(broken)} broken link{'s' if len(broken) != 1 else ''}")
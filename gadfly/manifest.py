@@ -0,0 +1,240 @@
+"""Manifest of the output directory and the changes made by each build.
+
+Each process producing output records the files it wrote (with their sha256)
+and removed in an `OutputTracker`, saved to `.gadfly/outputs-<name>.json` when
+the process finishes (for the build daemon: when a build is done). Once all
+processes of `gadfly compile` are done, `merge` folds these into the manifest of
+the previous build, writing
+
+* `.gadfly/manifest.json`: every output file known to gadfly, by path relative
+  to the output directory, with the process which wrote it:
+  `{"files": {"blog/index.html": {"sha256": ..., "size": ..., "by": "pages"}}}`
+* `.gadfly/changes.json`: `{"added": [...], "changed": [...], "removed": [...]}`,
+  the files a deploy step must upload or delete.
+
+Files rewritten with identical content are not listed as changed.
+
+As a compile renders every page, outputs of the page compiler (pages and
+generated pages) in the previous manifest which were neither written nor
+explicitly kept are orphans (e.g. outputs of pages deleted since) and are
+removed, see `collect_garbage`. Asset handlers commonly skip unchanged files,
+their outputs are never collected: they remain in the manifest while they exist.
+"""
+from pathlib import Path
+from hashlib import sha256
+from typing import Dict, List, Optional, Set
+import threading
+import fnmatch
+import json
+import os
+import re
+from gadfly.atomic import write_atomic
+from gadfly.config import Config
+from gadfly.utils import file_sha256
+
+MANIFEST_VERSION = 1
+# the tracker whose outputs are collected as garbage, see `merge`
+PAGES_TRACKER = "pages"
+
+
+def manifest_path(cfg: Config) -> Path:
+    return cfg.cache_path / "manifest.json"
+
+
+def changes_path(cfg: Config) -> Path:
+    return cfg.cache_path / "changes.json"
+
+
+def tracker_path(cfg: Config, name: str) -> Path:
+    return cfg.cache_path / f"outputs-{name}.json"
+
+
+def _write_json(path: Path, data: dict) -> None:
+    write_atomic(path, json.dumps(data, indent=1, sort_keys=True).encode())
+
+
+class OutputTracker:
+    def __init__(self, cfg: Config, name: str):
+        """Record the output files written and removed by a process.
+
+        Thread-safe, compressed variants are written from a thread pool.
+
+        Args:
+            cfg: gadfly config
+            name: identifies the producing process, e.g. "pages" or "assets"
+        """
+        self._cfg = cfg
+        self._name = name
+        self._lock = threading.Lock()
+        # path relative to output dir => [sha256, size]
+        self._written: Dict[str, list] = {}
+        self._removed: Set[str] = set()
+        # deliberately left as is, e.g. when re-rendering the page failed
+        self._kept: Set[str] = set()
+
+    def _rel(self, path: Path) -> Optional[str]:
+        try:
+            return Path(path).relative_to(self._cfg.output_path).as_posix()
+        except ValueError:
+            # not an output file
+            return None
+
+    def written(self, path: Path, content: Optional[bytes] = None) -> None:
+        """Register that `path` was (re-)written, reads the file if `content` is not given."""
+        rel = self._rel(path)
+        if rel is None:
+            return
+        if content is not None:
+            entry = [sha256(content).hexdigest(), len(content)]
+        else:
+            try:
+                entry = [file_sha256(path), os.stat(path).st_size]
+            except FileNotFoundError:
+                return
+        with self._lock:
+            self._written[rel] = entry
+            self._removed.discard(rel)
+
+    def removed(self, path: Path) -> None:
+        rel = self._rel(path)
+        if rel is None:
+            return
+        with self._lock:
+            self._written.pop(rel, None)
+            self._removed.add(rel)
+
+    def kept(self, path: Path) -> None:
+        """Register that `path` is still an output, though it was not rewritten."""
+        rel = self._rel(path)
+        if rel is None:
+            return
+        with self._lock:
+            self._kept.add(rel)
+
+    def save(self) -> None:
+        """Add the records to the tracker file of the build, clearing them.
+
+        A process may save several times per build, e.g. when restarted."""
+        path = tracker_path(self._cfg, self._name)
+        with self._lock:
+            written, removed, kept = self._written, self._removed, self._kept
+            self._written, self._removed, self._kept = {}, set(), set()
+        try:
+            with open(path) as fh:
+                data = json.load(fh)
+        except (FileNotFoundError, ValueError):
+            data = {"written": {}, "removed": [], "kept": []}
+        prev_removed = set(data["removed"]) - written.keys()
+        data["written"] = {rel: entry for rel, entry in data["written"].items() if rel not in removed}
+        data["written"].update(written)
+        data["removed"] = sorted(prev_removed | removed)
+        data["kept"] = sorted(set(data["kept"]) | kept)
+        _write_json(path, data)
+
+
+def clear_trackers(cfg: Config, names: List[str]) -> None:
+    """Remove trackers of an earlier (possibly failed) build, see `merge`."""
+    for name in names:
+        tracker_path(cfg, name).unlink(missing_ok=True)
+
+
+def load(cfg: Config) -> Dict[str, dict]:
+    """Files of the manifest of the last build, empty if there is none."""
+    try:
+        with open(manifest_path(cfg)) as fh:
+            manifest = json.load(fh)
+    except (FileNotFoundError, ValueError):
+        return {}
+    if manifest.get("version") != MANIFEST_VERSION:
+        return {}
+    return manifest["files"]
+
+
+def collect_garbage(cfg: Config, orphans: List[str]) -> List[str]:
+    """Remove orphaned output files, i.e. files no longer produced by the build.
+
+    Files matching a `gc_keep` pattern are left alone. Directories left empty
+    are removed as well.
+
+    Returns:
+        the files removed (or found missing), relative to the output directory.
+    """
+    keep = [re.compile(fnmatch.translate(pattern)) for pattern in cfg.build.gc_keep]
+    removed = []
+    for rel in orphans:
+        if any(pattern.match(rel) for pattern in keep):
+            continue
+        fpath = cfg.output_path / rel
+        fpath.unlink(missing_ok=True)
+        removed.append(rel)
+        # e.g. the directory of a deleted page's index.html
+        parent = fpath.parent
+        while parent != cfg.output_path:
+            try:
+                parent.rmdir()
+            except OSError:
+                # not empty (or already gone)
+                break
+            parent = parent.parent
+    return removed
+
+
+def merge(cfg: Config, names: List[str], full: bool = True) -> Optional[Dict[str, List[str]]]:
+    """Merge the trackers of all processes of a build into the manifest.
+
+    Args:
+        cfg: gadfly config
+        names: names of the trackers of all processes of the build.
+        full: whether the build produced every output. Otherwise (builds of the
+              daemon) no files are collected as garbage, instead entries whose
+              file was deleted (e.g. with its page) are dropped.
+
+    Returns:
+        the changes (as written to changes.json), None if a tracker is missing,
+        i.e. a process did not finish, in which case nothing is written.
+    """
+    trackers = {}
+    for name in names:
+        try:
+            with open(tracker_path(cfg, name)) as fh:
+                trackers[name] = json.load(fh)
+        except FileNotFoundError:
+            return None
+    previous = load(cfg)
+    files = dict(previous)
+    for tracker in trackers.values():
+        for rel in tracker["removed"]:
+            files.pop(rel, None)
+    written: Set[str] = set()
+    for name, tracker in trackers.items():
+        for rel, (digest, size) in tracker["written"].items():
+            # a file belongs to the first tracker (in `names`) recording it
+            if rel not in written:
+                written.add(rel)
+                files[rel] = {"sha256": digest, "size": size, "by": name}
+
+    if not full:
+        for rel in [rel for rel in files if not (cfg.output_path / rel).exists()]:
+            files.pop(rel)
+    else:
+        produced = set(written)
+        for tracker in trackers.values():
+            produced.update(tracker["kept"])
+        orphans = [rel for rel, entry in files.items() if rel not in produced and entry.get("by") == PAGES_TRACKER]
+        if cfg.build.gc_outputs:
+            for rel in collect_garbage(cfg, orphans):
+                files.pop(rel)
+        # outputs of asset handlers are kept while they exist
+        for rel in [rel for rel in files if rel not in produced and not (cfg.output_path / rel).exists()]:
+            files.pop(rel)
+
+    changes = {
+        "added": sorted(rel for rel in files if rel not in previous),
+        "changed": sorted(rel for rel, entry in files.items()
+                          if rel in previous and previous[rel]["sha256"] != entry["sha256"]),
+        "removed": sorted(rel for rel in previous if rel not in files),
+    }
+    _write_json(manifest_path(cfg), {"version": MANIFEST_VERSION, "files": files})
+    _write_json(changes_path(cfg), changes)
+    clear_trackers(cfg, names)
+    return changes
@@ -0,0 +1,29 @@
+"""Peak memory usage of the build processes."""
+from typing import Optional
+import sys
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+
+def peak_rss(children: bool = False) -> Optional[int]:
+    """Peak resident set size in bytes, None if unknown on this platform.
+
+    Args:
+        children: if True, report the largest terminated (and waited for)
+                  child process instead of this process.
+    """
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+    # kilobytes on Linux, bytes on macOS
+    return usage.ru_maxrss if sys.platform == "darwin" else usage.ru_maxrss * 1024
+
+
+def fmt_bytes(n: Optional[int]) -> str:
+    if n is None:
+        return "n/a"
+    return f"{n / (1024 * 1024):.1f}MB"
@@ -0,0 +1,308 @@
+"""Metrics of `gadfly compile` builds, checked against the budgets of `[metrics]`.
+
+Each compile process records, in its `Recorder` (see `recorder`), the time
+spent in each stage of the build, the render time of each page and the hits
+and misses of gadfly's caches. Once done, a process saves these to
+`.gadfly/metrics-<name>.json`. After all processes are done, `record` folds
+them, along with the build's total time and the size of its outputs (from the
+manifest, see `gadfly.manifest`), into a build record:
+
+    .gadfly/builds/<n>.json: {"version": 1, "id": n, "finished": ..., "total_ms": ...,
+                              "pages": ..., "pages_per_s": ..., "stages_ms": {...},
+                              "slowest_pages": [[page, ms], ...], "peak_rss": {...},
+                              "caches": {name: {"hits": ..., "misses": ...}},
+                              "output": {...}, "over_budget": [...]}
+
+Builds are numbered in sequence, the latest `[metrics] keep` are kept.
+`gadfly metrics` lists them, shows one or compares two.
+"""
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+import heapq
+import json
+import threading
+import time
+from gadfly.config import Config
+from gadfly import cli
+
+METRICS_VERSION = 1
+
+# set by the compile processes of `gadfly compile`, nothing is recorded otherwise
+recorder: Optional["Recorder"] = None
+
+
+def part_path(cfg: Config, name: str) -> Path:
+    return cfg.cache_path / f"metrics-{name}.json"
+
+
+def builds_path(cfg: Config) -> Path:
+    return cfg.cache_path / "builds"
+
+
+class Recorder:
+    def __init__(self, cfg: Config, name: str):
+        """Metrics of a compile process.
+
+        Thread-safe, e.g. compressed variants are written from a thread pool.
+
+        Args:
+            cfg: gadfly config
+            name: identifies the process, e.g. "pages" or "assets"
+        """
+        self._cfg = cfg
+        self._name = name
+        self._lock = threading.Lock()
+        # stage => seconds
+        self._stages: Dict[str, float] = {}
+        # page name => seconds, of the latest render
+        self._pages: Dict[str, float] = {}
+        # cache => [hits, misses]
+        self._caches: Dict[str, List[int]] = {}
+
+    def stage(self, name: str, seconds: float) -> None:
+        with self._lock:
+            self._stages[name] = self._stages.get(name, 0.0) + seconds
+
+    def page(self, page_name: str, seconds: float) -> None:
+        with self._lock:
+            self._pages[page_name] = seconds
+
+    def cache(self, name: str, hit: bool) -> None:
+        with self._lock:
+            counts = self._caches.setdefault(name, [0, 0])
+            counts[0 if hit else 1] += 1
+
+    def save(self, peak_rss: Dict[str, Optional[int]]) -> None:
+        """Write the metrics for `record`.
+
+        Args:
+            peak_rss: peak memory of the process (and its workers), by label.
+        """
+        opts = self._cfg.metrics
+        with self._lock:
+            pages = dict(self._pages)
+            data = {
+                "stages_ms": {stage: _ms(seconds) for stage, seconds in self._stages.items()},
+                "caches": {cache: {"hits": hits, "misses": misses}
+                           for cache, (hits, misses) in self._caches.items()},
+            }
+        data["pages"] = len(pages)
+        data["slowest_pages"] = [[page, _page_ms(seconds)] for page, seconds in
+                                 heapq.nlargest(opts.slowest, pages.items(), key=lambda entry: entry[1])]
+        # every offending page, not just the slowest
+        limit = opts.budgets.max_page_ms
+        data["pages_over_budget"] = [] if limit is None else sorted(
+            [page, _page_ms(seconds)] for page, seconds in pages.items() if seconds * 1000 > limit)
+        data["peak_rss"] = {label: rss for label, rss in peak_rss.items() if rss is not None}
+        # imported here, avoids an import cycle through `gadfly.utils`
+        from gadfly import manifest
+        manifest._write_json(part_path(self._cfg, self._name), data)
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """Time the enclosed code as (part of) stage `name`."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        if recorder is not None:
+            recorder.stage(name, time.perf_counter() - started)
+
+
+def cache(name: str, hit: bool) -> None:
+    """Record a lookup in cache `name`, if recording."""
+    if recorder is not None:
+        recorder.cache(name, hit)
+
+
+def page(page_name: Path, seconds: float) -> None:
+    if recorder is not None:
+        recorder.page(page_name.as_posix(), seconds)
+
+
+def _ms(seconds: float) -> int:
+    return int(seconds * 1000)
+
+
+def _page_ms(seconds: float) -> float:
+    # pages take a few milliseconds
+    return round(seconds * 1000, 1)
+
+
+def clear_parts(cfg: Config, names: List[str]) -> None:
+    """Remove metrics of an earlier (possibly failed) build, see `record`."""
+    for name in names:
+        part_path(cfg, name).unlink(missing_ok=True)
+
+
+def _budgets(cfg: Config, build: dict) -> List[List[str]]:
+    """Budgets `build` exceeded, as [what, by how much] pairs."""
+    budgets = cfg.metrics.budgets
+    over = []
+    if budgets.max_build_ms is not None and build["total_ms"] > budgets.max_build_ms:
+        over.append(["build", f"{build['total_ms']}ms, budget {budgets.max_build_ms}ms"])
+    for name, limit in budgets.max_stage_ms.items():
+        spent = build["stages_ms"].get(name, 0)
+        if spent > limit:
+            over.append([f"stage {name}", f"{spent}ms, budget {limit}ms"])
+    for page_name, ms in build["pages_over_budget"]:
+        over.append([f"page {page_name}", f"{ms}ms, budget {budgets.max_page_ms}ms"])
+    if budgets.min_pages_per_s is not None and build["pages"] and build["pages_per_s"] < budgets.min_pages_per_s:
+        over.append(["pages/s", f"{build['pages_per_s']}, budget {budgets.min_pages_per_s}"])
+    peak = max(build["peak_rss"].values(), default=0)
+    if budgets.max_peak_rss_mb is not None and peak > budgets.max_peak_rss_mb * 1024 * 1024:
+        over.append(["peak memory", f"{peak // (1024 * 1024)}MB, budget {budgets.max_peak_rss_mb}MB"])
+    out_bytes = build["output"]["bytes"]
+    if budgets.max_output_mb is not None and out_bytes > budgets.max_output_mb * 1024 * 1024:
+        over.append(["output", f"{out_bytes // (1024 * 1024)}MB, budget {budgets.max_output_mb}MB"])
+    return over
+
+
+def record(cfg: Config, names: List[str], total_s: float, changes: Dict[str, List[str]]) -> Optional[dict]:
+    """Record the build from the metrics of its processes, checking it against the budgets.
+
+    Args:
+        cfg: gadfly config
+        names: names of the metrics of all processes of the build.
+        total_s: wall time of the build.
+        changes: of the build, see `manifest.merge`.
+
+    Returns:
+        the build record, None if the metrics of a process are missing.
+    """
+    from gadfly import manifest
+    parts = {}
+    for name in names:
+        try:
+            with open(part_path(cfg, name)) as fh:
+                parts[name] = json.load(fh)
+        except (FileNotFoundError, ValueError):
+            return None
+    stages: Dict[str, int] = {}
+    caches: Dict[str, Dict[str, int]] = {}
+    slowest = []
+    over_budget = []
+    peak_rss = {}
+    pages = 0
+    for name, part in parts.items():
+        for stage_name, ms in part["stages_ms"].items():
+            stages[stage_name] = stages.get(stage_name, 0) + ms
+        for cache_name, counts in part["caches"].items():
+            total = caches.setdefault(cache_name, {"hits": 0, "misses": 0})
+            total["hits"] += counts["hits"]
+            total["misses"] += counts["misses"]
+        slowest.extend(part["slowest_pages"])
+        over_budget.extend(part["pages_over_budget"])
+        peak_rss.update({f"{name}/{label}" if label != "process" else name: rss
+                         for label, rss in part["peak_rss"].items()})
+        pages += part["pages"]
+
+    files = manifest.load(cfg)
+    written = set(changes["added"]) | set(changes["changed"])
+    total_ms = _ms(total_s)
+    build = {
+        "version": METRICS_VERSION,
+        "finished": time.time(),
+        "total_ms": total_ms,
+        "pages": pages,
+        "pages_per_s": round(pages / total_s, 1) if total_s > 0 else 0,
+        "stages_ms": dict(sorted(stages.items())),
+        "slowest_pages": sorted(slowest, key=lambda entry: -entry[1])[:cfg.metrics.slowest],
+        "pages_over_budget": sorted(over_budget),
+        "peak_rss": peak_rss,
+        "caches": {name: {**counts, "hit_rate": round(counts["hits"] / max(1, counts["hits"] + counts["misses"]), 3)}
+                   for name, counts in sorted(caches.items())},
+        "output": {
+            "files": len(files),
+            "bytes": sum(entry["size"] for entry in files.values()),
+            "written_bytes": sum(files[rel]["size"] for rel in written if rel in files),
+            **{kind: len(changed) for kind, changed in changes.items()},
+        },
+    }
+    build["over_budget"] = _budgets(cfg, build)
+
+    builds_dir = builds_path(cfg)
+    recorded = _build_ids(cfg)
+    build["id"] = recorded[-1] + 1 if recorded else 1
+    manifest._write_json(builds_dir / f"{build['id']}.json", build)
+    for build_id in recorded[:max(0, len(recorded) + 1 - cfg.metrics.keep)]:
+        (builds_dir / f"{build_id}.json").unlink(missing_ok=True)
+    clear_parts(cfg, names)
+    return build
+
+
+def _build_ids(cfg: Config) -> List[int]:
+    return sorted(int(fpath.stem) for fpath in builds_path(cfg).glob("*.json") if fpath.stem.isdigit())
+
+
+def load(cfg: Config, build_id: str) -> dict:
+    """Build record `build_id`, "latest" for the latest build.
+
+    Raises:
+        KeyError: no such build was recorded (or it was pruned since).
+    """
+    if build_id == "latest":
+        recorded = _build_ids(cfg)
+        if not recorded:
+            raise KeyError(build_id)
+        build_id = str(recorded[-1])
+    try:
+        with open(builds_path(cfg) / f"{int(build_id)}.json") as fh:
+            return json.load(fh)
+    except (FileNotFoundError, ValueError):
+        raise KeyError(build_id)
+
+
+def report(build: dict) -> None:
+    """Summary of a build, along with any budget it exceeded."""
+    caches = ", ".join(f"{name} {counts['hit_rate']:.0%}" for name, counts in build["caches"].items())
+    cli.info(f"build #{build['id']}: {build['total_ms']}ms, {build['pages']} pages ({build['pages_per_s']}/s)"
+             + (f", cache hits: {caches}" if caches else ""))
+    if build["over_budget"]:
+        cli.pp_err_details("build over budget", dict(build["over_budget"]))
+
+
+def list_builds(cfg: Config) -> None:
+    for build_id in _build_ids(cfg):
+        build = load(cfg, str(build_id))
+        finished = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(build["finished"]))
+        status = f"{len(build['over_budget'])} over budget" if build["over_budget"] else "ok"
+        print(f"#{build_id:<5} {finished}  {build['total_ms']:>8}ms  {build['pages']:>7} pages  "
+              f"{build['pages_per_s']:>8}/s  {status}")
+
+
+def _delta(old: float, new: float) -> str:
+    if not old:
+        return ""
+    return f" ({(new - old) / old:+.0%})"
+
+
+def compare(old: dict, new: dict) -> None:
+    """Print the differences between two build records."""
+    rows: List[Tuple[str, float, float]] = [
+        ("total ms", old["total_ms"], new["total_ms"]),
+        ("pages", old["pages"], new["pages"]),
+        ("pages/s", old["pages_per_s"], new["pages_per_s"]),
+        ("output bytes", old["output"]["bytes"], new["output"]["bytes"]),
+        ("written bytes", old["output"]["written_bytes"], new["output"]["written_bytes"]),
+    ]
+    for stage_name in sorted(old["stages_ms"].keys() | new["stages_ms"].keys()):
+        rows.append((f"stage {stage_name} ms", old["stages_ms"].get(stage_name, 0),
+                     new["stages_ms"].get(stage_name, 0)))
+    for label in sorted(old["peak_rss"].keys() | new["peak_rss"].keys()):
+        rows.append((f"peak rss {label} MB", round(old["peak_rss"].get(label, 0) / (1024 * 1024), 1),
+                     round(new["peak_rss"].get(label, 0) / (1024 * 1024), 1)))
+    for cache_name in sorted(old["caches"].keys() | new["caches"].keys()):
+        rows.append((f"cache {cache_name} hit rate", old["caches"].get(cache_name, {}).get("hit_rate", 0),
+                     new["caches"].get(cache_name, {}).get("hit_rate", 0)))
+    print(f"{'':<28}{'#' + str(old['id']):>14}{'#' + str(new['id']):>14}")
+    for label, old_val, new_val in rows:
+        print(f"{label:<28}{old_val:>14}{new_val:>14}{_delta(old_val, new_val)}")
+
+    old_pages = dict(old["slowest_pages"])
+    print("slowest pages:")
+    for page_name, ms in new["slowest_pages"]:
+        before = old_pages.get(page_name)
+        print(f"  {page_name}: {ms}ms" + (f", was {before}ms{_delta(before, ms)}" if before is not None else ""))
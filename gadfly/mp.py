@@ -1,32 +1,114 @@
 import multiprocessing as mp
-from multiprocessing.connection import wait as mp_wait
 from multiprocessing.process import BaseProcess
 from multiprocessing.context import BaseContext
 import importlib
-from typing import Callable, Tuple, Dict, List, cast
-from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler, FileSystemEvent, FileSystemMovedEvent
+from typing import Callable, Tuple, Dict, List, Sequence, cast
 from gadfly.utils import *
 from gadfly import config
-from gadfly import compiler
+from gadfly import context_cache
+from gadfly import deps
+from gadfly import metrics
+from gadfly.output import Outputs
+from gadfly.page_md import PageMetadataStore
+from gadfly.memory import peak_rss, fmt_bytes
 from gadfly.assets.errors import *
 from gadfly.assets.ctx import AssetCtx
 from gadfly import cli
-from gadfly.cli import colors
 from gadfly.page_hooks_api import *
 from queue import Empty as QueueEmpty
 from dataclasses import dataclass
+import dataclasses
 import time
 
 
 class EventType:
     CONTEXT_CHANGED = "context_changed"
     PAGE_CHANGED = "page_changed"
+    # a page, or a directory of pages, was deleted (or moved away)
+    PAGE_DELETED = "page_deleted"
     TEMPLATE_CHANGED = "template_changed"
     ASSET_CHANGED = "asset_changed"
+    # asset compiler => page compiler: files written by an asset handler (and
+    # the changed source file), pages referencing them are re-rendered.
+    ASSET_OUTPUT_CHANGED = "asset_output_changed"
+    # dev server => page compiler: pages currently viewed in a browser
+    PAGES_VIEWED = "pages_viewed"
+    # page compiler => dev server: reload browsers viewing the given pages,
+    # or a request to (re-)send PAGES_VIEWED if no payload is given.
+    RELOAD = "reload"
+    # build daemon => asset compiler => page compiler: marks the end of a
+    # build's events, answered by FLUSHED once all preceding events are processed.
+    FLUSH = "flush"
+    FLUSHED = "flushed"
     STOP = "stop"
 
 
+class ChangeSet:
+    def __init__(self, action: str = EventType.PAGE_CHANGED):
+        """Events to process, merged into the most far-reaching action they require.
+
+        Events arriving after a STOP event are ignored."""
+        self.action = action
+        self.pages: List[str] = []
+        # pages, or directories of pages, deleted
+        self.deleted: List[str] = []
+        # files reported by ASSET_OUTPUT_CHANGED events
+        self.asset_files: List[str] = []
+        # latest report of the pages viewed in a browser, if any arrived
+        self.viewed: Optional[List[str]] = None
+        # time (`time.time()`) the earliest of the file changes was detected
+        self.since: Optional[float] = None
+        # FLUSH events, to answer once the changes are processed
+        self.flush: List[dict] = []
+        self.stop = False
+
+    def empty(self) -> bool:
+        return (self.action == EventType.PAGE_CHANGED and not self.pages and not self.deleted
+                and not self.asset_files and not self.flush and not self.stop)
+
+    def add(self, event: dict) -> None:
+        if self.stop:
+            return
+        ts = event.get("ts")
+        if ts is not None and (self.since is None or ts < self.since):
+            self.since = ts
+        if event["type"] == EventType.PAGE_CHANGED:
+            if event["payload"]["page"] not in self.pages:
+                self.pages.append(event["payload"]["page"])
+        elif event["type"] == EventType.PAGE_DELETED:
+            path = Path(event["payload"]["page"])
+            self.pages = [page for page in self.pages if page != str(path) and path not in Path(page).parents]
+            # a directory move is also reported for each file moved along
+            if not any(page == str(path) or Path(page) in path.parents for page in self.deleted):
+                self.deleted = [page for page in self.deleted if path not in Path(page).parents]
+                self.deleted.append(str(path))
+        elif event["type"] == EventType.CONTEXT_CHANGED:
+            self.action = EventType.CONTEXT_CHANGED
+        elif event["type"] == EventType.TEMPLATE_CHANGED and self.action == EventType.PAGE_CHANGED:
+            self.action = EventType.TEMPLATE_CHANGED
+        elif event["type"] == EventType.ASSET_OUTPUT_CHANGED:
+            self.asset_files.extend(f for f in event["payload"]["files"] if f not in self.asset_files)
+        elif event["type"] == EventType.PAGES_VIEWED:
+            self.viewed = event["payload"]["pages"]
+        elif event["type"] == EventType.FLUSH:
+            self.flush.append(event)
+        elif event["type"] == EventType.STOP:
+            self.stop = True
+
+    def drain(self, queue: mp.Queue) -> None:
+        """Add events until the queue is empty or a STOP event is received."""
+        try:
+            while not self.stop:
+                # will immediately raise queue.Empty iff. queue is empty
+                self.add(queue.get(block=False))
+        except QueueEmpty:
+            pass
+
+
+# names of the `Outputs` of the page and asset processes
+OUTPUT_TRACKERS = ["pages", "assets"]
+
+
 class StopQueueType:
     EXCEPTION = "exception"
 
@@ -54,95 +136,6 @@ class ConsumerProcess:
         self.input_queue.put({"type": EventType.STOP})
 
 
-class BaseEventHandler(FileSystemEventHandler):
-    def __init__(self, queue: mp.Queue):
-        self._db = {}
-        self._queue = queue
-
-    def hash_db_clear(self, fpath: str):
-        del self._db[fpath]
-
-    def hash_db_set(self, fpath: str):
-        """Forcefully set entry's hash.
-        NOTE: do not use if already calling `is_file_changed`."""
-        self._db[fpath] = file_sha256(fpath)
-
-    def hash_db_update(self, fpath) -> bool:
-        old_hash = self._db.get(fpath)
-        new_hash = file_sha256(fpath)
-        if old_hash != new_hash:
-            self._db[fpath] = new_hash
-            return True
-        return False
-
-    def send_event(self, event_type: str, payload: dict) -> None:
-        self._queue.put({"type": event_type, "payload": payload})
-
-
-class PageHandler(BaseEventHandler):
-    def on_deleted(self, event: FileSystemEvent):
-        """Delete corresponding compiled page"""
-        if not is_page(event):
-            return
-        outpath = output_path(config.config, Path(event.src_path))
-        delete_output(outpath)
-        self.hash_db_clear(event.src_path)
-
-    def on_moved(self, event: FileSystemMovedEvent):
-        """Trigger delete"""
-        if not is_page(event):
-            return
-        delete_output(output_path(
-            config.config,
-            Path(event.src_path)
-        ))
-        self.hash_db_clear(event.src_path)
-        self.hash_db_update(event.dest_path)  # run for side-effects - updates hash entry
-        self.send_event(EventType.PAGE_CHANGED, {"page": event.dest_path})
-
-    def on_modified(self, event: FileSystemEvent):
-        if not is_page(event):
-            return
-        if self.hash_db_update(event.src_path):
-            self.send_event(EventType.PAGE_CHANGED, {"page": event.src_path})
-
-
-class ContextCodeHandler(BaseEventHandler):
-    def on_modified(self, event: FileSystemEvent):
-        if event.is_directory or not event.src_path.endswith(".py"):
-            return
-        if not self.hash_db_update(event.src_path):
-            return
-        self.send_event(EventType.CONTEXT_CHANGED, {})
-
-
-class TemplateEventHandler(BaseEventHandler):
-    def on_modified(self, event: FileSystemEvent):
-        if event.is_directory:
-            return
-        self.send_event(EventType.TEMPLATE_CHANGED, {})
-
-
-class AssetEventHandler(BaseEventHandler):
-    def __init__(self, queue: mp.Queue, asset_name: str, asset_opts: dict):
-        super().__init__(queue)
-        self.asset_name = asset_name
-        # no validation here, validation happens at the point of reading in
-        # the configuration files.
-        self.asset_opts = asset_opts
-
-    def on_modified(self, event: FileSystemEvent):
-        if event.is_directory:
-            return
-        if not self.hash_db_update(event.src_path):
-            return
-        self.send_event(EventType.ASSET_CHANGED, {
-            "file": event.src_path,
-            "asset_name": self.asset_name,
-            "asset_opts": self.asset_opts,
-        })
-
-
 def get_code_hook(cfg: config.Config, hook_name: str) -> Optional[Callable]:
     mod = importlib.import_module(cfg.code.module)
     if not hasattr(mod, hook_name):
@@ -172,8 +165,17 @@ def _eval_context(cfg: config.Config) -> dict:
              "module file": cfg.code.module_path,
              "hook": cfg.code.context_hook})
         raise ConsumerProcessFatalError
+    key = None
+    if cfg.code.context_cache:
+        key = context_cache.snapshot_key(cfg)
+        if not cfg.bypass_context_cache:
+            context = context_cache.load(cfg, key)
+            metrics.cache("context", context is not None)
+            if context is not None:
+                cli.info("context loaded from snapshot")
+                return context
     try:
-        return hook(cfg)
+        context = hook(cfg)
     except Exception:
         cli.pp_exc()
         cli.pp_err_details(
@@ -182,6 +184,10 @@ def _eval_context(cfg: config.Config) -> dict:
              "module file": cfg.code.module_path,
              "hook": cfg.code.context_hook}
         )
+        return None
+    if key is not None:
+        context_cache.store(cfg, key, context)
+    return context
 
 
 def page_pre_compile_noop(page_path: Path, config: config.Config, extra_vars: Dict) -> bool:
@@ -192,70 +198,204 @@ def page_post_compile_noop(page_path: Path, config: config.Config, page_content:
     return page_content
 
 
-def _compile_process_inner(queue: mp.Queue, stop_queue: mp.Queue, cfg: config.Config) -> None:
+def _compile_process_inner(queue: mp.Queue, stop_queue: mp.Queue, cfg: config.Config,
+                           reload_queue: Optional[mp.Queue]) -> None:
+    # imported here, the templating engine is only needed by the page compiler process
+    from gadfly import compiler
+    from gadfly.transforms import TransformPipeline, TransformError
+    from gadfly.workers import LazyPool
+    from gadfly.search import SearchIndex
+    from gadfly.links import LinkChecker, report as report_links
+    from gadfly.pages import PageIndex
+
     # this globally assigned variable is not set in the new process.
     config.config = cfg
+    if cfg.build.low_memory:
+        cfg.page_md = PageMetadataStore()
+    if reload_queue is not None:
+        # watch mode and the build daemon, a one-off compile gets no ASSET_OUTPUT_CHANGED events
+        deps.tracker = deps.AssetDependencies(cfg)
+    if cfg.record_metrics:
+        metrics.recorder = metrics.Recorder(cfg, "pages")
+    if reload_queue is not None:
+        # a restarted process has lost track of the viewed pages, ask the dev
+        # server while the context is computed.
+        reload_queue.put({"type": EventType.RELOAD})
     # (re-)compute context, done once for duration of the compile-process' lifetime.
-    cfg.context = _eval_context(cfg)
+    with metrics.stage("context"):
+        cfg.context = _eval_context(cfg)
     post_compile_hook = get_code_hook(cfg, cfg.code.post_compile_hook) or (lambda *args, **kwargs: None)
     page_pre_compile_hook: PagePreCompileHookFn = \
         cast(PagePreCompileHookFn, get_code_hook(cfg, cfg.code.page_pre_compile_hook)) or page_pre_compile_noop
     page_post_compile_hook: PagePostCompileHookFn = \
         cast(PagePostCompileHookFn, get_code_hook(cfg, cfg.code.page_post_compile_hook)) or page_post_compile_noop
+    page_post_compile_stream_hook = cast(Optional[PagePostCompileStreamHookFn],
+                                         get_code_hook(cfg, cfg.code.page_post_compile_stream_hook))
+    stream = cfg.build.stream_pages
+    if stream and cfg.transforms:
+        cli.info("stream_pages: output transforms need the whole page, rendering pages in memory")
+        stream = False
+    elif stream and page_post_compile_hook is not page_post_compile_noop and page_post_compile_stream_hook is None:
+        cli.info(f"stream_pages: '{cfg.code.page_post_compile_hook}' needs the whole page, rendering pages in memory "
+                 f"(define '{cfg.code.page_post_compile_stream_hook}' to post-process streamed pages)")
+        stream = False
 
     # initialize templating engine instance
     env = compiler.Environment(config=cfg)
+    pool = LazyPool(cfg)
+    page_index = PageIndex(cfg)
+    links = LinkChecker(cfg, pool, page_index) if cfg.links.check else None
+    outputs = Outputs(cfg, "pages", on_written=links.written if links is not None else None)
+    search = SearchIndex(cfg, outputs) if cfg.search.enabled else None
+    try:
+        transforms = TransformPipeline(cfg, pool)
+    except TransformError as e:
+        cli.pp_exc()
+        cli.pp_err_details(str(e), {
+            "transform": e.transform.name,
+            "fn": e.transform.fn,
+        })
+        raise ConsumerProcessFatalError
 
-    def render_generated_page(page: str, template: str, context: dict) -> None:
-        compiler.render_generated_page(Path(page), template, cfg, env, context)
-
-    # render all pages using the newly computed context.
-    compiler.render_all(cfg, env, page_pre_compile_hook, page_post_compile_hook)
-    post_compile_hook(cfg, render_generated_page)
-
-    while True:
-        event = queue.get(block=True)
-        # Continue extracting events until queue empty OR STOP event received.
-        # determine most far-reaching action based on event types.
-        # If PAGE_CHAGED: recompile the page(s) affected
-        # If TEMPLATE_CHANGED: recompile all pages
-        # If CONTEXT_CHANGED: restart process (to recompute context), then recompile all pages
-        action: str = EventType.PAGE_CHANGED
-        pages = []
-        try:
-            while True:
-                if event["type"] == EventType.PAGE_CHANGED:
-                    pages.append(event["payload"]["page"])
-                elif event["type"] == EventType.CONTEXT_CHANGED:
-                    action = EventType.CONTEXT_CHANGED
-                elif event["type"] == EventType.TEMPLATE_CHANGED and action == EventType.PAGE_CHANGED:
-                    action = EventType.TEMPLATE_CHANGED
-                elif event["type"] == EventType.STOP:
-                    break
-                # will immediately raise queue.Empty iff. queue is empty
-                event = queue.get(block=False)
-        except QueueEmpty:
-            pass
-        if action == EventType.PAGE_CHANGED:
-            for page in pages:
-                compiler.render(cfg, env, Path(page), page_pre_compile_hook, page_post_compile_hook)
-            post_compile_hook(cfg, render_generated_page)
-        elif action == EventType.TEMPLATE_CHANGED:
-            compiler.render_all(cfg, env, page_pre_compile_hook, page_post_compile_hook)
-            post_compile_hook(cfg, render_generated_page)
-        elif action == EventType.CONTEXT_CHANGED:
-            return
-        else:
-            raise RuntimeError("unknown action")
-
-        if event["type"] == EventType.STOP:
-            stop_queue.put(0)
-            return
-
+    def shutdown() -> None:
+        transforms.close()
+        pool.shutdown()
+        outputs.close()
 
-def _compile_process(queue: mp.Queue, stop_queue: mp.Queue, cfg: config.Config) -> None:
     try:
-        _compile_process_inner(queue, stop_queue, cfg)
+        with metrics.stage("scan"):
+            page_index.scan()
+        rctx = compiler.RenderCtx(
+            config=cfg, env=env,
+            page_pre_compile_hook=page_pre_compile_hook, page_post_compile_hook=page_post_compile_hook,
+            outputs=outputs, transforms=transforms, pool=pool, pages=page_index,
+            stream=stream, page_post_compile_stream_hook=page_post_compile_stream_hook,
+            search=search, links=links)
+
+        generated = compiler.GeneratedPages(rctx)
+
+        def generate_pages() -> None:
+            with metrics.stage("generated"):
+                try:
+                    post_compile_hook(cfg, generated)
+                finally:
+                    # pages submitted by the hook
+                    generated.wait()
+
+        def reload(pages: Optional[List[str]] = None, skip: Sequence[str] = ()) -> None:
+            # reload browsers viewing `pages` (all if None), except those viewing a page in `skip`
+            if reload_queue is not None:
+                reload_queue.put({"type": EventType.RELOAD, "payload": {"pages": pages, "skip": list(skip)}})
+
+        # pages viewed in a browser (watch mode), rendered before all others
+        viewed: List[str] = []
+        # start by rendering all pages using the newly computed context.
+        changes = ChangeSet(action=EventType.TEMPLATE_CHANGED)
+        while True:
+            if changes.empty():
+                changes.add(queue.get(block=True))
+            changes.drain(queue)
+            # If PAGE_CHANGED: recompile the page(s) affected
+            # If TEMPLATE_CHANGED: recompile all pages
+            # If CONTEXT_CHANGED: restart process (to recompute context), then recompile all pages
+            current, changes = changes, ChangeSet()
+            if current.viewed is not None:
+                viewed = current.viewed
+            if current.action != EventType.CONTEXT_CHANGED:
+                for page in current.deleted:
+                    for entry in page_index.remove(Path(page)):
+                        compiler.delete_page(rctx, entry)
+            # pages rendered against an older version of a file the asset compiler wrote
+            if deps.tracker is not None:
+                for page in deps.tracker.affected(current.asset_files):
+                    if page not in current.pages:
+                        current.pages.append(page)
+            if links is not None:
+                links.files_changed(current.asset_files)
+
+            def superseded() -> bool:
+                # collect events arriving during the build, abort the build if they require a new one.
+                changes.drain(queue)
+                return changes.action != EventType.PAGE_CHANGED
+
+            # render pages viewed in a browser first (of those to render), then
+            # the pages which triggered the rebuild. Reload browsers as soon as
+            # these are done.
+            priority = list(dict.fromkeys([
+                *(p for p in viewed if current.action != EventType.PAGE_CHANGED or p in current.pages),
+                *current.pages]))
+            reloaded: List[str] = []
+
+            def priority_done() -> None:
+                reloaded.extend(priority)
+                outputs.flush()
+                reload(reloaded)
+
+            if current.action == EventType.PAGE_CHANGED:
+                for page in priority:
+                    compiler.render(rctx, Path(page))
+                transforms.wait()
+                if priority:
+                    priority_done()
+                if priority or current.deleted:
+                    generate_pages()
+            elif current.action == EventType.TEMPLATE_CHANGED:
+                if not compiler.render_all(rctx, superseded, [Path(p) for p in priority], priority_done):
+                    cli.info("newer changes arrived, abandoning rebuild")
+                    outputs.flush()
+                    changes.stop = changes.stop or current.stop
+                    changes.flush[:0] = current.flush
+                    continue
+                generate_pages()
+            elif current.action == EventType.CONTEXT_CHANGED:
+                shutdown()
+                # processed by the restarted process, answered after rendering all pages
+                for page in current.deleted:
+                    queue.put({"type": EventType.PAGE_DELETED, "payload": {"page": page}})
+                for event in current.flush:
+                    queue.put(event)
+                return
+            else:
+                raise RuntimeError("unknown action")
+            if search is not None:
+                with metrics.stage("search"):
+                    search.save()
+            if links is not None and (cfg.dev_mode or current.stop or current.flush):
+                # one-off builds check once all pages and assets are written
+                with metrics.stage("links"):
+                    broken = links.check()
+                report_links(cfg, broken)
+            with metrics.stage("compress"):
+                outputs.flush()
+            if current.action != EventType.PAGE_CHANGED or current.pages or current.deleted:
+                reload(skip=reloaded)
+                if current.since is not None:
+                    cli.info(f"pages rebuilt {_ms_since(current.since)}ms after the change")
+            if current.flush:
+                outputs.flush()
+                outputs.checkpoint()
+                for event in current.flush:
+                    reload_queue.put({"type": EventType.FLUSHED, "payload": {**event["payload"], "name": "pages"}})
+
+            if current.stop:
+                shutdown()
+                # workers count once terminated, i.e. after shutdown
+                workers_rss = peak_rss(children=True) if pool.started else None
+                cli.info(f"peak memory: page compiler {fmt_bytes(peak_rss())}"
+                         + (f", largest worker {fmt_bytes(workers_rss)}" if workers_rss else ""))
+                if metrics.recorder is not None:
+                    metrics.recorder.save({"process": peak_rss(), "workers": workers_rss})
+                stop_queue.put(0)
+                return
+    finally:
+        # also on unexpected errors, a running pool keeps the process from exiting
+        shutdown()
+
+
+def _compile_process(queue: mp.Queue, stop_queue: mp.Queue, cfg: config.Config,
+                     reload_queue: Optional[mp.Queue] = None) -> None:
+    try:
+        _compile_process_inner(queue, stop_queue, cfg, reload_queue)
     except ConsumerProcessFatalError:
         stop_queue.put(1)
     except KeyboardInterrupt:
@@ -263,10 +403,24 @@ def _compile_process(queue: mp.Queue, stop_queue: mp.Queue, cfg: config.Config)
         pass
 
 
-def _exec_asset_handler(handler: Callable, asset_name: str, ctx: AssetCtx) -> None:
+def _ms_since(ts: float) -> int:
+    return int((time.time() - ts) * 1000)
+
+
+def _exec_asset_handler(handler: Callable, asset_name: str, ctx: AssetCtx, outputs: Outputs) -> List[Path]:
+    """Run asset handler, returns the output files it wrote.
+
+    These are the files the handler reported (see `AssetCtx.written`) and those
+    it created or modified below the asset's `out` directory (defaults to the
+    asset's name, "." for the whole output directory)."""
     cli.info(f"running asset {asset_name} handler")
+    cfg = ctx.config
+    out_dir = cfg.output_path / ctx.asset_opts.get("out", asset_name).strip("/")
+    reported: List[Path] = []
+    ctx = dataclasses.replace(ctx, on_written=reported.append)
+    started = outputs.start_external(out_dir)
     try:
-        with cwd(ctx.config.project_root):
+        with cwd(cfg.project_root), metrics.stage(f"assets:{asset_name}"):
             handler(ctx)
     except Exception:
         cli.pp_exc()
@@ -274,9 +428,16 @@ def _exec_asset_handler(handler: Callable, asset_name: str, ctx: AssetCtx) -> No
             "error executing handler function", {}
         )
         raise ConsumerProcessFatalError
+    written = outputs.end_external(started)
+    for fpath in dict.fromkeys(cfg.output_path / fpath for fpath in reported):
+        if fpath not in written:
+            outputs.written(fpath)
+            written.append(fpath)
+    return written
 
 
-def _asset_compile_process_inner(queue: mp.Queue, cfg: config.Config) -> None:
+def _asset_compile_process_inner(queue: mp.Queue, cfg: config.Config, reload_queue: Optional[mp.Queue],
+                                 page_queue: Optional[mp.Queue]) -> None:
     handlers = {}
     # TODO: handle changes IN handlers.. (reload this process)
     # For each handler, import and resolve its handler function
@@ -300,10 +461,27 @@ def _asset_compile_process_inner(queue: mp.Queue, cfg: config.Config) -> None:
             )
         handlers[asset_name] = handler
 
+    def outputs_changed(files: List[Path], ts: Optional[float] = None) -> None:
+        # pages referencing these are re-rendered, see `gadfly.deps`
+        if page_queue is not None and files:
+            event = {"type": EventType.ASSET_OUTPUT_CHANGED, "payload": {"files": [str(f) for f in files]}}
+            if ts is not None:
+                event["ts"] = ts
+            page_queue.put(event)
+
+    if cfg.record_metrics:
+        metrics.recorder = metrics.Recorder(cfg, "assets")
+    outputs = Outputs(cfg, "assets")
     # trigger a once-over compile
+    written = []
     for asset_name, handler in handlers.items():
-        ctx = AssetCtx(config=cfg, asset_dir=cfg.assets[asset_name]["dir"], dev_mode=cfg.dev_mode)
-        _exec_asset_handler(handler, asset_name, ctx)
+        ctx = AssetCtx(config=cfg, asset_dir=cfg.assets[asset_name]["dir"], dev_mode=cfg.dev_mode,
+                       asset_name=asset_name, asset_opts=cfg.assets[asset_name], on_kept=outputs.kept)
+        written.extend(_exec_asset_handler(handler, asset_name, ctx, outputs))
+    with metrics.stage("compress"):
+        outputs.flush()
+    # pages rendered before their assets were written
+    outputs_changed(written)
     while True:
         event = queue.get(block=True)
         action = event["type"]
@@ -311,16 +489,37 @@ def _asset_compile_process_inner(queue: mp.Queue, cfg: config.Config) -> None:
             asset_name = event["payload"]["asset_name"]
             handler = handlers[asset_name]
             opts = event["payload"]["asset_opts"]
+            # no file: re-run the handler over the whole directory
+            file = event["payload"].get("file")
             ctx = AssetCtx(config=cfg, asset_dir=opts["dir"],
-                           file=Path(event["payload"]["file"]), dev_mode=cfg.dev_mode)
-            _exec_asset_handler(handler, asset_name, ctx)
+                           file=Path(file) if file is not None else None, dev_mode=cfg.dev_mode,
+                           asset_name=asset_name, asset_opts=opts, on_kept=outputs.kept)
+            written = _exec_asset_handler(handler, asset_name, ctx, outputs)
+            outputs.flush()
+            outputs_changed([*written, *([ctx.file] if ctx.file is not None else [])], event.get("ts"))
+            if "ts" in event:
+                cli.info(f"asset {asset_name} rebuilt {_ms_since(event['ts'])}ms after the change")
+            if reload_queue is not None and written:
+                # browsers reload just the stylesheets if given the path of one
+                changed = next((fpath for fpath in written if fpath.suffix == ".css"), written[0])
+                reload_queue.put({"type": EventType.RELOAD, "payload": {
+                    "pages": None, "skip": [], "path": changed.relative_to(cfg.output_path).as_posix()}})
+        elif action == EventType.FLUSH:
+            outputs.checkpoint()
+            # after any ASSET_OUTPUT_CHANGED events sent, the page compiler answers once these are processed
+            page_queue.put({"type": EventType.FLUSH, "payload": {**event["payload"], "source": "assets"}})
+            reload_queue.put({"type": EventType.FLUSHED, "payload": {**event["payload"], "name": "assets"}})
         elif action == EventType.STOP:
+            outputs.close()
+            if metrics.recorder is not None:
+                metrics.recorder.save({"process": peak_rss()})
             return
 
 
-def _asset_compile_process(queue: mp.Queue, stop_queue: mp.Queue, cfg: config.Config) -> None:
+def _asset_compile_process(queue: mp.Queue, stop_queue: mp.Queue, cfg: config.Config,
+                           reload_queue: Optional[mp.Queue] = None, page_queue: Optional[mp.Queue] = None) -> None:
     try:
-        _asset_compile_process_inner(queue, cfg)
+        _asset_compile_process_inner(queue, cfg, reload_queue, page_queue)
     except KeyboardInterrupt:
         pass
     except ConsumerProcessFatalError:
@@ -358,42 +557,46 @@ def _asset_compile_process(queue: mp.Queue, stop_queue: mp.Queue, cfg: config.Co
         stop_queue.put(1)
 
 
-def compile_watch(cfg: config.Config) -> None:
+def compile_watch(cfg: config.Config, serve_port: Optional[int] = None) -> None:
+    """Compile, then recompile on changes.
+
+    Args:
+        cfg: the configuration
+        serve_port: if set, serve the output directory on this port, with live-reload.
+    """
     if not isinstance(cfg, config.Config):
         raise RuntimeError(f"expected Config, got {type(cfg)}")
+    # imported here, only needed in watch mode
+    import asyncio
+    asyncio.run(_compile_watch(cfg, serve_port))
+
+
+async def _compile_watch(cfg: config.Config, serve_port: Optional[int]) -> None:
+    # imported here, only needed in watch mode
+    import asyncio
+    from gadfly.supervisor import Supervisor, EventForwarder
+    from gadfly.watch import schedule_watches
+
+    loop = asyncio.get_running_loop()
     ctx = mp.get_context("spawn")
     page_queue = ctx.Queue()
     asset_queue = ctx.Queue()
+    reload_queue = ctx.Queue() if serve_port is not None else None
+    stop_queue = ctx.Queue()
+    # watchers send their events through the supervisor's loop, see `EventForwarder`
+    debounce = cfg.watch.debounce_ms / 1000
+    page_events = EventForwarder(loop, page_queue, debounce)
+    asset_events = EventForwarder(loop, asset_queue, debounce)
 
-    observer = Observer()
-    observer.schedule(
-        PageHandler(page_queue),
-        str(cfg.pages_path.absolute()),
-        recursive=True
-    )
-    observer.schedule(
-        ContextCodeHandler(page_queue),
-        str(cfg.code.module_path),
-        recursive=True
-    )
-    observer.schedule(
-        TemplateEventHandler(page_queue),
-        str(cfg.templates_path.absolute()),
-        recursive=True
-    )
-    for asset_name, asset_opts in cfg.assets.items():
-        print(f"""{colors.B_MAGENTA}> {colors.B_WHITE}asset watcher {colors.B_MAGENTA}{asset_name}{colors.B_WHITE} (dir: {colors.B_MAGENTA}{asset_opts["dir"]}{colors.B_WHITE})""")
-        observer.schedule(
-            AssetEventHandler(asset_queue, asset_name, asset_opts),
-            str(asset_opts["dir"]),
-            recursive=True
-        )
-    observer.start()
+    if cfg.watch.backend == "poll":
+        from gadfly.poll import PollingObserver
+        observer = PollingObserver(cfg.watch.poll_interval_ms / 1000)
+    else:
+        from watchdog.observers import Observer
+        observer = Observer()
+
+    schedule_watches(cfg, observer, page_events, asset_events)
 
-    stop_queue = ctx.Queue()
-    p_handles: Dict[int, ConsumerProcess] = {}
-    # Start compile processes.
-    #
     # Compilation is split into 2 processes:
     # 1) Page compiler
     #   This process compiles pages - compiling single- or all pages as needed.
@@ -408,38 +611,50 @@ def compile_watch(cfg: config.Config) -> None:
     #   The same applies in case of a one-time compile being triggered. In case of being in a development/watch-mode
     #   loop, the function is first triggered without a file argument (meaning: apply operation to all files) and THEN
     #   triggered each time a file is modified.
-    for cp in [
-        ConsumerProcess(target=_compile_process, input_queue=page_queue, args=(stop_queue, cfg)),
-        ConsumerProcess(target=_asset_compile_process, input_queue=asset_queue, args=(stop_queue, cfg))
-    ]:
-        p = cp.spawn(ctx=ctx)
-        p.start()
-        p_handles[p.sentinel] = cp
-
-    p_quit: List[int] = []
-    while stop_queue.empty():
-        for sentinel in p_quit:
-            cp = p_handles[sentinel]
-            del p_handles[sentinel]
-            p_new = cp.spawn(ctx=ctx)
-            p_new.start()
-            p_handles[p_new.sentinel] = cp
-
-        # block until one or more processes exit - provided the stop_queue is
-        # empty, we will process and restart them in the next loop iteration.
-        p_quit = mp_wait(p_handles.keys())
-
-    for cp in [v for k, v in p_handles.items() if k not in set(p_quit)]:
-        cp.stop()
+    # 3) Dev server (if serving)
+    #   Serves the output directory. Tells the page compiler which pages are
+    #   viewed, such that it renders these first, and reloads browsers when
+    #   the page compiler (or asset compiler) is done.
+    #
+    # The supervisor restarts processes when they exit, and stops all of them
+    # once one signals a fatal error on the stop queue.
+    supervisor = Supervisor(ctx, stop_queue)
+    supervisor.add("page compiler", ConsumerProcess(
+        target=_compile_process, input_queue=page_queue, args=(stop_queue, cfg, reload_queue)))
+    supervisor.add("asset compiler", ConsumerProcess(
+        target=_asset_compile_process, input_queue=asset_queue, args=(stop_queue, cfg, reload_queue, page_queue)))
+    if reload_queue is not None:
+        from gadfly import devserver
+        supervisor.add("dev server", ConsumerProcess(
+            target=devserver.serve, input_queue=reload_queue, args=(stop_queue, cfg, serve_port, page_queue)))
+    observer.start()
+    try:
+        await supervisor.run()
+    finally:
+        observer.stop()
+
 
+def compile_once(cfg: config.Config) -> List[List[str]]:
+    """Compile the site once.
 
-def compile_once(cfg: config.Config) -> None:
+    Returns:
+        the budgets the build exceeded, see `gadfly.metrics`.
+    """
     # We setup both processes as in watch-mode, execute them and immediately
     # afterwards send a STOP message which they will obey as soon as they would
     # enter watch-mode.
     #
     # Doing this ensures both compile steps behave similarly and cuts down on
     # code duplication.
+    # imported here, only needed for one-off compiles
+    from gadfly import manifest
+    started = time.perf_counter()
+    cfg.track_outputs = True
+    # without a tracker from each process, the manifest is not updated
+    manifest.clear_trackers(cfg, OUTPUT_TRACKERS)
+    cfg.record_metrics = cfg.metrics.record
+    metrics.clear_parts(cfg, OUTPUT_TRACKERS)
+
     ctx = mp.get_context("spawn")
     page_queue = ctx.Queue()
     asset_queue = ctx.Queue()
@@ -451,7 +666,27 @@ def compile_once(cfg: config.Config) -> None:
     for cp in processes:
         p = cp.spawn(ctx=ctx)
         p.start()
-    # avoid a race condition error from the runtime itself
-    time.sleep(1)
-    for cp in processes:
+    # STOP is queued right away, each process handles it once its initial build is done.
+    # assets first: once the page compiler stops, all outputs exist (see `gadfly.links`)
+    for cp in reversed(processes):
         cp.stop()
+        cp.process.join()
+
+    if any(cp.process.exitcode != 0 for cp in processes):
+        # a crashed process may have saved the tracker of a partial build
+        cli.info("build did not complete, output manifest not updated")
+        return []
+    changes = manifest.merge(cfg, OUTPUT_TRACKERS)
+    if changes is None:
+        cli.info("build did not complete, output manifest not updated")
+        return []
+    cli.info(f"output manifest: {len(changes['added'])} added, {len(changes['changed'])} changed, "
+             f"{len(changes['removed'])} removed, see '{manifest.changes_path(cfg).relative_to(cfg.project_root)}'")
+    if not cfg.record_metrics:
+        return []
+    build = metrics.record(cfg, OUTPUT_TRACKERS, time.perf_counter() - started, changes)
+    if build is None:
+        cli.info("build did not complete, metrics not recorded")
+        return []
+    metrics.report(build)
+    return build["over_budget"]
@@ -0,0 +1,128 @@
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Iterator, TextIO, Tuple
+from contextlib import contextmanager
+import time
+import os
+from gadfly.atomic import open_atomic, write_atomic
+from gadfly.config import Config
+from gadfly.compress import OutputCompressor, remove_variants, variant_paths
+from gadfly.manifest import OutputTracker, load as load_manifest
+
+
+class Outputs:
+    def __init__(self, cfg: Config, name: str, on_written: Optional[Callable[[Path], None]] = None):
+        """Bookkeeping for files written to and removed from the output directory.
+
+        Each process producing output creates its own instance.
+
+        Args:
+            cfg: gadfly config
+            name: identifies the producing process, e.g. "pages" or "assets"
+            on_written: called with each file written or kept, e.g. `LinkChecker.written`
+        """
+        self._cfg = cfg
+        self._name = name
+        self._on_written = on_written
+        # records outputs for the build manifest, see `gadfly.manifest`
+        self._tracker = OutputTracker(cfg, name) if cfg.track_outputs else None
+        self._compressor = OutputCompressor(cfg, name, self._tracker) if cfg.compress.formats else None
+
+    def write(self, path: Path, content: str) -> None:
+        data = content.encode("utf-8")
+        write_atomic(path, data)
+        self.written(path, data)
+
+    @contextmanager
+    def writing(self, path: Path) -> Iterator[TextIO]:
+        """Write `path` as a stream of text, see `open_atomic`."""
+        with open_atomic(path, "w", encoding="utf-8", newline="") as fh:
+            yield fh
+        self.written(path)
+
+    def written(self, path: Path, content: Optional[bytes] = None) -> None:
+        """Register that `path` was (re-)written."""
+        if self._on_written is not None:
+            self._on_written(path)
+        if self._tracker is not None:
+            self._tracker.written(path, content)
+        if self._compressor is not None:
+            self._compressor.submit(path, content)
+
+    def kept(self, path: Path) -> None:
+        """Register that `path` remains an output though it was not rewritten."""
+        if self._on_written is not None:
+            self._on_written(path)
+        if self._tracker is not None:
+            for fpath in [path, *variant_paths(path)]:
+                self._tracker.kept(fpath)
+
+    def removed(self, path: Path) -> None:
+        """Register that `path` was deleted."""
+        if self._tracker is not None:
+            for fpath in [path, *variant_paths(path)]:
+                self._tracker.removed(fpath)
+        if self._compressor is not None:
+            self._compressor.remove(path)
+        else:
+            remove_variants(path)
+
+    def _stat_outputs(self, root: Path) -> Dict[str, Tuple[int, int]]:
+        stats = {}
+        for dirpath, _dir_names, file_names in os.walk(root):
+            for file_name in file_names:
+                if file_name.endswith(".tmp"):
+                    # another process' write in progress, see `open_atomic`
+                    continue
+                fpath = os.path.join(dirpath, file_name)
+                try:
+                    st = os.stat(fpath)
+                except FileNotFoundError:
+                    continue
+                stats[fpath] = (st.st_mtime_ns, st.st_size)
+        return stats
+
+    def start_external(self, root: Path) -> Tuple[int, Path, Dict[str, Tuple[int, int]]]:
+        """Mark start of code writing outputs on its own (asset handlers) below
+        directory `root`, see `end_external`."""
+        return time.time_ns(), root, self._stat_outputs(root)
+
+    def end_external(self, started: Tuple[int, Path, Dict[str, Tuple[int, int]]]) -> List[Path]:
+        """Register files below `root` created or modified since `start_external` as written.
+
+        If `root` is the whole output directory, files the previous build
+        attributes to another process (e.g. pages rewritten meanwhile) are left out.
+
+        Returns:
+            the files written."""
+        started_ns, root, before = started
+        foreign = set()
+        if root == self._cfg.output_path:
+            foreign = {rel for rel, entry in load_manifest(self._cfg).items()
+                       if entry.get("by", self._name) != self._name}
+        written = []
+        for fpath, st in self._stat_outputs(root).items():
+            # some file systems only store mtime with a resolution of seconds,
+            # compare against the state before as well.
+            if st[0] >= started_ns or before.get(fpath) != st:
+                if foreign and Path(fpath).relative_to(root).as_posix() in foreign:
+                    continue
+                written.append(Path(fpath))
+                self.written(written[-1])
+        return written
+
+    def flush(self) -> None:
+        """Wait for pending post-processing of written files."""
+        if self._compressor is not None:
+            self._compressor.wait()
+
+    def checkpoint(self) -> None:
+        """Save the records of the outputs written so far, see `gadfly.manifest`."""
+        self.flush()
+        if self._tracker is not None:
+            self._tracker.save()
+
+    def close(self) -> None:
+        if self._compressor is not None:
+            self._compressor.close()
+        if self._tracker is not None:
+            self._tracker.save()
@@ -1,5 +1,5 @@
 from pathlib import Path
-from typing import Optional, Dict, TYPE_CHECKING
+from typing import Optional, Dict, Iterable, Iterator, TYPE_CHECKING
 
 if TYPE_CHECKING:
     from gadfly.config import Config
@@ -15,7 +15,19 @@ class PagePostCompileHookFn:
         ...
 
 
+class PagePostCompileStreamHookFn:
+    def __call__(self, page_path: Path, config: "Config", chunks: Iterator[str]) -> Optional[Iterable[str]]:
+        ...
+
+
+class PageTransformFn:
+    def __call__(self, page_name: Path, content: str, options: Dict) -> str:
+        ...
+
+
 __all__ = [
     "PagePreCompileHookFn",
     "PagePostCompileHookFn",
+    "PagePostCompileStreamHookFn",
+    "PageTransformFn",
 ]
\ No newline at end of file
@@ -0,0 +1,57 @@
+"""Compact storage of page metadata for low-memory builds.
+
+`config.page_md` maps each page (its path relative to the pages directory) to
+a dict of metadata. With tens of thousands of pages, the `Path` keys and
+per-page dicts dominate. `PageMetadataStore` keeps the same mapping interface
+but stores
+* keys as interned strings,
+* each page's metadata as a `Record`: a tuple of field names, shared by all
+  pages setting the same fields, and a tuple of values.
+
+Reading a page's metadata builds a new dict, so updates must be assigned back,
+as `gf_md_assoc` does.
+"""
+from pathlib import Path
+from typing import Dict, Iterator, MutableMapping, Tuple, Union
+import sys
+
+
+class Record:
+    __slots__ = ("fields", "values")
+
+    def __init__(self, fields: Tuple[str, ...], values: tuple):
+        self.fields = fields
+        self.values = values
+
+
+class PageMetadataStore(MutableMapping):
+    def __init__(self):
+        self._records: Dict[str, Record] = {}
+        # interned field name tuples, shared between records
+        self._schemas: Dict[Tuple[str, ...], Tuple[str, ...]] = {}
+
+    @staticmethod
+    def _key(page_name: Union[Path, str]) -> str:
+        return sys.intern(str(page_name))
+
+    def __getitem__(self, page_name: Union[Path, str]) -> Dict:
+        record = self._records[str(page_name)]
+        return dict(zip(record.fields, record.values))
+
+    def __setitem__(self, page_name: Union[Path, str], md: Dict) -> None:
+        fields = tuple(sys.intern(key) for key in md)
+        fields = self._schemas.setdefault(fields, fields)
+        self._records[self._key(page_name)] = Record(fields, tuple(md.values()))
+
+    def __delitem__(self, page_name: Union[Path, str]) -> None:
+        del self._records[str(page_name)]
+
+    def __contains__(self, page_name) -> bool:
+        return str(page_name) in self._records
+
+    def __iter__(self) -> Iterator[Path]:
+        # keys were `Path` objects before, keep it that way for user code
+        return (Path(key) for key in self._records)
+
+    def __len__(self) -> int:
+        return len(self._records)
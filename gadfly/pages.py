@@ -0,0 +1,143 @@
+"""Index of the pages, kept by the page compiler.
+
+Full rebuilds iterate the index rather than walking the pages directory, and
+each page's name (relative to the pages directory) and output file are
+computed once. The page compiler scans the pages directory when it starts,
+then keeps the index up to date from the watcher's events: pages are added as
+they are rendered, removed on `EventType.PAGE_DELETED`.
+
+The scan itself lists only the directories which changed since the previous
+scan: the listing (pages and subdirectories) of each directory is kept in
+`.gadfly/pages.json` along with the directory's mtime. Directories whose mtime
+is unchanged are stat'ed rather than listed, which saves listing directories
+holding many files which are not pages. As in `gadfly.poll`, a directory's
+mtime changes when entries are added, removed or renamed.
+"""
+from pathlib import Path
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
+import json
+import os
+import time
+from gadfly.atomic import write_atomic
+from gadfly.config import Config
+from gadfly.utils import output_path
+
+# bump whenever the layout of the stored listings changes
+PAGES_VERSION = 1
+# directories modified this recently (in ns) are listed on every scan, another
+# change within the file system's mtime resolution would go unnoticed.
+_RECENT_NS = 2_000_000_000
+
+
+class PageEntry(NamedTuple):
+    # page file (.md)
+    path: Path
+    # relative to the pages directory
+    name: Path
+    out_path: Path
+
+
+class _Listing(NamedTuple):
+    mtime_ns: Optional[int]
+    pages: List[str]
+    subdirs: List[str]
+
+
+class PageIndex:
+    def __init__(self, cfg: Config):
+        """Index of the pages of the project, see `scan`."""
+        self._cfg = cfg
+        self._state_path = cfg.cache_path / "pages.json"
+        # page file => entry, in the order the pages were found
+        self._pages: Dict[Path, PageEntry] = {}
+
+    def _entry(self, page_path: Path) -> PageEntry:
+        return PageEntry(page_path, page_path.relative_to(self._cfg.pages_path), output_path(self._cfg, page_path))
+
+    def _load(self) -> Dict[str, _Listing]:
+        try:
+            with open(self._state_path) as fh:
+                state = json.load(fh)
+        except (FileNotFoundError, ValueError):
+            return {}
+        if state.get("version") != PAGES_VERSION or state.get("root") != str(self._cfg.pages_path):
+            return {}
+        return {rel: _Listing(*listing) for rel, listing in state["dirs"].items()}
+
+    def _list(self, dirpath: str, mtime_ns: int) -> _Listing:
+        pages, subdirs = [], []
+        try:
+            with os.scandir(dirpath) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir():
+                            # as `os.walk`, symbolic links to directories are not followed
+                            if not entry.is_symlink():
+                                subdirs.append(entry.name)
+                        elif entry.name.endswith(".md"):
+                            pages.append(entry.name)
+                    except OSError:
+                        # removed while listing
+                        continue
+        except OSError:
+            return _Listing(None, [], [])
+        recent = time.time_ns() - mtime_ns < _RECENT_NS
+        return _Listing(None if recent else mtime_ns, sorted(pages), sorted(subdirs))
+
+    def scan(self) -> None:
+        """(Re-)build the index from the pages directory."""
+        previous = self._load()
+        listings: Dict[str, _Listing] = {}
+        pages: Dict[Path, PageEntry] = {}
+        pending: List[Tuple[str, str]] = [(".", str(self._cfg.pages_path))]
+        while pending:
+            rel, dirpath = pending.pop()
+            try:
+                mtime_ns = os.stat(dirpath).st_mtime_ns
+            except OSError:
+                continue
+            listing = previous.get(rel)
+            if listing is None or listing.mtime_ns != mtime_ns:
+                listing = self._list(dirpath, mtime_ns)
+            listings[rel] = listing
+            for name in listing.pages:
+                page_path = Path(dirpath) / name
+                pages[page_path] = self._pages.get(page_path) or self._entry(page_path)
+            # reversed, subdirectories are then visited in order
+            for name in reversed(listing.subdirs):
+                pending.append((name if rel == "." else f"{rel}/{name}", os.path.join(dirpath, name)))
+        self._pages = pages
+        if listings != previous:
+            write_atomic(self._state_path, json.dumps({
+                "version": PAGES_VERSION,
+                "root": str(self._cfg.pages_path),
+                "dirs": {rel: list(listing) for rel, listing in listings.items()},
+            }).encode())
+
+    def __iter__(self) -> Iterator[PageEntry]:
+        return iter(list(self._pages.values()))
+
+    def __len__(self) -> int:
+        return len(self._pages)
+
+    def paths(self) -> List[Path]:
+        return list(self._pages)
+
+    def entry(self, page_path: Path) -> PageEntry:
+        """Entry of page `page_path`, added to the index if new."""
+        entry = self._pages.get(page_path)
+        if entry is None:
+            entry = self._pages[page_path] = self._entry(page_path)
+        return entry
+
+    def remove(self, path: Path) -> List[PageEntry]:
+        """Remove page `path`, or all pages in directory `path`, returns their entries."""
+        entry = self._pages.pop(path, None)
+        if entry is not None:
+            return [entry]
+        removed = [page_path for page_path in self._pages if path in page_path.parents]
+        if not removed and path.suffix == ".md":
+            # deleted before it was indexed (e.g. while the page compiler restarted)
+            entry = self._entry(path)
+            return [entry] if entry.out_path.exists() else []
+        return [self._pages.pop(page_path) for page_path in removed]
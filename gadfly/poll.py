@@ -0,0 +1,263 @@
+"""Polling watch backend, for file systems which do not deliver native file
+events, such as network file systems or bind mounts of some container setups.
+
+`PollingObserver` stands in for watchdog's `Observer` and dispatches the same
+kind of events to the same handlers, rebuilds behave identically.
+
+Each watch keeps a stat snapshot of its tree. Every interval,
+* each directory is stat'ed, only those whose mtime changed (i.e. entries were
+  added, removed or renamed) are listed again with `os.scandir`,
+* each file in the other directories is stat'ed and reported as modified if
+  its mtime, size or inode changed.
+The handlers' hash database then drops modifications which did not change a
+file's content.
+
+Renames are reported as a deletion followed by a creation.
+"""
+from typing import Dict, List, Optional, Tuple
+import threading
+import os
+from watchdog.events import (
+    FileSystemEvent, FileCreatedEvent, FileModifiedEvent, FileDeletedEvent, DirCreatedEvent, DirDeletedEvent
+)
+from gadfly import cli
+
+# (mtime_ns, size, inode)
+Signature = Tuple[int, int, int]
+
+
+def _signature(st: os.stat_result) -> Signature:
+    return st.st_mtime_ns, st.st_size, st.st_ino
+
+
+class _Dir:
+    __slots__ = ("mtime_ns", "files", "subdirs")
+
+    def __init__(self, mtime_ns: int):
+        self.mtime_ns = mtime_ns
+        # file name => signature
+        self.files: Dict[str, Signature] = {}
+        self.subdirs: List[str] = []
+
+
+class _Watch:
+    def __init__(self, handler, path: str, recursive: bool):
+        self.handler = handler
+        self.path = path
+        self.recursive = recursive
+        # directory path => snapshot, for a watched file: the file's signature
+        self._dirs: Dict[str, _Dir] = {}
+        self._file: Optional[Signature] = None
+
+    def _dispatch(self, event: FileSystemEvent) -> None:
+        try:
+            self.handler.dispatch(event)
+        except Exception:
+            # keep polling, the native observer would stop delivering events altogether
+            cli.pp_exc()
+
+    def _ignored(self, path: str) -> bool:
+        ignore = getattr(self.handler, "ignore", None)
+        return ignore is not None and ignore.ignored(path)
+
+    def _file_added(self, path: str) -> None:
+        self._dispatch(FileCreatedEvent(path))
+        self._dispatch(FileModifiedEvent(path))
+
+    def scan(self, report: bool) -> bool:
+        """Take the initial snapshot, reporting existing files as created if `report`.
+
+        Returns:
+            False if the watched path does not exist.
+        """
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return False
+        if os.path.isdir(self.path):
+            self._add_tree(self.path, st, report)
+        else:
+            self._file = _signature(st)
+            if report:
+                self._file_added(self.path)
+        return True
+
+    def _add_tree(self, dirpath: str, st: os.stat_result, report: bool) -> None:
+        snapshot = self._dirs[dirpath] = _Dir(st.st_mtime_ns)
+        try:
+            with os.scandir(dirpath) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            snapshot.subdirs.append(entry.name)
+                        else:
+                            snapshot.files[entry.name] = _signature(entry.stat())
+                    except OSError:
+                        # removed while listing, noticed on the next poll
+                        continue
+        except OSError:
+            # removed in the meantime, noticed on the next poll
+            return
+        if report:
+            for name in snapshot.files:
+                self._file_added(os.path.join(dirpath, name))
+        if not self.recursive:
+            return
+        for name in snapshot.subdirs:
+            subdir = os.path.join(dirpath, name)
+            if self._ignored(subdir):
+                continue
+            try:
+                sub_st = os.stat(subdir)
+            except OSError:
+                continue
+            if report:
+                self._dispatch(DirCreatedEvent(subdir))
+            self._add_tree(subdir, sub_st, report)
+
+    def _remove_tree(self, dirpath: str) -> None:
+        snapshot = self._dirs.pop(dirpath, None)
+        if snapshot is None:
+            return
+        for name in snapshot.subdirs:
+            subdir = os.path.join(dirpath, name)
+            if subdir in self._dirs:
+                self._remove_tree(subdir)
+                self._dispatch(DirDeletedEvent(subdir))
+        for name in snapshot.files:
+            self._dispatch(FileDeletedEvent(os.path.join(dirpath, name)))
+
+    def _rescan(self, dirpath: str, st: os.stat_result) -> None:
+        snapshot = self._dirs[dirpath]
+        snapshot.mtime_ns = st.st_mtime_ns
+        files: Dict[str, Signature] = {}
+        subdirs = []
+        try:
+            with os.scandir(dirpath) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirs.append(entry.name)
+                        else:
+                            files[entry.name] = _signature(entry.stat())
+                    except OSError:
+                        continue
+        except OSError:
+            return
+        for name in snapshot.files.keys() - files.keys():
+            self._dispatch(FileDeletedEvent(os.path.join(dirpath, name)))
+        for name, sig in files.items():
+            old = snapshot.files.get(name)
+            if old is None:
+                self._file_added(os.path.join(dirpath, name))
+            elif old != sig:
+                self._dispatch(FileModifiedEvent(os.path.join(dirpath, name)))
+        snapshot.files = files
+
+        for name in set(snapshot.subdirs) - set(subdirs):
+            subdir = os.path.join(dirpath, name)
+            self._remove_tree(subdir)
+            self._dispatch(DirDeletedEvent(subdir))
+        for name in set(subdirs) - set(snapshot.subdirs):
+            subdir = os.path.join(dirpath, name)
+            # non-recursive watches report the directory only, `TreeWatch` may add a watch for it
+            self._dispatch(DirCreatedEvent(subdir))
+            if self.recursive and not self._ignored(subdir):
+                try:
+                    self._add_tree(subdir, os.stat(subdir), report=True)
+                except OSError:
+                    continue
+        snapshot.subdirs = subdirs
+
+    def _stat_files(self, dirpath: str) -> None:
+        snapshot = self._dirs[dirpath]
+        for name, old in snapshot.files.items():
+            fpath = os.path.join(dirpath, name)
+            try:
+                sig = _signature(os.stat(fpath))
+            except OSError:
+                # deleted, the directory's mtime changed as well, handled on the next poll
+                continue
+            if sig != old:
+                snapshot.files[name] = sig
+                self._dispatch(FileModifiedEvent(fpath))
+
+    def poll(self) -> bool:
+        """Compare against the snapshot and dispatch events for any differences.
+
+        Returns:
+            False once the watched path is gone, the watch is then dropped.
+        """
+        if self._file is not None:
+            try:
+                sig = _signature(os.stat(self.path))
+            except OSError:
+                self._dispatch(FileDeletedEvent(self.path))
+                return False
+            if sig != self._file:
+                self._file = sig
+                self._dispatch(FileModifiedEvent(self.path))
+            return True
+
+        # parents before children, a parent's rescan may remove or add subtrees
+        for dirpath in list(self._dirs):
+            if dirpath not in self._dirs:
+                continue
+            try:
+                st = os.stat(dirpath)
+            except OSError:
+                if dirpath == self.path:
+                    self._remove_tree(dirpath)
+                    return False
+                # noticed by the parent's rescan
+                continue
+            if st.st_mtime_ns != self._dirs[dirpath].mtime_ns:
+                self._rescan(dirpath, st)
+            else:
+                self._stat_files(dirpath)
+        return True
+
+
+class PollingObserver(threading.Thread):
+    def __init__(self, interval: float):
+        """Watch for file changes by polling every `interval` seconds.
+
+        Implements the parts of watchdog's `Observer` interface used by
+        `TreeWatch`. Watches scheduled while running (i.e. for new directories)
+        report the files already present as created, as they were created since
+        the last poll.
+
+        Rather than starting the thread, `poll` can be called when needed (the
+        build daemon polls once per build).
+        """
+        super().__init__(name="gadfly-poll", daemon=True)
+        self._interval = interval
+        self._watches: List[_Watch] = []
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._polling = False
+
+    def schedule(self, handler, path: str, recursive: bool = False) -> None:
+        watch = _Watch(handler, str(path), recursive)
+        if not watch.scan(report=self._polling):
+            return
+        with self._lock:
+            self._watches.append(watch)
+
+    def poll(self) -> None:
+        """Dispatch events for all changes since the last poll."""
+        self._polling = True
+        with self._lock:
+            watches = list(self._watches)
+        # handlers may schedule new watches while polling, see `TreeWatch.dir_added`
+        gone = [watch for watch in watches if not watch.poll()]
+        if gone:
+            with self._lock:
+                self._watches = [watch for watch in self._watches if watch not in gone]
+
+    def run(self) -> None:
+        while not self._stopped.wait(self._interval):
+            self.poll()
+
+    def stop(self) -> None:
+        self._stopped.set()
@@ -0,0 +1,305 @@
+"""Full-text search index of the rendered pages.
+
+Enabled by the `[search]` section of `gadfly.toml`. The page compiler passes
+each page it renders to the index (see `compiler.render`), rather than the
+index re-reading the output directory. The terms of every page are kept in
+`.gadfly/search/`, re-rendering a page replaces just that page's postings and
+rewrites just the index files holding a term which changed.
+
+Index files, in `<output>/<search.output>/`:
+
+* `docs.json`: `{"version": 1, "shards": N, "shard_prefix": P, "docs": [[url, title], ...]}`.
+  Postings refer to pages by their position in `docs`, positions of removed
+  pages are `null` (and reused).
+* `terms-<shard>.json`: `{term: [doc, weight, doc, weight, ...]}`, the weight
+  being the term's number of occurrences (occurrences in the title count
+  `TITLE_WEIGHT` times). A term is in shard `fnv1a32(term[:P]) % N`, FNV-1a
+  over its UTF-8 bytes: browsers fetch only the shards of the searched terms,
+  and all terms starting with the same P characters are in the same shard.
+
+Terms are the lower-cased words (`\\w+`) of the page's text, outside of
+`script`, `style`, `noscript` and `template` elements. A page's title is its
+`title` metadata, its `<title>` or first `<h1>`. Pages setting
+`gf_md_assoc(search=False)` are not indexed, nor are generated pages.
+"""
+from dataclasses import dataclass
+from fnmatch import fnmatch
+from hashlib import sha256
+from html.parser import HTMLParser
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
+import json
+import pickle
+import re
+from gadfly.atomic import write_atomic
+from gadfly.config import Config
+from gadfly import metrics
+from gadfly.output import Outputs
+from gadfly.utils import output_path
+
+# bump whenever the layout of the index files or of the stored state changes
+SEARCH_VERSION = 1
+# an occurrence in the title counts as this many in the text
+TITLE_WEIGHT = 5
+_TERM_RE = re.compile(r"\w+")
+
+
+def fnv1a32(data: bytes) -> int:
+    h = 0x811c9dc5
+    for byte in data:
+        h = ((h ^ byte) * 0x01000193) & 0xffffffff
+    return h
+
+
+class _TextExtractor(HTMLParser):
+    SKIP = {"script", "style", "noscript", "template"}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.text: List[str] = []
+        self.title: List[str] = []
+        self.h1: List[str] = []
+        self._skip = 0
+        self._in_title = False
+        # 0: before the first h1, 1: within it, 2: after it
+        self._h1 = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP:
+            self._skip += 1
+        elif tag == "title":
+            self._in_title = True
+        elif tag == "h1" and self._h1 == 0:
+            self._h1 = 1
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP:
+            self._skip = max(0, self._skip - 1)
+        elif tag == "title":
+            self._in_title = False
+        elif tag == "h1" and self._h1 == 1:
+            self._h1 = 2
+
+    def handle_data(self, data):
+        if self._skip:
+            return
+        if self._in_title:
+            self.title.append(data)
+            return
+        if self._h1 == 1:
+            self.h1.append(data)
+        self.text.append(data)
+
+
+@dataclass
+class _Doc:
+    id: int
+    url: str
+    title: str
+    # of the indexed content and title, unchanged pages are skipped
+    digest: str
+    # term => weight
+    terms: Dict[str, int]
+
+
+class SearchIndex:
+    def __init__(self, cfg: Config, outputs: Outputs):
+        """Search index of the pages, loaded from the state of the previous build, if any.
+
+        Args:
+            cfg: gadfly config
+            outputs: of the page compiler, the index files are written through it.
+        """
+        self._cfg = cfg
+        self._opts = cfg.search
+        self._outputs = outputs
+        self._state_path = cfg.cache_path / "search" / "state.pickle"
+        self._out_dir = cfg.output_path / self._opts.output
+        self._stop_words = {word.lower() for word in self._opts.stop_words}
+        # page name (posix) => doc
+        self._docs: Dict[str, _Doc] = {}
+        # doc id => page name, None for a free id
+        self._ids: List[Optional[str]] = []
+        self._free: List[int] = []
+        # term => {doc id => weight}
+        self._postings: Dict[str, Dict[int, int]] = {}
+        self._shard_cache: Dict[str, int] = {}
+        # shards and doc list to rewrite on `save`
+        self._dirty: Set[int] = set()
+        self._docs_dirty = False
+        self._state_dirty = False
+        self._load()
+
+    def _options_key(self) -> str:
+        opts = self._opts
+        return json.dumps([SEARCH_VERSION, TITLE_WEIGHT, opts.output, opts.shards, opts.shard_prefix,
+                           opts.min_term_length, sorted(self._stop_words)])
+
+    def _shard_path(self, shard: int) -> Path:
+        return self._out_dir / f"terms-{shard}.json"
+
+    def _load(self) -> None:
+        try:
+            with open(self._state_path, "rb") as fh:
+                state = pickle.load(fh)
+        except FileNotFoundError:
+            state = None
+        except Exception:
+            # corrupt or written by an incompatible version, start over
+            state = None
+        if not isinstance(state, dict) or state.get("key") != self._options_key():
+            self._dirty = set(range(self._opts.shards))
+            self._docs_dirty = self._state_dirty = True
+            return
+        self._docs = state["docs"]
+        self._ids = [None] * (max((doc.id for doc in self._docs.values()), default=-1) + 1)
+        for page_name, doc in self._docs.items():
+            self._ids[doc.id] = page_name
+            for term, weight in doc.terms.items():
+                self._postings.setdefault(term, {})[doc.id] = weight
+        self._free = [doc_id for doc_id, page_name in enumerate(self._ids) if page_name is None]
+        # e.g. the output directory was cleared
+        self._dirty = {shard for shard in range(self._opts.shards) if not self._shard_path(shard).exists()}
+        self._docs_dirty = not (self._out_dir / "docs.json").exists()
+
+    def shard(self, term: str) -> int:
+        shard = self._shard_cache.get(term)
+        if shard is None:
+            shard = self._shard_cache[term] = \
+                fnv1a32(term[:self._opts.shard_prefix].encode("utf-8")) % self._opts.shards
+        return shard
+
+    def _terms(self, text: str, weight: int, terms: Dict[str, int]) -> None:
+        min_len = self._opts.min_term_length
+        for term in _TERM_RE.findall(text.lower()):
+            if len(term) >= min_len and term not in self._stop_words:
+                terms[term] = terms.get(term, 0) + weight
+
+    def _excluded(self, page_name: Path, page_md: dict) -> bool:
+        if page_md.get("search") is False:
+            return True
+        name = page_name.as_posix()
+        return any(fnmatch(name, pattern) for pattern in self._opts.exclude)
+
+    def update(self, page_name: Path, content: str) -> None:
+        """Index the rendered `content` of page `page_name` (relative to the pages directory)."""
+        page_md = self._cfg.page_md.get(page_name) or {}
+        if self._excluded(page_name, page_md):
+            self.remove(page_name)
+            return
+        md_title = page_md.get("title")
+        digest = sha256(f"{md_title}\0{content}".encode("utf-8")).hexdigest()
+        name = page_name.as_posix()
+        doc = self._docs.get(name)
+        if doc is not None and doc.digest == digest:
+            metrics.cache("search", True)
+            return
+        metrics.cache("search", False)
+
+        parser = _TextExtractor()
+        parser.feed(content)
+        parser.close()
+        url = "/" + output_path(self._cfg, self._cfg.pages_path / page_name) \
+            .relative_to(self._cfg.output_path).as_posix()
+        if url.endswith("/index.html"):
+            url = url[:-len("index.html")]
+        if md_title is not None:
+            title = str(md_title)
+        else:
+            title = "".join(parser.title).strip() or "".join(parser.h1).strip() or url
+        title = " ".join(title.split())
+        terms: Dict[str, int] = {}
+        self._terms("".join(parser.text), 1, terms)
+        self._terms(title, TITLE_WEIGHT, terms)
+
+        if doc is None:
+            doc = self._docs[name] = _Doc(self._allocate(name), url, title, digest, {})
+            self._docs_dirty = True
+        elif (doc.url, doc.title) != (url, title):
+            doc.url, doc.title = url, title
+            self._docs_dirty = True
+        doc.digest = digest
+        self._set_terms(doc, terms)
+        self._state_dirty = True
+
+    def update_file(self, page_name: Path, fpath: Path) -> None:
+        """Index page `page_name` from its output file, for pages streamed to their output."""
+        with open(fpath, "r", encoding="utf-8") as fh:
+            self.update(page_name, fh.read())
+
+    def remove(self, page_name: Path) -> None:
+        """Drop page `page_name` from the index, if indexed."""
+        name = page_name.as_posix()
+        doc = self._docs.pop(name, None)
+        if doc is None:
+            return
+        self._set_terms(doc, {})
+        self._ids[doc.id] = None
+        self._free.append(doc.id)
+        self._docs_dirty = self._state_dirty = True
+
+    def _allocate(self, name: str) -> int:
+        if self._free:
+            doc_id = self._free.pop()
+            self._ids[doc_id] = name
+            return doc_id
+        self._ids.append(name)
+        return len(self._ids) - 1
+
+    def _set_terms(self, doc: _Doc, terms: Dict[str, int]) -> None:
+        # only the postings of terms whose weight changed are touched
+        old = doc.terms
+        for term, weight in old.items():
+            if term not in terms:
+                postings = self._postings[term]
+                del postings[doc.id]
+                if not postings:
+                    del self._postings[term]
+                self._dirty.add(self.shard(term))
+        for term, weight in terms.items():
+            if old.get(term) != weight:
+                self._postings.setdefault(term, {})[doc.id] = weight
+                self._dirty.add(self.shard(term))
+        doc.terms = terms
+
+    def save(self) -> None:
+        """Write the index files changed since the last save, and the state for the next build."""
+        # pages deleted since rendered
+        for name in [name for name in self._docs if not (self._cfg.pages_path / name).exists()]:
+            self.remove(Path(name))
+
+        if self._dirty:
+            shards: Dict[int, Dict[str, List[int]]] = {shard: {} for shard in self._dirty}
+            for term, postings in self._postings.items():
+                shard = shards.get(self.shard(term))
+                if shard is not None:
+                    shard[term] = [n for doc_weight in sorted(postings.items()) for n in doc_weight]
+            for shard, terms in shards.items():
+                self._outputs.write(self._shard_path(shard), _dumps(terms))
+        if self._docs_dirty:
+            docs: List[Optional[Tuple[str, str]]] = [None] * len(self._ids)
+            for doc in self._docs.values():
+                docs[doc.id] = (doc.url, doc.title)
+            self._outputs.write(self._out_dir / "docs.json", _dumps({
+                "version": SEARCH_VERSION,
+                "shards": self._opts.shards,
+                "shard_prefix": self._opts.shard_prefix,
+                "docs": docs,
+            }))
+        else:
+            self._outputs.kept(self._out_dir / "docs.json")
+        for shard in range(self._opts.shards):
+            if shard not in self._dirty:
+                self._outputs.kept(self._shard_path(shard))
+        self._dirty = set()
+        self._docs_dirty = False
+
+        if self._state_dirty:
+            write_atomic(self._state_path, pickle.dumps(
+                {"key": self._options_key(), "docs": self._docs}, protocol=pickle.HIGHEST_PROTOCOL))
+            self._state_dirty = False
+
+
+def _dumps(obj) -> str:
+    # sorted, rewriting an unchanged shard yields the same file
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"), sort_keys=True)
@@ -0,0 +1,180 @@
+"""Read-only copy of the evaluated context, shared by worker processes.
+
+Worker processes receive the config pickled when they start, so each would
+unpickle, and hold, its own copy of the whole context. Instead, the process
+owning the pool writes the context once to a file in the project's state
+directory, pickling each top-level key on its own. Workers map the file into
+memory (`mmap`) read-only: its pages are shared by all of them, and a key is
+unpickled in a worker only once a template looks it up.
+
+Layout: magic, length of the index, the pickled index (key => (offset, length)
+of the key's pickled value), then the values.
+"""
+from pathlib import Path
+from typing import Any, Dict, Iterator, Optional, Tuple
+import mmap
+import os
+import pickle
+import struct
+from gadfly.config import Config
+from gadfly import cli
+
+MAGIC = b"GFCTX\x00\x00\x01"
+# magic, length of the index
+_HEADER = struct.Struct("<8sQ")
+
+
+def write(cfg: Config, context: dict) -> Optional[Path]:
+    """Write `context` for workers to map, returns the file's path.
+
+    Returns:
+        None if a value cannot be pickled, workers then receive the context
+        along with the config.
+    """
+    blobs = []
+    for key, value in context.items():
+        try:
+            blobs.append((key, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)))
+        except Exception as e:
+            cli.info(f"context key '{key}' cannot be pickled ({e}), passing the context to each worker")
+            return None
+    index: Dict[Any, Tuple[int, int]] = {}
+    offset = 0
+    for key, blob in blobs:
+        index[key] = (offset, len(blob))
+        offset += len(blob)
+    index_blob = pickle.dumps(index, protocol=pickle.HIGHEST_PROTOCOL)
+
+    # one file per owning process, a page compiler may be restarted while the
+    # workers of its predecessor are shutting down.
+    fpath = cfg.cache_path / f"context-{os.getpid()}.bin"
+    fpath.parent.mkdir(parents=True, exist_ok=True)
+    _remove_stale(cfg)
+    with open(fpath, "wb") as fh:
+        fh.write(_HEADER.pack(MAGIC, len(index_blob)))
+        fh.write(index_blob)
+        for _key, blob in blobs:
+            fh.write(blob)
+    return fpath
+
+
+def _remove_stale(cfg: Config) -> None:
+    # left behind by processes which were killed
+    if os.name != "posix":
+        # no way to probe a process without signalling it
+        return
+    for fpath in cfg.cache_path.glob("context-*.bin"):
+        try:
+            pid = int(fpath.stem.split("-", 1)[1])
+        except ValueError:
+            continue
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            remove(fpath)
+        except OSError:
+            # exists, owned by another user
+            pass
+
+
+def remove(fpath: Path) -> None:
+    try:
+        fpath.unlink(missing_ok=True)
+    except OSError:
+        # still mapped by a worker on Windows, overwritten by a later run
+        pass
+
+
+class SharedContext:
+    def __init__(self, fpath: Path):
+        """Map the context written by `write`."""
+        with open(fpath, "rb") as fh:
+            self._mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, index_len = _HEADER.unpack_from(self._mm)
+        if magic != MAGIC:
+            raise ValueError(f"'{fpath}' is not a shared context")
+        start = _HEADER.size
+        self._index: Dict[Any, Tuple[int, int]] = pickle.loads(self._mm[start:start + index_len])
+        self._base = start + index_len
+        # values unpickled so far
+        self._values: Dict[Any, Any] = {}
+
+    def __contains__(self, key) -> bool:
+        return key in self._index
+
+    def keys(self):
+        return self._index.keys()
+
+    def load(self, key) -> Any:
+        """Value of `key`, unpickled on first access."""
+        try:
+            return self._values[key]
+        except KeyError:
+            pass
+        offset, size = self._index[key]
+        start = self._base + offset
+        with memoryview(self._mm)[start:start + size] as view:
+            value = self._values[key] = pickle.loads(view)
+        return value
+
+
+class LazyContext(dict):
+    """Context whose values are unpickled from a `SharedContext` on lookup.
+
+    The dict itself holds only the entries set on top of the shared context
+    (e.g. the variables of a render), which take precedence. Iterating (and so
+    `{**ctx}`) loads every value, lookups through `[]`, `get` and `in`, which is
+    what templates do, load just the requested one."""
+
+    def __init__(self, shared: SharedContext, overlay: Optional[dict] = None):
+        super().__init__(overlay or {})
+        self._shared = shared
+
+    def overlay(self, entries: dict) -> "LazyContext":
+        """Copy of this context with `entries` set on top."""
+        merged = dict(dict.items(self))
+        merged.update(entries)
+        return LazyContext(self._shared, merged)
+
+    def __missing__(self, key):
+        if key in self._shared:
+            return self._shared.load(key)
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key) -> bool:
+        return dict.__contains__(self, key) or key in self._shared
+
+    def keys(self):
+        return list(self)
+
+    def __iter__(self) -> Iterator:
+        yield from dict.__iter__(self)
+        for key in self._shared.keys():
+            if not dict.__contains__(self, key):
+                yield key
+
+    def __len__(self) -> int:
+        return len(self.keys())
+
+    def items(self):
+        return [(key, self[key]) for key in self]
+
+    def values(self):
+        return [self[key] for key in self]
+
+    def copy(self) -> "LazyContext":
+        return LazyContext(self._shared, dict(dict.items(self)))
+
+    def __reduce__(self):
+        # a materialized copy, the mapping cannot be pickled
+        return dict, (self.items(),)
+
+
+def attach(fpath: Path) -> LazyContext:
+    return LazyContext(SharedContext(fpath))
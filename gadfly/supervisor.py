@@ -0,0 +1,156 @@
+"""Supervisor of watch mode, an asyncio event loop owning
+
+* the event forwarders, which receive the file watchers' events (from the
+  watchdog threads), debounce and pass them on to the compile processes,
+* the compile processes and dev server, restarting them when they exit, with
+  exponential backoff if they crash,
+* the stop queue, on which a process signals that watch mode must end.
+
+Process exits are detected by registering each process' sentinel with the
+event loop, the loop sleeps until something happens.
+"""
+from typing import Callable, Dict, List, Optional
+from multiprocessing.context import BaseContext
+from multiprocessing.process import BaseProcess
+import multiprocessing as mp
+import asyncio
+import threading
+from gadfly import cli
+from gadfly.mp import ConsumerProcess
+
+# delay before restarting a crashed process, doubled on each consecutive crash
+BACKOFF_INITIAL = 0.5
+BACKOFF_MAX = 30.0
+# a process running at least this long before crashing restarts without delay
+STABLE_AFTER = 10.0
+# delay before restarting a process which exited cleanly
+RESTART_GRACE = 0.1
+# the longest a burst of events may hold back forwarding, as a multiple of the debounce delay
+DEBOUNCE_MAX_FACTOR = 4
+
+
+class EventForwarder:
+    def __init__(self, loop: asyncio.AbstractEventLoop, queue: mp.Queue, debounce: float):
+        """Forward events to `queue` once no new event arrived for `debounce` seconds.
+
+        Stands in for the queue of the watchers' event handlers, `put` may be
+        called from any thread. Saving a file often yields several events in
+        short succession, forwarding them together lets the compile process
+        handle them in one go."""
+        self._loop = loop
+        self._queue = queue
+        self._debounce = debounce
+        self._pending: List[dict] = []
+        self._first_at = 0.0
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    def put(self, event: dict) -> None:
+        self._loop.call_soon_threadsafe(self._add, event)
+
+    def _add(self, event: dict) -> None:
+        now = self._loop.time()
+        if not self._pending:
+            self._first_at = now
+        self._pending.append(event)
+        if self._timer is not None:
+            self._timer.cancel()
+        # never postpone beyond the max, a steady stream of events would starve the compiler
+        at = min(now + self._debounce, self._first_at + self._debounce * DEBOUNCE_MAX_FACTOR)
+        self._timer = self._loop.call_at(at, self._flush)
+
+    def _flush(self) -> None:
+        self._timer = None
+        pending, self._pending = self._pending, []
+        for event in pending:
+            self._queue.put(event)
+
+
+class Supervised:
+    def __init__(self, name: str, cp: ConsumerProcess):
+        self.name = name
+        self.cp = cp
+        self.backoff = BACKOFF_INITIAL
+        self.started_at = 0.0
+
+
+class Supervisor:
+    def __init__(self, ctx: BaseContext, stop_queue: mp.Queue,
+                 on_crash: Optional[Callable[[str, int], None]] = None):
+        """Start processes and restart them whenever they exit, until a
+        message arrives on `stop_queue`.
+
+        `on_crash`, if given, is called with the name and exit code of each
+        process exiting with an error."""
+        self._ctx = ctx
+        self._stop_queue = stop_queue
+        self._on_crash = on_crash
+        self._supervised: List[Supervised] = []
+        self._stopping = False
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def add(self, name: str, cp: ConsumerProcess) -> None:
+        self._supervised.append(Supervised(name, cp))
+
+    def alive(self) -> Dict[str, bool]:
+        """Whether each process is running (restarting processes are not)."""
+        return {sup.name: sup.cp.process is not None and sup.cp.process.is_alive() for sup in self._supervised}
+
+    async def run(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        stopped = self._loop.create_future()
+
+        def wait_stop():
+            self._stop_queue.get()
+            self._loop.call_soon_threadsafe(lambda: stopped.done() or stopped.set_result(None))
+
+        # a daemon thread, rather than the loop's executor, which would wait for
+        # it on shutdown.
+        threading.Thread(target=wait_stop, name="gadfly-stop-queue", daemon=True).start()
+        for sup in self._supervised:
+            self._start(sup)
+        try:
+            await stopped
+        finally:
+            self._stopping = True
+            for sup in self._supervised:
+                if sup.cp.process is not None and sup.cp.process.is_alive():
+                    sup.cp.stop()
+
+    def _start(self, sup: Supervised) -> None:
+        if self._stopping:
+            return
+        p = sup.cp.spawn(ctx=self._ctx)
+        p.start()
+        sup.started_at = self._loop.time()
+        try:
+            self._loop.add_reader(p.sentinel, self._on_exit, sup, p)
+        except NotImplementedError:
+            # the loop cannot watch handles (Windows), wait in a thread instead
+            fut = self._loop.run_in_executor(None, p.join)
+            fut.add_done_callback(lambda _: self._on_exit(sup, p))
+
+    def _on_exit(self, sup: Supervised, p: BaseProcess) -> None:
+        try:
+            self._loop.remove_reader(p.sentinel)
+        except NotImplementedError:
+            pass
+        p.join()
+        if self._stopping:
+            return
+        if p.exitcode == 0:
+            # exited on purpose, e.g. the page compiler to re-evaluate the context.
+            # Processes failing fatally also exit cleanly, after writing to the stop
+            # queue - give the stop queue thread a moment to notice.
+            self._loop.call_later(RESTART_GRACE, self._start, sup)
+            return
+        if self._on_crash is not None:
+            self._on_crash(sup.name, p.exitcode)
+        ran = self._loop.time() - sup.started_at
+        if ran >= STABLE_AFTER:
+            sup.backoff = BACKOFF_INITIAL
+            delay = 0.0
+        else:
+            delay = sup.backoff
+            sup.backoff = min(sup.backoff * 2, BACKOFF_MAX)
+        cli.info(f"{sup.name} exited (code {p.exitcode}), restarting in {delay:.1f}s")
+        self._loop.call_later(delay, self._start, sup)
@@ -1,10 +1,11 @@
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, TextIO
 from pathlib import Path
 from io import StringIO
 from mako.runtime import Context, TemplateNamespace
 from mako.template import Template
 from mako.lookup import TemplateLookup
 from gadfly.config import Config
+from gadfly.shared_context import LazyContext
 
 
 class Environment:
@@ -19,7 +20,10 @@ class Environment:
         #
         # self.module_directory = module_directory
         self._config = config
-        self._lookup = TemplateLookup(directories=[config.templates_path])
+        # unbounded by default, low-memory builds evict the least recently used templates
+        self._lookup = TemplateLookup(
+            directories=[config.templates_path],
+            collection_size=config.build.template_cache_size if config.build.low_memory else -1)
         self._prelude_template = prelude_ns()
         pass
 
@@ -31,12 +35,31 @@ class Environment:
             lookup=self._lookup
         )
 
+    def template(self, name: str) -> Template:
+        """Template `name`, relative to the templates directory.
+
+        Unlike `template_from_file`, the template is compiled once and kept
+        by the lookup, which recompiles it if the file changes."""
+        return self._lookup.get_template("/" + Path(name).as_posix().lstrip("/"))
+
     def render(self, template: Template, render_ctx: Dict[str, Any]) -> str:
         buf = StringIO()
-        mako_ctx = Context(buf, **{
-            **self._config.context,
-            **render_ctx
-        })
+        self.render_to(template, render_ctx, buf)
+        return buf.getvalue()
+
+    def render_to(self, template: Template, render_ctx: Dict[str, Any], buf: TextIO) -> None:
+        """Render template, writing the output to `buf` as it is produced."""
+        context = self._config.context
+        if isinstance(context, LazyContext):
+            # worker process: keep values in the shared context until the template looks them up
+            mako_ctx = Context(buf, **render_ctx)
+            mako_ctx._data = context.overlay(mako_ctx._data)
+            mako_ctx._kwargs = context.overlay(render_ctx)
+        else:
+            mako_ctx = Context(buf, **{
+                **context,
+                **render_ctx
+            })
         prelude_ns = TemplateNamespace(
             "gadfly",
             mako_ctx,
@@ -46,13 +69,13 @@ class Environment:
         mako_ctx._data["gadfly"] = prelude_ns
         # template.render_context(mako_ctx, **{**self._config.context, **render_ctx})
         template.render_context(mako_ctx)
-        return buf.getvalue()
         # return template.render(**{**self._config.context, **render_ctx})
 
 
 def prelude_ns() -> Template:
     return Template("""<%!
 from markdown_it import MarkdownIt
+from gadfly import deps, images
 
 def to_markdown(fn):
     def decorate(context, *args, **kwargs):
@@ -63,7 +86,11 @@ def to_markdown(fn):
 %>
 <%def name="markdown()" decorator="to_markdown">
 ${caller.body()}
-</%def>""")
+</%def>
+<%def name="asset(path)">${deps.asset(context.get('gf_page_name'), path)}</%def>
+<%def name="depends(path)">${deps.depends(context.get('gf_page_name'), path)}</%def>
+<%def name="srcset(src, fmt=None, asset=None)">${images.srcset(src, fmt, asset, page_name=context.get('gf_page_name'))}</%def>
+<%def name="img(src, alt='', sizes='100vw', asset=None, **attrs)">${images.img(src, alt, sizes, asset, page_name=context.get('gf_page_name'), **attrs)}</%def>""")
 
 
 # mako.runtime.py, _populate_self_namespace
@@ -0,0 +1,213 @@
+"""Ordered pipeline of output transforms applied to each page after compilation.
+
+Transforms are declared as `[[transforms]]` entries in `gadfly.toml` and called
+as `fn(page_name, content, options) -> content`, see `PageTransformFn`.
+
+Consecutive pure transforms are run as one job in a worker process. Each pure
+transform's result is cached in `.gadfly/transforms/`, keyed by a hash of its
+input and of the transform itself (name, function, options and the source of the
+module defining the function). The cache is consulted before submitting work,
+so unchanged pages never reach the worker pool. Entries are touched when used,
+those not used by a full build are pruned once it completes, see `prune`.
+"""
+from collections import deque
+from concurrent.futures import Future
+from importlib.util import find_spec
+from pathlib import Path
+from hashlib import sha256
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+import importlib
+import json
+import os
+from gadfly.atomic import write_atomic
+from gadfly.config import Config, ConfigTransform
+from gadfly.utils import file_sha256
+from gadfly import metrics
+from gadfly import workers
+
+# transform and its cache key prefix
+Step = Tuple[ConfigTransform, str]
+
+# resolved transform functions, per process
+_fns: Dict[str, Callable] = {}
+# entries older than the start of a full build by this many seconds are pruned,
+# allowing for the file system's coarser clock.
+_PRUNE_SLACK_S = 2
+
+
+class TransformError(Exception):
+    def __init__(self, transform: ConfigTransform, message: str):
+        self.transform = transform
+        super().__init__(f"transform '{transform.name}' ({transform.fn}): {message}")
+
+
+def resolve_fn(transform: ConfigTransform) -> Callable:
+    fn = _fns.get(transform.fn)
+    if fn is not None:
+        return fn
+    module_name, fn_name = transform.fn.split(":")
+    try:
+        mod = importlib.import_module(module_name)
+    except ImportError as e:
+        raise TransformError(transform, f"could not import module '{module_name}'") from e
+    fn = getattr(mod, fn_name, None)
+    if fn is None:
+        raise TransformError(transform, f"fn {fn_name} not found in module file {mod.__file__}")
+    elif not callable(fn):
+        raise TransformError(transform, f"fn {fn_name} in module {module_name} not a callable!")
+    _fns[transform.fn] = fn
+    return fn
+
+
+def _transform_key(transform: ConfigTransform) -> str:
+    h = sha256()
+    h.update(transform.name.encode())
+    h.update(transform.fn.encode())
+    h.update(json.dumps(transform.options, sort_keys=True, default=str).encode())
+    spec = find_spec(transform.fn.split(":")[0])
+    if spec is not None and spec.origin and os.path.isfile(spec.origin):
+        # changing the transform's code invalidates its cached results
+        h.update(file_sha256(spec.origin).encode())
+    return h.hexdigest()
+
+
+def _input_key(transform_key: str, page_name: Path, content: str) -> str:
+    h = sha256(transform_key.encode())
+    h.update(b"\0")
+    h.update(page_name.as_posix().encode())
+    h.update(b"\0")
+    h.update(content.encode("utf-8"))
+    return h.hexdigest()
+
+
+def _cache_load(cache_dir: Path, key: str) -> Optional[str]:
+    fpath = cache_dir / key[:2] / key
+    try:
+        with open(fpath, "r", encoding="utf-8") as fh:
+            content = fh.read()
+        # marks the entry as used, see `TransformPipeline.prune`
+        os.utime(fpath)
+    except FileNotFoundError:
+        return None
+    return content
+
+
+def _cache_store(cache_dir: Path, key: str, content: str) -> None:
+    write_atomic(cache_dir / key[:2] / key, content.encode("utf-8"))
+
+
+def _run_pure(cache_dir: Path, steps: List[Step], page_name: Path, content: str) -> str:
+    # NOTE: runs in a worker process
+    for transform, transform_key in steps:
+        key = _input_key(transform_key, page_name, content)
+        cached = _cache_load(cache_dir, key)
+        if cached is not None:
+            content = cached
+            continue
+        content = resolve_fn(transform)(page_name, content, dict(transform.options))
+        _cache_store(cache_dir, key, content)
+    return content
+
+
+class TransformPipeline:
+    def __init__(self, cfg: Config, pool: workers.LazyPool):
+        """Pipeline of the configured transforms.
+
+        Raises:
+            TransformError: if a transform's function cannot be resolved.
+        """
+        self._cfg = cfg
+        self._cache_dir = cfg.cache_path / "transforms"
+        self._pool = pool
+        self._pending: Deque[Future] = deque()
+        # group consecutive transforms of same purity, pure groups run as one worker job
+        self._segments: List[Tuple[bool, List[Step]]] = []
+        for transform in cfg.transforms:
+            resolve_fn(transform)
+            step = (transform, _transform_key(transform) if transform.pure else "")
+            if self._segments and self._segments[-1][0] == transform.pure:
+                self._segments[-1][1].append(step)
+            else:
+                self._segments.append((transform.pure, [step]))
+
+    def apply(self, page_name: Path, content: str, on_done: Callable[[Future], None]) -> None:
+        """Apply transforms to page content.
+
+        Impure transforms are run right away, pure ones in the worker pool.
+
+        Args:
+            page_name: path of the page, relative to the pages directory.
+            content: compiled page content.
+            on_done: called with a future resolving to the transformed content
+                     (or the error of the failing transform), possibly from another thread.
+        """
+        fut: Optional[Future] = None
+        try:
+            for pure, steps in self._segments:
+                if fut is not None:
+                    # an impure transform must wait for the preceding pure ones
+                    content = fut.result()
+                    fut = None
+                if not pure:
+                    for transform, _ in steps:
+                        content = resolve_fn(transform)(page_name, content, dict(transform.options))
+                    continue
+                while steps:
+                    cached = _cache_load(self._cache_dir, _input_key(steps[0][1], page_name, content))
+                    metrics.cache("transforms", cached is not None)
+                    if cached is None:
+                        break
+                    content = cached
+                    steps = steps[1:]
+                if steps:
+                    fut = self._pool.get().submit(_run_pure, self._cache_dir, steps, page_name, content)
+        except Exception as e:
+            # fails the page, like a pure transform failing in the pool
+            fut = Future()
+            fut.set_exception(e)
+            on_done(fut)
+            return
+        if fut is None:
+            # nothing left to wait for, no need to track the page
+            fut = Future()
+            fut.set_result(content)
+            on_done(fut)
+            return
+        # signals completion of `on_done`, which runs after the result is set.
+        done = Future()
+        # drop pages already handled, a full build would otherwise keep one per page.
+        # Pages mostly complete in order, pruning from the front suffices.
+        while self._pending and self._pending[0].done():
+            self._pending.popleft()
+        self._pending.append(done)
+
+        def _finish(result: Future):
+            try:
+                on_done(result)
+            finally:
+                done.set_result(None)
+        fut.add_done_callback(_finish)
+
+    def wait(self) -> None:
+        """Block until all pages passed to `apply` are transformed and handled."""
+        pending, self._pending = self._pending, deque()
+        for done in pending:
+            done.result()
+
+    def prune(self, since: float) -> None:
+        """Remove cached results not used since `since` (a `time.time()`),
+        called once a full build started then has transformed every page."""
+        if not self._cache_dir.exists():
+            return
+        cutoff = since - _PRUNE_SLACK_S
+        for dirpath, _dir_names, file_names in os.walk(self._cache_dir):
+            for name in file_names:
+                fpath = Path(dirpath, name)
+                try:
+                    if fpath.stat().st_mtime < cutoff:
+                        fpath.unlink()
+                except FileNotFoundError:
+                    continue
+
+    def close(self) -> None:
+        self.wait()
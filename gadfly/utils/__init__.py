@@ -1,24 +1,28 @@
 from gadfly.config import Config
-from typing import Union
+from gadfly.compress import remove_variants
+from typing import Union, TYPE_CHECKING
 from pathlib import Path
 from hashlib import sha256
-from watchdog.events import FileSystemEvent
 from contextlib import contextmanager
 import os
 
+if TYPE_CHECKING:
+    from watchdog.events import FileSystemEvent
+
 
 def file_sha256(fpath: Union[str, Path]) -> str:
     with open(fpath, "rb") as fh:
         return sha256(fh.read()).hexdigest()
 
 
-def is_page(event: FileSystemEvent) -> bool:
+def is_page(event: "FileSystemEvent") -> bool:
     return ((not event.is_directory)
             and event.src_path.endswith(".md"))
 
 
 def delete_output(path: Path):
     path.unlink(missing_ok=True)
+    remove_variants(path)
     if path.name == "index.html":
         # will error out if dir is not empty, that's OK.
         # TODO: test, capture error and print relevant message
@@ -0,0 +1,303 @@
+"""File watchers: the event handlers feeding the compile processes, ignore
+patterns and scheduling of watches around ignored subtrees.
+
+Only imported in watch mode, as importing watchdog is comparatively slow.
+
+Patterns follow (a subset of) .gitignore semantics:
+* a pattern without a '/' is matched against each path component, so
+  `node_modules` ignores every directory of that name and `*.swp` every swap file.
+* a pattern with a '/' is matched against the path relative to the watch root,
+  e.g. `vendor/*.min.js`.
+"""
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+import multiprocessing as mp
+import fnmatch
+import os
+import re
+import time
+from watchdog.events import FileSystemEventHandler, FileSystemEvent, FileSystemMovedEvent, EVENT_TYPE_CREATED
+from gadfly.utils import file_sha256, is_page
+from gadfly.mp import EventType
+from gadfly.cli import colors
+from gadfly import config
+
+# ignored by every watcher
+DEFAULT_IGNORE = [
+    # version control
+    ".git", ".hg", ".svn",
+    # tooling
+    "node_modules", "__pycache__", ".pytest_cache", ".mypy_cache", ".venv", ".gadfly",
+    # editor swap, backup and lock files
+    "*.swp", "*.swo", "*.swx", "4913", "*~", ".#*", "#*#",
+    # os metadata
+    ".DS_Store", "Thumbs.db",
+]
+
+_NEVER = re.compile(r"(?!)")
+
+
+def _compile(patterns: Iterable[str]) -> "re.Pattern":
+    patterns = list(patterns)
+    if not patterns:
+        return _NEVER
+    # one regex for all patterns, matching costs a single scan per path component
+    return re.compile("|".join(f"(?:{fnmatch.translate(pattern)})" for pattern in patterns))
+
+
+class IgnoreMatcher:
+    def __init__(self, root: Path, patterns: Iterable[str], excluded: Iterable[Path] = ()):
+        """Decide which paths below `root` are ignored.
+
+        Args:
+            root: the watch root, path patterns are relative to it.
+            patterns: glob patterns, see module docstring.
+            excluded: absolute paths of directories to ignore in their entirety
+                      (e.g. the output directory).
+        """
+        self.root = str(root)
+        patterns = list(patterns)
+        self._name_re = _compile(p.rstrip("/") for p in patterns if "/" not in p.rstrip("/"))
+        self._path_re = _compile(p.strip("/") for p in patterns if "/" in p.rstrip("/"))
+        self._excluded = [str(path) for path in excluded]
+
+    def ignored(self, path: str) -> bool:
+        """Whether (absolute) `path` is ignored."""
+        for excluded in self._excluded:
+            if path == excluded or path.startswith(excluded + os.sep):
+                return True
+        rel = os.path.relpath(path, self.root)
+        if rel == ".":
+            return False
+        if rel.startswith(".." + os.sep):
+            # outside the root, not for us to decide.
+            return False
+        # a path is ignored if it, or any directory above it, matches
+        prefix = ""
+        for part in rel.split(os.sep):
+            if self._name_re.match(part):
+                return True
+            prefix = f"{prefix}/{part}" if prefix else part
+            if self._path_re.match(prefix):
+                return True
+        return False
+
+    def plan(self, top: str) -> List[Tuple[str, bool]]:
+        """Determine the watches needed to cover `top` except for ignored subtrees.
+
+        Directories whose subtree contains nothing ignored are watched recursively,
+        the directories above ignored subtrees are watched non-recursively. Ignored
+        subtrees are never descended into.
+
+        Returns:
+            list of (directory, recursive) tuples.
+        """
+        watches = []
+        # directory => whether some (transitive) subdirectory is ignored
+        prunes: Dict[str, bool] = {}
+        order = []
+        for dirpath, dir_names, _file_names in os.walk(top):
+            order.append(dirpath)
+            kept = [name for name in dir_names if not self.ignored(os.path.join(dirpath, name))]
+            prunes[dirpath] = len(kept) != len(dir_names)
+            dir_names[:] = kept
+        # propagate bottom-up, os.walk yields parents before their children
+        for dirpath in reversed(order):
+            if prunes[dirpath] and dirpath != top:
+                prunes[os.path.dirname(dirpath)] = True
+        covered: Set[str] = set()
+        for dirpath in order:
+            if os.path.dirname(dirpath) in covered:
+                covered.add(dirpath)
+                continue
+            if prunes[dirpath]:
+                watches.append((dirpath, False))
+            else:
+                watches.append((dirpath, True))
+                covered.add(dirpath)
+        return watches
+
+
+class TreeWatch:
+    def __init__(self, observer, handler, root: Path, matcher: IgnoreMatcher):
+        """Watch `root` for `handler`, skipping subtrees ignored by `matcher`.
+
+        The handler must route directory creations to `dir_added` (see
+        `BaseEventHandler.dispatch`), as new directories below non-recursively
+        watched directories need watches of their own.
+        """
+        self._observer = observer
+        self._handler = handler
+        self._matcher = matcher
+        self._root = str(root)
+        # directories watched non-recursively
+        self._flat: Set[str] = set()
+        handler.ignore = matcher
+        handler.tree = self
+
+    def _schedule(self, top: str) -> None:
+        for dirpath, recursive in self._matcher.plan(top):
+            self._observer.schedule(self._handler, dirpath, recursive=recursive)
+            if not recursive:
+                self._flat.add(dirpath)
+
+    def start(self) -> None:
+        if os.path.isdir(self._root):
+            self._schedule(self._root)
+        else:
+            self._observer.schedule(self._handler, self._root, recursive=False)
+
+    def dir_added(self, path: str) -> None:
+        if os.path.dirname(path) in self._flat and not self._matcher.ignored(path):
+            self._schedule(path)
+
+
+class BaseEventHandler(FileSystemEventHandler):
+    def __init__(self, queue: mp.Queue):
+        self._db = {}
+        self._queue = queue
+        # set by `TreeWatch`
+        self.ignore: Optional[IgnoreMatcher] = None
+        self.tree: Optional[TreeWatch] = None
+
+    def dispatch(self, event: FileSystemEvent) -> None:
+        # filter before any handler (and hashing) sees the event
+        if self.ignore is not None:
+            dest_path = getattr(event, "dest_path", None)
+            if self.ignore.ignored(event.src_path) and (dest_path is None or self.ignore.ignored(dest_path)):
+                return
+        if self.tree is not None and event.is_directory:
+            if event.event_type == EVENT_TYPE_CREATED:
+                self.tree.dir_added(event.src_path)
+            elif isinstance(event, FileSystemMovedEvent):
+                self.tree.dir_added(event.dest_path)
+        super().dispatch(event)
+
+    def hash_db_clear(self, fpath: str):
+        # never hashed if not modified since watching started
+        self._db.pop(fpath, None)
+
+    def hash_db_set(self, fpath: str):
+        """Forcefully set entry's hash.
+        NOTE: do not use if already calling `is_file_changed`."""
+        self._db[fpath] = file_sha256(fpath)
+
+    def hash_db_update(self, fpath) -> bool:
+        old_hash = self._db.get(fpath)
+        new_hash = file_sha256(fpath)
+        if old_hash != new_hash:
+            self._db[fpath] = new_hash
+            return True
+        return False
+
+    def send_event(self, event_type: str, payload: dict) -> None:
+        # stamped, so the compile processes can report the latency of rebuilds
+        self._queue.put({"type": event_type, "payload": payload, "ts": time.time()})
+
+
+class PageHandler(BaseEventHandler):
+    """Feeds page changes to the page compiler, which maintains the index of
+    the pages (see `gadfly.pages`) and deletes the outputs of deleted pages."""
+
+    def _deleted(self, path: str) -> None:
+        # a page or a directory, whichever it was
+        for fpath in [fpath for fpath in self._db if fpath == path or fpath.startswith(path + os.sep)]:
+            self.hash_db_clear(fpath)
+        self.send_event(EventType.PAGE_DELETED, {"page": path})
+
+    def _added_dir(self, path: str) -> None:
+        # moved in whole, no event is received for the pages within
+        for dirpath, _dir_names, file_names in os.walk(path):
+            for file_name in file_names:
+                fpath = os.path.join(dirpath, file_name)
+                if file_name.endswith(".md") and (self.ignore is None or not self.ignore.ignored(fpath)):
+                    if self.hash_db_update(fpath):
+                        self.send_event(EventType.PAGE_CHANGED, {"page": fpath})
+
+    def on_created(self, event: FileSystemEvent):
+        if event.is_directory:
+            self._added_dir(event.src_path)
+
+    def on_deleted(self, event: FileSystemEvent):
+        if event.is_directory or is_page(event):
+            self._deleted(event.src_path)
+
+    def on_moved(self, event: FileSystemMovedEvent):
+        if event.is_directory:
+            self._deleted(event.src_path)
+            self._added_dir(event.dest_path)
+            return
+        if event.src_path.endswith(".md"):
+            self._deleted(event.src_path)
+        if event.dest_path.endswith(".md"):
+            self.hash_db_update(event.dest_path)  # run for side-effects - updates hash entry
+            self.send_event(EventType.PAGE_CHANGED, {"page": event.dest_path})
+
+    def on_modified(self, event: FileSystemEvent):
+        if not is_page(event):
+            return
+        if self.hash_db_update(event.src_path):
+            self.send_event(EventType.PAGE_CHANGED, {"page": event.src_path})
+
+
+class ContextCodeHandler(BaseEventHandler):
+    def on_modified(self, event: FileSystemEvent):
+        if event.is_directory or not event.src_path.endswith(".py"):
+            return
+        if not self.hash_db_update(event.src_path):
+            return
+        self.send_event(EventType.CONTEXT_CHANGED, {})
+
+
+class TemplateEventHandler(BaseEventHandler):
+    def on_modified(self, event: FileSystemEvent):
+        if event.is_directory:
+            return
+        # a single save often yields several events, each would restart a full rebuild
+        if not self.hash_db_update(event.src_path):
+            return
+        self.send_event(EventType.TEMPLATE_CHANGED, {})
+
+
+class AssetEventHandler(BaseEventHandler):
+    def __init__(self, queue: mp.Queue, asset_name: str, asset_opts: dict):
+        super().__init__(queue)
+        self.asset_name = asset_name
+        # no validation here, validation happens at the point of reading in
+        # the configuration files.
+        self.asset_opts = asset_opts
+
+    def on_modified(self, event: FileSystemEvent):
+        if event.is_directory:
+            return
+        if not self.hash_db_update(event.src_path):
+            return
+        self.send_event(EventType.ASSET_CHANGED, {
+            "file": event.src_path,
+            "asset_name": self.asset_name,
+            "asset_opts": self.asset_opts,
+        })
+
+
+def schedule_watches(cfg: config.Config, observer, page_queue, asset_queue) -> None:
+    """Schedule the watches of pages, templates, context code and assets with `observer`.
+
+    Events are put on the page and asset compilers' queues (or stand-ins, see
+    `gadfly.supervisor.EventForwarder`)."""
+    def watch(handler: BaseEventHandler, root: Path, ignore: List[str]) -> None:
+        matcher = IgnoreMatcher(
+            root, [*DEFAULT_IGNORE, *cfg.watch.ignore, *ignore],
+            excluded=[cfg.output_path, cfg.cache_path])
+        TreeWatch(observer, handler, root, matcher).start()
+
+    module_path = Path(cfg.code.module_path)
+    watch(PageHandler(page_queue), cfg.pages_path.absolute(), cfg.watch.pages_ignore)
+    # watch the whole package, for a single-file module just the file itself
+    watch(ContextCodeHandler(page_queue),
+          module_path.parent if module_path.name == "__init__.py" else module_path,
+          cfg.watch.code_ignore)
+    watch(TemplateEventHandler(page_queue), cfg.templates_path.absolute(), cfg.watch.templates_ignore)
+    for asset_name, asset_opts in cfg.assets.items():
+        print(f"""{colors.B_MAGENTA}> {colors.B_WHITE}asset watcher {colors.B_MAGENTA}{asset_name}{colors.B_WHITE} (dir: {colors.B_MAGENTA}{asset_opts["dir"]}{colors.B_WHITE})""")
+        watch(AssetEventHandler(asset_queue, asset_name, asset_opts),
+              Path(asset_opts["dir"]), asset_opts.get("ignore", []))
@@ -0,0 +1,66 @@
+"""Worker processes for CPU-bound stages of the page compiler."""
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Optional
+import multiprocessing as mp
+import copy
+import os
+from gadfly import config
+from gadfly import shared_context
+
+
+def worker_count(cfg: config.Config) -> int:
+    return cfg.build.workers or os.cpu_count() or 1
+
+
+def _init_worker(cfg: config.Config, context_path: Optional[Path]) -> None:
+    # this globally assigned variable is not set in the new process.
+    config.config = cfg
+    if context_path is not None:
+        cfg.context = shared_context.attach(context_path)
+
+
+def create_pool(cfg: config.Config, context_path: Optional[Path] = None) -> ProcessPoolExecutor:
+    """Create pool of worker processes, each with `config.config` set to `cfg`.
+
+    With `context_path` (see `shared_context.write`), workers map the context
+    from there rather than receiving a copy of it."""
+    if context_path is not None:
+        cfg = copy.copy(cfg)
+        cfg.context = {}
+    return ProcessPoolExecutor(
+        max_workers=worker_count(cfg),
+        # same as the compile processes, fork is unsafe with the threads we run
+        mp_context=mp.get_context("spawn"),
+        initializer=_init_worker,
+        initargs=(cfg, context_path),
+    )
+
+
+class LazyPool:
+    def __init__(self, cfg: config.Config):
+        """Worker pool shared by the parallel stages of a process, started on first use.
+
+        Starting workers is not free, builds not needing them should not pay for it."""
+        self._cfg = cfg
+        self._pool: Optional[ProcessPoolExecutor] = None
+        # the context as mapped by the workers, see `gadfly.shared_context`
+        self._context_path: Optional[Path] = None
+        # whether workers were ever started
+        self.started = False
+
+    def get(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            if self._cfg.context and self._context_path is None:
+                self._context_path = shared_context.write(self._cfg, self._cfg.context)
+            self._pool = create_pool(self._cfg, self._context_path)
+            self.started = True
+        return self._pool
+
+    def shutdown(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+        if self._context_path is not None:
+            shared_context.remove(self._context_path)
+            self._context_path = None
@@ -19,7 +19,7 @@ setup(
     options={"bdist_wheel": {"universal": True}},
     entry_points = {
         "console_scripts": [
-            "gadfly=gadfly.__main__:main"
+            "gadfly=gadfly:main"
         ]
     },
     classifiers=[